@@ -19,20 +19,35 @@ workflows.
 """
 
 import asyncio
+import binascii
+import collections
 import datetime
+import functools
+import hashlib
+import itertools
 import logging
 import json
 import os
+import random
 import re
+import tempfile
+import time
+import urllib.parse
 import uuid
 
+import git_patrol_cloud_build
+import git_patrol_http
+import git_patrol_metrics
+import git_patrol_refs
+
 
 # Extract the commit hash and the reference name from the output of
-# 'git ls-remote --refs'. The exact regex for a reference name is tricky as seen
-# on StackOverflow (https://stackoverflow.com/questions/12093748). Since this
-# regex is parsing the output of the git command, we will assume it is well
-# formatted and just limit the length.
-GIT_HASH_REFNAME_REGEX = r'^([0-9a-f]{40})\s+(refs/[^\s]{1,64})$'
+# 'git ls-remote --refs'. Reference names follow the same rule as those listed
+# by the in-process smart HTTP client.
+GIT_HASH_REFNAME_REGEX = r'^([0-9a-f]{40})\s+(' + (
+    git_patrol_http.GIT_REFNAME_REGEX) + r')$'
+GIT_HASH_REFNAME_BYTES_REGEX = re.compile(
+    GIT_HASH_REFNAME_REGEX.encode(), re.MULTILINE)
 
 # Extract the Cloud Build UUID from the text sent to stdout when a build is
 # started with "gcloud builds submit ... --async".
@@ -44,6 +59,48 @@ GCB_ASYNC_BUILD_ID_REGEX = (
 # Limit on the total number of ref filters.
 MAX_REF_FILTERS = 5
 
+# Default limits on the size of a repository's ref advertisement. Polls of
+# repositories exceeding these limits fail rather than exhausting memory.
+MAX_REFS = 2000000
+MAX_REF_BYTES = 256 * 1024 * 1024
+
+# First git release supporting wire protocol version 2. Older releases refuse
+# to run with protocol.version=2.
+GIT_PROTOCOL_V2_VERSION = (2, 18)
+
+# Size of the chunks read from the output of 'git ls-remote'.
+LS_REMOTE_CHUNK_BYTES = 64 * 1024
+
+# Bounds in seconds on the time between build status checks of the shared
+# Cloud Build watcher. The watcher backs off towards the maximum while none of
+# the builds it waits for finish.
+BUILD_WATCH_MIN_INTERVAL_SECS = 5
+BUILD_WATCH_MAX_INTERVAL_SECS = 60
+
+# Number of consecutive failures to describe a finished build before giving up
+# on waiting for it.
+BUILD_DESCRIBE_ATTEMPTS = 3
+
+# Factor by which adaptive poll intervals grow after each poll that finds no
+# changes.
+ADAPTIVE_POLL_BACKOFF = 2.0
+
+# Number of recent changes of a repository used to seed its adaptive poll
+# interval.
+ADAPTIVE_POLL_HISTORY = 10
+
+# Where to continue the workflows of a git ref interrupted by a restart. All
+# dictionaries are keyed by the index of the workflow in the target's
+# workflows.
+#   - finished: (bool, int) tuples of the workflows that already ran, with
+#     whether they succeeded and the journal ID of their latest entry. The
+#     journal ID is None for workflows that will never run.
+#   - parent_ids: Journal IDs of the latest entry of the workflows that are
+#     pending or have a build in progress.
+#   - build_ids: IDs of the Cloud Builds in progress.
+WorkflowResume = collections.namedtuple(
+    'WorkflowResume', ['finished', 'parent_ids', 'build_ids'])
+
 # Route logs to StackDriver when running in the Cloud. The Google Cloud logging
 # library enables logs for INFO level by default.
 # Adapted from the "Setting up StackDriver Logging for Python" page at
@@ -59,32 +116,197 @@ except (ImportError, google.auth.exceptions.GoogleAuthError) as ex:
   logger.addHandler(logging.StreamHandler())
 
 
-def make_subprocess_cmd(cmd):
+def make_subprocess_cmd(cmd, semaphore=None):
   """Creates a function that returns an async subprocess.
 
   Args:
     cmd: Command to run in the subprocess. Arguments should be provided when
       calling the returned function.
+    semaphore: Optional asyncio.Semaphore shared by the commands whose
+      processes count towards the same limit. Starting a process waits for
+      the semaphore, which is released once the process exits.
   Returns:
     A function that creates an asyncio.subprocess.Process instance.
   """
-  def subprocess_cmd(*args, cwd=None):
+  async def subprocess_cmd(*args, cwd=None):
+    if semaphore:
+      await semaphore.acquire()
     logger.info('Running "%s %s"', cmd, ' '.join(args))
-    return asyncio.create_subprocess_exec(
-        cmd, *args, stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE, cwd=cwd)
+    try:
+      proc = await asyncio.create_subprocess_exec(
+          cmd, *args, stdout=asyncio.subprocess.PIPE,
+          stderr=asyncio.subprocess.PIPE, cwd=cwd)
+    except BaseException:
+      if semaphore:
+        semaphore.release()
+      raise
+    if semaphore:
+      asyncio.ensure_future(proc.wait()).add_done_callback(
+          lambda _: semaphore.release())
+    return proc
   return subprocess_cmd
 
 
+def url_host(url):
+  """Extract the host name from a git repository URL.
+
+  Handles both regular URLs (ex: https://host/repo.git) and the scp-like syntax
+  understood by git (ex: user@host:repo.git).
+
+  Args:
+    url: URL of the git repository.
+  Returns:
+    The host name, or an empty string for local repositories.
+  """
+  parsed = urllib.parse.urlsplit(url)
+  if parsed.scheme:
+    return parsed.hostname or ''
+  host, separator, _ = url.partition(':')
+  if separator:
+    return host.rpartition('@')[2]
+  return ''
+
+
+class PollScheduler:
+  """Bounds the number of repository polls running at the same time.
+
+  Rather than each target loop running its poll as soon as it wakes up, all
+  target loops submit their polls to a shared scheduler. A fixed number of
+  workers run the submitted polls in order of their planned wake-up time while
+  limiting the number of simultaneous polls against any single host. This keeps
+  the number of git processes and remote requests flat regardless of the number
+  of targets.
+  """
+
+  def __init__(self, max_workers, max_per_host=None):
+    """Create a new poll scheduler.
+
+    Args:
+      max_workers: Maximum number of polls to run at the same time.
+      max_per_host: Maximum number of polls to run at the same time against the
+        same host. None for no per-host limit.
+    """
+    self.max_workers = max_workers
+    self.max_per_host = max_per_host
+    self._pending = []
+    self._sequence = itertools.count()
+    self._host_polls = collections.Counter()
+    self._condition = asyncio.Condition()
+
+  async def submit(self, due_time, url, poll_fn):
+    """Queue a poll and wait for its result.
+
+    Args:
+      due_time: Planned start time of the poll in event loop time. Polls with
+        earlier due times are run first.
+      url: URL of the repository being polled.
+      poll_fn: Coroutine function that performs the poll.
+    Returns:
+      The value returned by poll_fn.
+    """
+    future = asyncio.get_event_loop().create_future()
+    async with self._condition:
+      self._pending.append(
+          (due_time, next(self._sequence), url_host(url), poll_fn, future))
+      self._condition.notify()
+    return await future
+
+  def _pop_runnable(self):
+    """Remove and return the earliest queued poll allowed to run, if any."""
+    runnable = [
+        item for item in self._pending
+        if self.max_per_host is None or
+        self._host_polls[item[2]] < self.max_per_host]
+    if not runnable:
+      return None
+    item = min(runnable, key=lambda pending: pending[:2])
+    self._pending.remove(item)
+    return item
+
+  async def _worker(self):
+    while True:
+      async with self._condition:
+        item = self._pop_runnable()
+        while not item:
+          await self._condition.wait()
+          item = self._pop_runnable()
+        _, _, host, poll_fn, future = item
+        self._host_polls[host] += 1
+
+      try:
+        # The submitter may have given up while the poll was queued.
+        if not future.done():
+          result = await poll_fn()
+          if not future.done():
+            future.set_result(result)
+      except Exception as e:
+        if not future.done():
+          future.set_exception(e)
+      finally:
+        async with self._condition:
+          self._host_polls[host] -= 1
+          self._condition.notify_all()
+
+  async def run(self):
+    """Run the scheduler's workers. Loops forever."""
+    await asyncio.gather(*[self._worker() for _ in range(self.max_workers)])
+
+
 class GitPatrolCommands:
 
-  def __init__(self):
-    self.git = make_subprocess_cmd('git')
-    self.gcloud = make_subprocess_cmd('gcloud')
+  def __init__(self, max_subprocesses=None):
+    # Processes of all commands share one limit when max_subprocesses is set.
+    semaphore = None
+    if max_subprocesses:
+      semaphore = asyncio.Semaphore(max_subprocesses)
+    self.git = make_subprocess_cmd('git', semaphore)
+    self.gcloud = make_subprocess_cmd('gcloud', semaphore)
+    # Optional git_patrol_http.GitSmartHttpClient used to list the refs of
+    # HTTP(S) repositories without running 'git ls-remote'.
+    self.git_http = None
+    # Limits on the number of refs and bytes accepted from a single poll.
+    self.max_refs = MAX_REFS
+    self.max_ref_bytes = MAX_REF_BYTES
+    # Optional git_patrol_cloud_build.CloudBuildClient used to start and wait
+    # for workflows through the Cloud Build REST API instead of 'gcloud'.
+    self.cloud_build = None
+    # Optional CloudBuildWatcher shared by all workflows waiting for builds.
+    self.build_watcher = None
+    # Whether the installed git supports wire protocol version 2. Checked on
+    # first use when None.
+    self.git_protocol_v2 = None
+
+
+def check_ref_format(ref_filter):
+  """Validate a ref filter like 'git check-ref-format'.
+
+  Applies the rules of 'git check-ref-format --allow-onelevel
+  --refspec-pattern' in-process. See
+  https://git-scm.com/docs/git-check-ref-format for the rules.
+
+  Args:
+    ref_filter: The git ref filter to validate.
+  Returns:
+    True for a valid ref filter. False otherwise.
+  """
+  if not ref_filter or ref_filter == '@' or ref_filter.endswith('.'):
+    return False
+  if '..' in ref_filter or '@{' in ref_filter or ref_filter.count('*') > 1:
+    return False
+  if any(ord(c) < 0x20 or ord(c) == 0x7f or c in ' ~^:?[\\'
+         for c in ref_filter):
+    return False
+  return all(
+      component and not component.startswith('.') and
+      not component.endswith('.lock')
+      for component in ref_filter.split('/'))
 
 
 async def git_check_ref_filter(commands, ref_filter):
-  """Use the git command to validate a ref filter.
+  """Validate a ref filter.
+
+  Uses check_ref_format() rather than running 'git check-ref-format', so
+  validating the filters of many targets doesn't start a process per filter.
 
   Args:
     commands: GitPatrolCommands object used to execute external commands.
@@ -92,11 +314,7 @@ async def git_check_ref_filter(commands, ref_filter):
   Returns:
     True for a valid ref filter. False otherwise.
   """
-  git_subproc = await commands.git(
-      'check-ref-format', '--allow-onelevel', '--refspec-pattern', ref_filter)
-  await git_subproc.communicate()
-  returncode = await git_subproc.wait()
-  return returncode == 0
+  return check_ref_format(ref_filter)
 
 
 def log_command_error(command, returncode, stdout_bytes, stderr_bytes):
@@ -115,13 +333,160 @@ def log_command_error(command, returncode, stdout_bytes, stderr_bytes):
       '%s stderr:\n%s', command, stderr_bytes.decode('utf-8', 'ignore'))
 
 
-async def fetch_git_refs(commands, url, ref_filters):
+def ls_remote_namespace_args(ref_filters):
+  """Translate ref filters into 'git ls-remote' namespace options.
+
+  With git protocol version 2 the server only advertises the refs matching the
+  'ref-prefix' arguments sent by the client. The 'git ls-remote' command only
+  sends those for its --heads and --tags options since its patterns are matched
+  against the tail of the ref names. Use these options whenever every filter is
+  confined to the refs/heads/ or refs/tags/ namespaces.
+
+  Args:
+    ref_filters: A (possibly empty) list of ref filter patterns.
+  Returns:
+    A (possibly empty) list of 'git ls-remote' options.
+  """
+  prefixes = git_patrol_http.ref_filters_prefixes(ref_filters)
+  if not prefixes:
+    return []
+  heads = [p for p in prefixes if p.startswith('refs/heads/')]
+  tags = [p for p in prefixes if p.startswith('refs/tags/')]
+  if len(heads) + len(tags) != len(prefixes):
+    return []
+  return (['--heads'] if heads else []) + (['--tags'] if tags else [])
+
+
+class RefLimitExceeded(Exception):
+  """Raised when a ref advertisement exceeds the configured limits."""
+
+
+async def read_git_refs(stream, max_refs, max_bytes, previous_refs=None):
+  """Parse 'git ls-remote' output.
+
+  The output is read in chunks and hashed, and the hash becomes the validator
+  of the result. Without a previous validator to compare with, each complete
+  line is parsed as soon as it is available.
+
+  When previous_refs has a validator, the output is spooled to a temporary
+  file instead, which only stays in memory while it is small, and parsed
+  from there only if its hash differs. Unchanged output is never parsed and
+  previous_refs itself is returned, so it doesn't need a new ref table or a
+  comparison with the previous one either. The ref limit is then enforced by
+  counting lines while reading.
+
+  Args:
+    stream: asyncio.StreamReader connected to the command's stdout.
+    max_refs: Maximum number of refs to accept. None for no limit.
+    max_bytes: Maximum number of bytes to accept. None for no limit.
+    previous_refs: Optional RefTable parsed from the previous output.
+  Returns:
+    A (RefTable, int) tuple. The first item holds the git references and
+    commit hashes, and is previous_refs itself when the output is unchanged.
+    The second item is the number of bytes read.
+  Raises:
+    RefLimitExceeded: The output exceeded one of the limits.
+  """
+  previous_validator = getattr(previous_refs, 'validator', None)
+  digest = hashlib.sha1()
+  names = []
+  hashes = bytearray()
+  bytes_read = 0
+  lines = 0
+  pending = b''
+
+  def parse_lines(chunk):
+    # Only parse complete lines. The last chunk might not end with a newline.
+    nonlocal pending
+    data = pending + chunk
+    end = len(data) if not chunk else data.rfind(b'\n') + 1
+    pending = data[end:]
+    for match in GIT_HASH_REFNAME_BYTES_REGEX.finditer(data, 0, end):
+      names.append(match.group(2).decode('utf-8', 'ignore'))
+      hashes.extend(binascii.unhexlify(match.group(1)))
+    if max_refs and len(names) > max_refs:
+      raise RefLimitExceeded('more than {} refs'.format(max_refs))
+
+  spool = None
+  if previous_validator:
+    spool = tempfile.SpooledTemporaryFile(max_size=LS_REMOTE_CHUNK_BYTES)
+  try:
+    while True:
+      chunk = await stream.read(LS_REMOTE_CHUNK_BYTES)
+      bytes_read += len(chunk)
+      if max_bytes and bytes_read > max_bytes:
+        raise RefLimitExceeded('more than {} bytes'.format(max_bytes))
+      digest.update(chunk)
+      if spool:
+        lines += chunk.count(b'\n')
+        if max_refs and lines > max_refs:
+          raise RefLimitExceeded('more than {} refs'.format(max_refs))
+        spool.write(chunk)
+      else:
+        parse_lines(chunk)
+      if not chunk:
+        break
+
+    validator = 'sha1:' + digest.hexdigest()
+    if validator == previous_validator:
+      return previous_refs, bytes_read
+    if spool:
+      spool.seek(0)
+      while True:
+        chunk = spool.read(LS_REMOTE_CHUNK_BYTES)
+        parse_lines(chunk)
+        if not chunk:
+          break
+  finally:
+    if spool:
+      spool.close()
+
+  refs = git_patrol_refs.RefTable.from_parsed(names, hashes)
+  refs.validator = validator
+  return refs, bytes_read
+
+
+def observe_ls_remote(url, transport, start_time, bytes_received):
+  """Record the latency and size of a successful ref listing."""
+  host = url_host(url)
+  git_patrol_metrics.LS_REMOTE_SECONDS.labels(host, transport).observe(
+      time.perf_counter() - start_time)
+  git_patrol_metrics.LS_REMOTE_BYTES.labels(host, transport).observe(
+      bytes_received)
+
+
+async def git_supports_protocol_v2(commands):
+  """Check once whether the installed git supports wire protocol version 2.
+
+  Args:
+    commands: GitPatrolCommands object used to execute external commands.
+  Returns:
+    True when 'git ls-remote' can be run with protocol.version=2.
+  """
+  if commands.git_protocol_v2 is None:
+    git_subproc = await commands.git('version')
+    stdout_bytes, _ = await git_subproc.communicate()
+    returncode = await git_subproc.wait()
+    match = re.search(rb'(\d+)\.(\d+)', stdout_bytes)
+    commands.git_protocol_v2 = bool(
+        not returncode and match and
+        tuple(int(n) for n in match.groups()) >= GIT_PROTOCOL_V2_VERSION)
+    if not commands.git_protocol_v2:
+      logger.warning(
+          'git protocol version 2 is not supported by %r',
+          stdout_bytes.decode('utf-8', 'ignore').strip())
+  return commands.git_protocol_v2
+
+
+async def fetch_git_refs(commands, url, ref_filters, previous_refs=None):
   """Fetch tags and HEADs from the provided git repository URL.
 
   Use 'git ls-remote --refs' to fetch the current list of references from the
-  repository. If successful the information is returned as a dictionary. The
-  dictionary keys will be the full reference names and the values will be the
-  commit hash associated with that reference.
+  repository. HTTP(S) repositories are queried in-process when an in-process
+  smart HTTP client is available, falling back to the git command if that
+  fails. If successful the information is returned as a RefTable, which behaves
+  like a read-only dictionary. The keys will be the full reference names and
+  the values will be the commit hash associated with that reference.
 
   Example:
     {
@@ -136,23 +501,78 @@ async def fetch_git_refs(commands, url, ref_filters):
     url: URL of git repo to retrieve refs from.
     ref_filters: A (possibly empty) list of ref filters to pass to the
       'git ls-remote' command to filter the returned refs.
+    previous_refs: Optional RefTable returned by the previous call for this
+      repository and ref filters. Its validator lets unchanged refs be
+      detected without parsing them again.
   Returns:
-    Returns a dictionary of git references and commit hashes retrieved from the
-    repository if successful. Returns None when the underlying git command
-    fails.
+    Returns a RefTable of git references and commit hashes retrieved from the
+    repository if successful. This is previous_refs itself when the refs are
+    known to be unchanged. Returns None when the underlying git command fails.
   """
-  git_subproc = await commands.git('ls-remote', '--refs', url, *ref_filters)
-  stdout_bytes, stderr_bytes = await git_subproc.communicate()
+  start_time = time.perf_counter()
+  if commands.git_http and commands.git_http.supports(url):
+    try:
+      refs, bytes_received, validator = (
+          await commands.git_http.ls_refs_if_changed(
+              url, ref_filters, getattr(previous_refs, 'validator', None),
+              commands.max_ref_bytes))
+      observe_ls_remote(url, 'http', start_time, bytes_received)
+      if refs is None:
+        logger.info('%s: refs unchanged (%d bytes)', url, bytes_received)
+        return previous_refs
+      if commands.max_refs and len(refs) > commands.max_refs:
+        logger.warning('%s: too many refs: %d', url, len(refs))
+        return None
+      logger.info(
+          '%s: received %d refs in %d bytes', url, len(refs), bytes_received)
+      refs = git_patrol_refs.RefTable(refs)
+      refs.validator = validator
+      return refs
+    except git_patrol_http.GitHttpLimitError as e:
+      logger.warning('%s: too many refs: %s', url, e)
+      return None
+    except git_patrol_http.GitHttpError as e:
+      logger.warning('%s: falling back to git ls-remote: %s', url, e)
+
+  # Force git protocol version 2 so the server can skip refs that can't match
+  # the ref filters rather than advertising every ref in the repository.
+  protocol_args = []
+  if await git_supports_protocol_v2(commands):
+    protocol_args = ['-c', 'protocol.version=2']
+  git_subproc = await commands.git(
+      *protocol_args, 'ls-remote', '--refs',
+      *ls_remote_namespace_args(ref_filters), url, *ref_filters)
+
+  # Drain stderr in the background so the command can't block on a full pipe
+  # while the refs are parsed from stdout.
+  stderr_task = asyncio.ensure_future(git_subproc.stderr.read())
+  try:
+    refs, bytes_read = await read_git_refs(
+        git_subproc.stdout, commands.max_refs, commands.max_ref_bytes,
+        previous_refs)
+  except RefLimitExceeded as e:
+    logger.warning('%s: too many refs: %s', url, e)
+    git_subproc.kill()
+    await git_subproc.wait()
+    await stderr_task
+    return None
+
+  stderr_bytes = await stderr_task
   returncode = await git_subproc.wait()
   if returncode:
-    log_command_error('git ls-remote', returncode, stdout_bytes, stderr_bytes)
+    log_command_error('git ls-remote', returncode, b'', stderr_bytes)
     return None
 
-  # Note that re.findall() returns group matches as tuples, so a conversion to
-  # lists is necessary.
-  raw_refs = stdout_bytes.decode('utf-8', 'ignore')
-  refs = re.findall(GIT_HASH_REFNAME_REGEX, raw_refs, re.MULTILINE)
-  return {refname: commit for (commit, refname) in refs}
+  observe_ls_remote(url, 'git', start_time, bytes_read)
+  if refs is previous_refs:
+    logger.info(
+        '%s: refs unchanged (%d bytes, protocol v%d)', url, bytes_read,
+        2 if protocol_args else 0)
+  else:
+    logger.info(
+        '%s: received %d refs in %d bytes (protocol v%d)', url, len(refs),
+        bytes_read, 2 if protocol_args else 0)
+  return refs
 
 
 async def cloud_build_start(commands, config_path, config, git_ref):
@@ -170,33 +590,44 @@ async def cloud_build_start(commands, config_path, config, git_ref):
     https://cloud.google.com/cloud-build/docs/api/reference/rest/v1/operations#Operation
     Otherwise returns None.
   """
-  arg_config = '--config={}'.format(os.path.join(config_path, config['config']))
-
   # Provide a few default substitutions that Google Cloud Build would fill in
   # if it was launching a triggered workflow. See link for details...
   # https://cloud.google.com/cloud-build/docs/configuring-builds/substitute-variable-values
-  substitutions_list = []
+  substitutions = collections.OrderedDict()
   if git_ref.startswith('refs/tags/'):
-    substitutions_list.append(
-        'TAG_NAME={}'.format(git_ref.replace('refs/tags/', '')))
+    substitutions['TAG_NAME'] = git_ref.replace('refs/tags/', '')
   elif git_ref.startswith('refs/heads/'):
-    substitutions_list.append(
-        'BRANCH_NAME={}'.format(git_ref.replace('refs/heads/', '')))
+    substitutions['BRANCH_NAME'] = git_ref.replace('refs/heads/', '')
+
+  # Add the substitutions from the target config.
+  for (k, v) in config.get('substitutions', {}).items():
+    substitutions['{!s}'.format(k)] = '{!s}'.format(v)
 
-  # Generate substitution strings from the target config.
-  if 'substitutions' in config:
-    substitutions_list += [
-        '{!s}={!s}'.format(k, v) for (k, v) in config['substitutions'].items()]
+  # Support an optional source archive passed to the workflow.
+  sources_path = None
+  if 'sources' in config:
+    sources_path = os.path.join(config_path, config['sources'])
+
+  if commands.cloud_build:
+    try:
+      build = await commands.cloud_build.submit_build(
+          os.path.join(config_path, config['config']), substitutions,
+          sources_path)
+    except (git_patrol_cloud_build.CloudBuildError, OSError) as e:
+      logger.warning('Cloud Build create build failed: %s', e)
+      return None
+    logger.info('Cloud Build started [ID=%s]', build.get('id'))
+    return json.dumps(build)
+
+  arg_config = '--config={}'.format(os.path.join(config_path, config['config']))
 
   # Populate the substitutions argument if needed.
   arg_substitutions = ''
-  if substitutions_list:
-    arg_substitutions = '--substitutions=' + ','.join(substitutions_list)
+  if substitutions:
+    arg_substitutions = '--substitutions=' + ','.join(
+        '{}={}'.format(k, v) for (k, v) in substitutions.items())
 
-  # Support an optional source archive passed to the workflow.
-  arg_sources = '--no-source'
-  if 'sources' in config:
-    arg_sources = os.path.join(config_path, config['sources'])
+  arg_sources = sources_path or '--no-source'
 
   gcloud_subproc = await commands.gcloud(
       'builds', 'submit', '--async', arg_config, arg_substitutions, arg_sources)
@@ -248,6 +679,22 @@ async def cloud_build_wait(commands, cloud_build_uuid):
   # text, so disabling output avoids blowing up the Python heap collecting
   # stdout.
   logger.info('Waiting for Cloud Build [ID=%s]', cloud_build_uuid)
+  if commands.build_watcher:
+    build = await commands.build_watcher.wait(str(cloud_build_uuid))
+    if not build:
+      return None
+    logger.info('Cloud Build finished [ID=%s]', cloud_build_uuid)
+    return json.dumps(build)
+
+  if commands.cloud_build:
+    try:
+      build = await commands.cloud_build.wait_build(str(cloud_build_uuid))
+    except git_patrol_cloud_build.CloudBuildError as e:
+      logger.warning('Cloud Build get build failed: %s', e)
+      return None
+    logger.info('Cloud Build finished [ID=%s]', cloud_build_uuid)
+    return json.dumps(build)
+
   gcb_log_subproc = await commands.gcloud(
       'builds', 'log', '--stream', '--no-user-output-enabled',
       str(cloud_build_uuid))
@@ -272,6 +719,577 @@ async def cloud_build_wait(commands, cloud_build_uuid):
   return stdout_bytes.decode('utf-8', 'ignore')
 
 
+async def cloud_build_cancel(commands, cloud_build_uuid):
+  """Cancel a queued or running Google Cloud Build workflow.
+
+  Args:
+    commands: GitPatrolCommands object used to execute external commands.
+    cloud_build_uuid: UUID of the Cloud Build workflow to cancel.
+  Returns:
+    True if the workflow was cancelled. False otherwise.
+  """
+  logger.info('Cancelling Cloud Build [ID=%s]', cloud_build_uuid)
+  if commands.cloud_build:
+    try:
+      await commands.cloud_build.cancel_build(str(cloud_build_uuid))
+    except git_patrol_cloud_build.CloudBuildError as e:
+      logger.warning('Cloud Build cancel build failed: %s', e)
+      return False
+    return True
+
+  gcb_cancel_subproc = await commands.gcloud(
+      'builds', 'cancel', str(cloud_build_uuid))
+  stdout_bytes, stderr_bytes = await gcb_cancel_subproc.communicate()
+  returncode = await gcb_cancel_subproc.wait()
+  if returncode:
+    log_command_error(
+        'gcloud builds cancel', returncode, stdout_bytes, stderr_bytes)
+    return False
+  return True
+
+
+class WorkflowTicket:
+  """Tracks the workflows triggered by one commit of a git ref.
+
+  Attributes:
+    alias: Alias of the target the git ref belongs to.
+    git_ref: The (ref name, commit hash) tuple that triggered the workflows.
+    superseded_by: Commit hash of a newer commit of the same git ref that
+      triggered the same workflows, or None.
+    build_ids: Set of the IDs of the Cloud Builds currently running for this
+      ticket. Independent workflows may run several at once.
+    cancelled_build_ids: Set of the IDs of the Cloud Builds cancelled because
+      the ticket was superseded.
+  """
+
+  def __init__(self, alias, git_ref):
+    self.alias = alias
+    self.git_ref = git_ref
+    self.superseded_by = None
+    self.build_ids = set()
+    self.cancelled_build_ids = set()
+
+
+class BuildSlot:
+  """Async context manager holding a set of build concurrency semaphores.
+
+  Semaphores are acquired in the given order and released in reverse order.
+  An empty slot never waits.
+  """
+
+  def __init__(self, semaphores=()):
+    self._semaphores = [sem for sem in semaphores if sem]
+    self._acquired = []
+
+  async def __aenter__(self):
+    git_patrol_metrics.BUILDS_WAITING.inc()
+    try:
+      for semaphore in self._semaphores:
+        await semaphore.acquire()
+        self._acquired.append(semaphore)
+    except BaseException:
+      self._release()
+      raise
+    finally:
+      git_patrol_metrics.BUILDS_WAITING.dec()
+    git_patrol_metrics.BUILDS_RUNNING.inc()
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    git_patrol_metrics.BUILDS_RUNNING.dec()
+    self._release()
+
+  def _release(self):
+    while self._acquired:
+      self._acquired.pop().release()
+
+
+class WorkflowDispatcher:
+  """Runs triggered workflows in the background with bounded concurrency.
+
+  Workflows are started as background tasks so target loops can keep polling
+  while builds drain. Each Cloud Build workflow holds a build slot while it
+  runs. Slots are limited globally, per target alias and per workflow. Waiting
+  workflows are served in first come, first served order.
+
+  The per-alias limit comes from the target's 'max_concurrent_builds' config
+  value, falling back to the dispatcher default. The per-workflow limit comes
+  from the workflow's 'max_concurrent_builds' config value.
+
+  When coalescing, a newer commit of a git ref supersedes the workflows still
+  queued or running for older commits of the same git ref. Superseded
+  workflows don't start any more builds and may have their running build
+  cancelled.
+  """
+
+  def __init__(
+      self, max_builds=None, max_builds_per_alias=None, coalesce=False,
+      cancel_superseded=False):
+    """Create a new workflow dispatcher.
+
+    Args:
+      max_builds: Maximum number of builds running at the same time. None for
+        no global limit.
+      max_builds_per_alias: Default maximum number of builds running at the
+        same time for a single target. None for no default limit.
+      coalesce: Skip the remaining builds of superseded workflows.
+      cancel_superseded: Also cancel the running build of superseded
+        workflows. Implies coalesce.
+    """
+    self.max_builds = max_builds
+    self.max_builds_per_alias = max_builds_per_alias
+    self.coalesce = coalesce or cancel_superseded
+    self.cancel_superseded = cancel_superseded
+    self._global_semaphore = (
+        asyncio.Semaphore(max_builds) if max_builds else None)
+    self._semaphores = {}
+    self._tickets = {}
+    self._tasks = set()
+
+  def _semaphore(self, key, limit):
+    if not limit:
+      return None
+    if key not in self._semaphores:
+      self._semaphores[key] = asyncio.Semaphore(limit)
+    return self._semaphores[key]
+
+  def build_slot(self, target_config, workflow):
+    """Returns a BuildSlot for running one build of a workflow.
+
+    Args:
+      target_config: Target configuration object.
+      workflow: Workflow configuration object from the target's workflows.
+    """
+    alias = target_config['alias']
+    workflow_key = workflow.get('alias', workflow['config'])
+    # Acquire the most specific limit first so builds waiting on their own
+    # workflow or target don't hold global slots.
+    return BuildSlot([
+        self._semaphore(
+            ('workflow', alias, workflow_key),
+            workflow.get('max_concurrent_builds')),
+        self._semaphore(
+            ('alias', alias),
+            target_config.get(
+                'max_concurrent_builds', self.max_builds_per_alias)),
+        self._global_semaphore])
+
+  def open_ticket(self, commands, alias, git_ref):
+    """Register the workflows triggered by a git ref.
+
+    Supersedes the ticket of any older commit of the same git ref.
+
+    Args:
+      commands: GitPatrolCommands object used to cancel superseded builds.
+      alias: Alias of the target the git ref belongs to.
+      git_ref: The (ref name, commit hash) tuple that triggered the workflows.
+    Returns:
+      A new WorkflowTicket when coalescing. Otherwise returns None.
+    """
+    if not self.coalesce:
+      return None
+    ticket = WorkflowTicket(alias, git_ref)
+    previous = self._tickets.get((alias, git_ref[0]))
+    self._tickets[(alias, git_ref[0])] = ticket
+    if previous:
+      logger.info(
+          '%s: %s %s superseded by %s', alias, git_ref[0],
+          previous.git_ref[1], git_ref[1])
+      previous.superseded_by = git_ref[1]
+      self._cancel_superseded_build(commands, previous)
+    return ticket
+
+  def close_ticket(self, ticket):
+    """Forget a ticket once its workflows are done."""
+    key = (ticket.alias, ticket.git_ref[0])
+    if self._tickets.get(key) is ticket:
+      del self._tickets[key]
+
+  def build_started(self, commands, ticket, build_id):
+    """Record the build running for a ticket.
+
+    Args:
+      commands: GitPatrolCommands object used to cancel superseded builds.
+      ticket: The WorkflowTicket the build belongs to.
+      build_id: ID of the started Cloud Build.
+    """
+    ticket.build_ids.add(build_id)
+    # The ticket may have been superseded while the build was starting.
+    self._cancel_superseded_build(commands, ticket)
+
+  def _cancel_superseded_build(self, commands, ticket):
+    if self.cancel_superseded and ticket.superseded_by:
+      for build_id in ticket.build_ids:
+        self._spawn(cloud_build_cancel(commands, build_id))
+      ticket.cancelled_build_ids.update(ticket.build_ids)
+      ticket.build_ids.clear()
+
+  def dispatch(self, workflow_coro):
+    """Run a workflow coroutine in the background.
+
+    Args:
+      workflow_coro: Coroutine object running the workflow.
+    Returns:
+      The asyncio.Task running the workflow.
+    """
+    task = self._spawn(workflow_coro)
+    logger.info('%d workflows in progress', len(self._tasks))
+    return task
+
+  def _spawn(self, coro):
+    task = asyncio.ensure_future(coro)
+    self._tasks.add(task)
+    task.add_done_callback(self._task_done)
+    return task
+
+  def _task_done(self, task):
+    self._tasks.discard(task)
+    if not task.cancelled() and task.exception():
+      logger.error('Workflow failed with exception: %r', task.exception())
+
+  async def join(self):
+    """Wait for all dispatched workflows to finish."""
+    while self._tasks:
+      await asyncio.gather(*self._tasks, return_exceptions=True)
+
+  async def shutdown(self, timeout):
+    """Let the dispatched workflows finish, then cancel the remaining ones.
+
+    Args:
+      timeout: Time in seconds to wait for the workflows to finish.
+    """
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while self._tasks and loop.time() < deadline:
+      await asyncio.wait(list(self._tasks), timeout=deadline - loop.time())
+    if self._tasks:
+      logger.warning('Cancelling %d unfinished workflows', len(self._tasks))
+    while self._tasks:
+      tasks = list(self._tasks)
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class CloudBuildWatcher:
+  """Waits for any number of Cloud Build workflows to finish.
+
+  Rather than following the logs of every in-flight build to find out when it
+  finishes, a single background task periodically lists the project's ongoing
+  builds. Watched builds missing from that list have finished and are
+  described once to collect their final state. Waiting for any number of
+  builds costs one list request per check.
+
+  The background task starts when the first build is watched and exits once
+  no builds are left.
+  """
+
+  def __init__(
+      self, commands, min_interval=BUILD_WATCH_MIN_INTERVAL_SECS,
+      max_interval=BUILD_WATCH_MAX_INTERVAL_SECS):
+    """Create a new build watcher.
+
+    Args:
+      commands: GitPatrolCommands object used to execute external commands.
+        Builds are checked through commands.cloud_build when set, otherwise
+        through the 'gcloud' command.
+      min_interval: Time in seconds between status checks while builds are
+        finishing.
+      max_interval: Upper bound in seconds on the time between status checks.
+    """
+    self._commands = commands
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self._waiters = {}
+    self._describe_failures = collections.Counter()
+    self._task = None
+
+  async def wait(self, build_id):
+    """Wait for a build to reach a terminal state.
+
+    Args:
+      build_id: ID of the build to wait for.
+    Returns:
+      The final Cloud Build workflow state as a dictionary if successful.
+      Otherwise returns None.
+    """
+    future = asyncio.get_event_loop().create_future()
+    self._waiters.setdefault(build_id, []).append(future)
+    if not self._task or self._task.done():
+      self._task = asyncio.ensure_future(self._run())
+    try:
+      return await future
+    finally:
+      # Stop watching builds nobody is waiting for anymore.
+      futures = self._waiters.get(build_id)
+      if futures and future in futures:
+        futures.remove(future)
+        if not futures:
+          del self._waiters[build_id]
+
+  async def _run(self):
+    interval = self.min_interval
+    try:
+      while self._waiters:
+        await asyncio.sleep(interval)
+        try:
+          finished = await self._check_builds()
+        except Exception:
+          # Keep watching: nothing else resolves the waiters.
+          logger.exception('Failed to check Cloud Build status')
+          finished = 0
+        if finished:
+          interval = self.min_interval
+        else:
+          interval = min(interval * 2, self.max_interval)
+    finally:
+      # Don't leave workflows waiting on a watcher that stopped.
+      waiters, self._waiters = self._waiters, {}
+      for futures in waiters.values():
+        for future in futures:
+          if not future.done():
+            future.set_result(None)
+
+  async def _check_builds(self):
+    """Resolve the waiters of finished builds.
+
+    Returns:
+      The number of builds that finished.
+    """
+    ongoing = await self._list_ongoing_builds()
+    if ongoing is None:
+      return 0
+
+    finished = 0
+    for build_id in [b for b in self._waiters if b not in ongoing]:
+      build = await self._describe_build(build_id)
+      if build is None:
+        self._describe_failures[build_id] += 1
+        if self._describe_failures[build_id] < BUILD_DESCRIBE_ATTEMPTS:
+          continue
+      elif build.get('status') not in git_patrol_cloud_build.TERMINAL_STATUSES:
+        # Recently started builds may not be listed yet.
+        continue
+
+      self._describe_failures.pop(build_id, None)
+      for future in self._waiters.pop(build_id, []):
+        if not future.done():
+          future.set_result(build)
+      finished += 1
+    return finished
+
+  async def _list_ongoing_builds(self):
+    """Returns the set of queued and running build IDs, or None on failure."""
+    if self._commands.cloud_build:
+      try:
+        return await self._commands.cloud_build.list_ongoing_builds()
+      except git_patrol_cloud_build.CloudBuildError as e:
+        logger.warning('Cloud Build list builds failed: %s', e)
+        return None
+
+    gcb_list_subproc = await self._commands.gcloud(
+        'builds', 'list', '--ongoing', '--format=value(id)')
+    stdout_bytes, stderr_bytes = await gcb_list_subproc.communicate()
+    returncode = await gcb_list_subproc.wait()
+    if returncode:
+      log_command_error(
+          'gcloud builds list', returncode, stdout_bytes, stderr_bytes)
+      return None
+    return set(stdout_bytes.decode('utf-8', 'ignore').split())
+
+  async def _describe_build(self, build_id):
+    """Returns the state of a build as a dictionary, or None on failure."""
+    if self._commands.cloud_build:
+      try:
+        return await self._commands.cloud_build.get_build(build_id)
+      except git_patrol_cloud_build.CloudBuildError as e:
+        logger.warning('Cloud Build get build failed: %s', e)
+        return None
+
+    gcb_describe_subproc = await self._commands.gcloud(
+        'builds', 'describe', '--format=json', build_id)
+    stdout_bytes, stderr_bytes = await gcb_describe_subproc.communicate()
+    returncode = await gcb_describe_subproc.wait()
+    if returncode:
+      log_command_error(
+          'gcloud builds describe', returncode, stdout_bytes, stderr_bytes)
+      return None
+    try:
+      return json.loads(stdout_bytes.decode('utf-8', 'ignore'))
+    except ValueError as e:
+      logger.warning('Failed to decode Cloud Build JSON: %s', e)
+      return None
+
+
+class TargetSchedule:
+  """Per-target poll interval, jitter and time windows.
+
+  Targets can set the following optional values next to their 'alias':
+    poll_interval: Time in seconds between polls of the target.
+    poll_jitter: Up to this many seconds are randomly added to each wait so
+      targets with the same interval drift apart.
+    poll_windows: List of 'HH:MM-HH:MM' UTC time ranges. Periodic polls only
+      start within one of them. Ranges may wrap around midnight.
+  """
+
+  def __init__(self, interval, jitter=0, windows=()):
+    """Create a new schedule.
+
+    Args:
+      interval: Time in seconds between polls.
+      jitter: Maximum random time in seconds added to each wait.
+      windows: List of (start, end) tuples of seconds since midnight UTC.
+    """
+    self.interval = interval
+    self.jitter = jitter
+    self.windows = list(windows)
+
+  @staticmethod
+  def _parse_window(window):
+    match = re.match(
+        r'^([01]\d|2[0-3]):([0-5]\d)-([01]\d|2[0-3]):([0-5]\d)$',
+        str(window))
+    if not match:
+      raise ValueError('invalid poll window {!r}, expected HH:MM-HH:MM'.format(
+          window))
+    hours, minutes, end_hours, end_minutes = map(int, match.groups())
+    start = hours * 3600 + minutes * 60
+    end = end_hours * 3600 + end_minutes * 60
+    if start == end:
+      raise ValueError('empty poll window {!r}'.format(window))
+    return start, end
+
+  @classmethod
+  def from_config(cls, target_config, default_interval):
+    """Read and validate the schedule of a target.
+
+    Args:
+      target_config: Target configuration object.
+      default_interval: Poll interval of targets that don't set their own.
+    Returns:
+      A new TargetSchedule.
+    Raises:
+      ValueError: The target's schedule settings are invalid.
+    """
+    alias = target_config.get('alias')
+    interval = target_config.get('poll_interval', default_interval)
+    jitter = target_config.get('poll_jitter', 0)
+    windows = target_config.get('poll_windows', [])
+    if (isinstance(interval, bool) or
+        not isinstance(interval, (int, float)) or interval <= 0):
+      raise ValueError('{}: poll_interval must be a positive number'.format(
+          alias))
+    if (isinstance(jitter, bool) or not isinstance(jitter, (int, float)) or
+        not 0 <= jitter < interval):
+      raise ValueError(
+          '{}: poll_jitter must be between zero and poll_interval'.format(
+              alias))
+    if not isinstance(windows, list):
+      raise ValueError('{}: poll_windows must be a list'.format(alias))
+    try:
+      windows = [cls._parse_window(window) for window in windows]
+    except ValueError as e:
+      raise ValueError('{}: {}'.format(alias, e))
+    return cls(interval, jitter, windows)
+
+  def _in_window(self, seconds):
+    return any(
+        start <= seconds < end if start < end else
+        seconds >= start or seconds < end
+        for (start, end) in self.windows)
+
+  def delay(self, sleep_time, utc_datetime):
+    """Adjust the time until the next periodic poll.
+
+    Args:
+      sleep_time: Time in seconds until the poll is due.
+      utc_datetime: Current time in UTC.
+    Returns:
+      The time in seconds to wait, including jitter and any wait for the next
+      poll window to open.
+    """
+    if self.jitter:
+      sleep_time += random.uniform(0, self.jitter)
+    if not self.windows:
+      return sleep_time
+    wakeup = utc_datetime + datetime.timedelta(seconds=sleep_time)
+    seconds = (wakeup - wakeup.replace(
+        hour=0, minute=0, second=0, microsecond=0)).total_seconds()
+    if self._in_window(seconds):
+      return sleep_time
+    return sleep_time + min(
+        (start - seconds) % 86400 for (start, _) in self.windows)
+
+
+class AdaptivePollInterval:
+  """Tunes the poll interval of a target to how often it changes.
+
+  Each poll that finds no changes multiplies the interval by a backoff factor,
+  so dormant repositories are polled less and less often. A poll that finds
+  new or updated git refs drops back to the minimum interval, since changes
+  tend to come in bursts.
+  """
+
+  def __init__(
+      self, min_interval, max_interval, interval=None,
+      backoff=ADAPTIVE_POLL_BACKOFF):
+    """Create a new adaptive poll interval.
+
+    Args:
+      min_interval: Shortest time in seconds between polls.
+      max_interval: Longest time in seconds between polls.
+      interval: Initial time in seconds between polls. Defaults to
+        min_interval.
+      backoff: Factor applied to the interval after a poll finds no changes.
+    """
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.backoff = backoff
+    self.interval = self._clamp(interval or min_interval)
+
+  @classmethod
+  def from_history(cls, min_interval, max_interval, change_times, now):
+    """Create an adaptive poll interval seeded from past changes.
+
+    Starts at half the median time between the recent changes of the target,
+    counting the time since the latest change as well, so the target is polled
+    about twice per expected change.
+
+    Args:
+      min_interval: Shortest time in seconds between polls.
+      max_interval: Longest time in seconds between polls.
+      change_times: List of datetimes of recent changes, most recent first.
+      now: Current datetime, in the same time zone as change_times.
+    Returns:
+      A new AdaptivePollInterval. Targets without any recorded change start at
+      max_interval.
+    """
+    if not change_times:
+      return cls(min_interval, max_interval, max_interval)
+    times = [now] + list(change_times)
+    gaps = sorted(
+        (newer - older).total_seconds()
+        for (newer, older) in zip(times, times[1:]))
+    return cls(min_interval, max_interval, gaps[len(gaps) // 2] / 2)
+
+  def _clamp(self, interval):
+    return min(self.max_interval, max(self.min_interval, interval))
+
+  def record(self, changed):
+    """Update the interval with the outcome of a poll.
+
+    Args:
+      changed: True if the poll found new or updated git refs.
+    Returns:
+      The time in seconds until the next poll.
+    """
+    if changed:
+      self.interval = self.min_interval
+    else:
+      self.interval = self._clamp(self.interval * self.backoff)
+    return self.interval
+
+
 def git_refs_find_deltas(previous_refs, current_refs):
   """Finds new or updated git refs.
 
@@ -280,20 +1298,15 @@ def git_refs_find_deltas(previous_refs, current_refs):
   from current_refs are ignored.
 
   Args:
-    previous_refs: Dictionary of git refs to compare against.
-    current_refs: Dictionary of git refs possibly containing new entries or
-      updates.
+    previous_refs: Dictionary or RefTable of git refs to compare against.
+    current_refs: Dictionary or RefTable of git refs possibly containing new
+      entries or updates.
 
   Returns:
     A dictionary of the new and updated git refs found in current_refs,
     otherwise an empty dictionary.
   """
-  new_refs = {}
-  for k, v in current_refs.items():
-    if k not in previous_refs:
-      new_refs[k] = v
-    elif previous_refs[k] != v:
-      new_refs[k] = v
+  new_refs, _ = git_patrol_refs.diff_refs(previous_refs, current_refs)
   return new_refs
 
 
@@ -324,14 +1337,20 @@ async def run_workflow_triggers(
     git refs in the remote repository. The third item contains a dictionary of
     git refs that should trigger a workflow execution.
     """
-  # Retrieve current refs from the remote repo.
-  current_refs = await fetch_git_refs(commands, url, ref_filters)
+  # Retrieve current refs from the remote repo. Unchanged refs come back as
+  # previous_refs itself, which needs no comparison.
+  current_refs = await fetch_git_refs(
+      commands, url, ref_filters, previous_refs)
   if not current_refs:
     return previous_uuid, previous_refs, {}
+  git_patrol_metrics.REFS.labels(alias).set(len(current_refs))
 
   # See if the repository was updated since the last check. Only record the
   # previous poll attempt's UUID if there was a change.
-  new_refs = git_refs_find_deltas(previous_refs, current_refs)
+  new_refs = {}
+  if current_refs is not previous_refs:
+    new_refs = git_refs_find_deltas(previous_refs, current_refs)
+  git_patrol_metrics.NEW_REFS.labels(alias).observe(len(new_refs))
   if new_refs:
     logger.info('%s: new refs: %s', alias, new_refs)
     previous_uuid_to_record = previous_uuid
@@ -350,74 +1369,359 @@ async def run_workflow_triggers(
   return current_uuid, current_refs, new_refs
 
 
-async def run_workflow_body(
-    commands, db, config_path, config, git_poll_uuid, git_ref):
-  """Runs the actual workflow logic.
+async def run_workflow_build(
+    commands, db, config_path, alias, workflow, git_poll_uuid, git_ref,
+    parent_id, build_started_fn=None, build_id=None):
+  """Runs a single Cloud Build workflow and journals its progress.
 
   Args:
     commands: GitPatrolCommands object used to execute external commands.
     db: A GitPatrolDb object used for database operations.
     config_path: Path to the Cloud Build configuration sources.
-    config: Target configuration object.
+    alias: Human friendly alias of the target configuration.
+    workflow: Workflow configuration object.
+    git_poll_uuid: UUID of the git poll that triggered this workflow.
     git_ref: The git ref dictionary item (ex: ('refs/heads/master', '<hash>'))
       that triggered this workflow execution.
+    parent_id: Journal ID of the previous workflow's last entry, or zero.
+    build_started_fn: Optional function called with the build ID once the
+      Cloud Build has started.
+    build_id: ID of a Cloud Build already started for this workflow, whose
+      start is journaled as parent_id. Waits for it rather than starting a
+      new build.
   Returns:
-    True when the workflow completes successfully. False otherwise.
+    A (bool, int) tuple. The first item is True when the workflow completed
+    successfully. The second item is the journal ID of the last entry recorded
+    for this workflow, or parent_id when nothing was recorded.
   """
-  alias = config['alias']
-
-  parent_id = 0
-  for workflow in config['workflows']:
+  start_time = time.perf_counter()
+  if not build_id:
     utc_datetime = datetime.datetime.utcnow()
     status_json = await cloud_build_start(
         commands, config_path, workflow, git_ref[0])
     if not status_json:
-      return False
+      return False, parent_id
 
     try:
       status = json.loads(status_json)
-    except JSONDecodeError as e:
+    except json.JSONDecodeError as e:
       logger.error('Failed to decode Cloud Build JSON: %s', e)
-      return False
+      return False, parent_id
 
     if not 'id' in status:
-      return False
+      return False, parent_id
     build_id = status['id']
 
     journal_id = await db.record_cloud_build(
-        parent_id, git_poll_uuid, utc_datetime, alias, git_ref, status)
+        parent_id, git_poll_uuid, utc_datetime, alias, git_ref, status,
+        workflow=workflow.get('alias'))
     if not journal_id:
-      return False
+      return False, parent_id
     parent_id = journal_id
+  if build_started_fn:
+    build_started_fn(build_id)
 
-    status_json = await cloud_build_wait(commands, build_id)
-    if not status_json:
-      return False
+  status_json = await cloud_build_wait(commands, build_id)
+  if not status_json:
+    return False, parent_id
 
-    utc_datetime = datetime.datetime.utcnow()
-    try:
-      status = json.loads(status_json)
-    except JSONDecodeError as e:
-      logger.error('Failed to decode Cloud Build JSON: %s', e)
-      return False
+  utc_datetime = datetime.datetime.utcnow()
+  try:
+    status = json.loads(status_json)
+  except json.JSONDecodeError as e:
+    logger.error('Failed to decode Cloud Build JSON: %s', e)
+    return False, parent_id
+  git_patrol_metrics.BUILD_SECONDS.labels(
+      alias, status.get('status', 'UNKNOWN')).observe(
+          time.perf_counter() - start_time)
 
-    journal_id = await db.record_cloud_build(
-        parent_id, git_poll_uuid, utc_datetime, alias, git_ref, status)
-    if not journal_id:
-      return False
-    parent_id = journal_id
+  journal_id = await db.record_cloud_build(
+      parent_id, git_poll_uuid, utc_datetime, alias, git_ref, status,
+      workflow=workflow.get('alias'))
+  if not journal_id:
+    return False, parent_id
+  parent_id = journal_id
 
-    if not 'status' in status:
-      return False
+  if not 'status' in status:
+    return False, parent_id
 
-    if status['status'] != 'SUCCESS':
-      return False
+  return status['status'] == 'SUCCESS', parent_id
 
-  return True
+
+def workflow_needs(config):
+  """Read and validate the dependencies between the workflows of a target.
+
+  Workflows run one after the other in the order they are listed, unless any
+  of them lists the aliases of the workflows it depends on in 'needs'. Then
+  each workflow starts as soon as all the workflows it needs succeeded, and
+  workflows without 'needs' start right away. A workflow can only need
+  workflows listed before it.
+
+  Args:
+    config: Target configuration object.
+  Returns:
+    A list with the indexes of the workflows each workflow needs.
+  Raises:
+    ValueError: The target's workflow dependencies are invalid.
+  """
+  alias = config.get('alias')
+  workflows = config.get('workflows') or []
+  if not any('needs' in workflow for workflow in workflows):
+    return [[index - 1] if index else [] for index in range(len(workflows))]
+
+  indexes = {}
+  all_needs = []
+  for (index, workflow) in enumerate(workflows):
+    needs = workflow.get('needs', [])
+    if isinstance(needs, str):
+      needs = [needs]
+    if not isinstance(needs, list):
+      raise ValueError('{}: needs must be a list of workflow aliases'.format(
+          alias))
+    for need in needs:
+      if need not in indexes:
+        raise ValueError(
+            '{}: workflow {} needs {}, which is not a workflow listed '
+            'before it'.format(alias, workflow.get('alias'), need))
+    all_needs.append([indexes[need] for need in needs])
+    if 'alias' in workflow:
+      indexes[workflow['alias']] = index
+  return all_needs
+
+
+def check_resumable(config):
+  """Check that the workflows of a target can be resumed after a restart.
+
+  Interrupted workflows are found by the workflow alias of their journal
+  entries, so each workflow needs an alias of its own.
+
+  Args:
+    config: Target configuration object.
+  Raises:
+    ValueError: A workflow of the target has no alias or a duplicate one.
+  """
+  aliases = set()
+  for workflow in config.get('workflows') or []:
+    workflow_alias = workflow.get('alias')
+    if not workflow_alias:
+      raise ValueError('{}: workflow {} needs an alias to be resumed'.format(
+          config.get('alias'), workflow.get('config')))
+    if workflow_alias in aliases:
+      raise ValueError('{}: workflow alias {} is used more than once'.format(
+          config.get('alias'), workflow_alias))
+    aliases.add(workflow_alias)
+
+
+def workflow_resume_point(config, entries):
+  """Find where to continue the interrupted workflows of a git ref.
+
+  Args:
+    config: Target configuration object.
+    entries: Dictionary mapping workflow aliases to a (int, dict) tuple with
+      the journal ID and the Cloud Build status JSON of the workflow's latest
+      journal entry for the git ref.
+  Returns:
+    A WorkflowResume, or None when nothing remains to be done.
+  """
+  aliases = [workflow.get('alias') for workflow in config['workflows']]
+  needs = workflow_needs(config)
+  finished = {}
+  parent_ids = {}
+  build_ids = {}
+  for (index, workflow_alias) in enumerate(aliases):
+    if workflow_alias not in entries:
+      continue
+    journal_id, status = entries[workflow_alias]
+    state = status.get('status')
+    if state == 'SUPERSEDED':
+      return None
+    if state == 'PENDING':
+      parent_ids[index] = journal_id
+    elif state in ('QUEUED', 'WORKING') and status.get('id'):
+      parent_ids[index] = journal_id
+      build_ids[index] = status['id']
+    else:
+      finished[index] = (state == 'SUCCESS', journal_id)
+
+  # Workflows without an entry run once the workflows they need succeed. Only
+  # removed or renamed workflows have no entry and need nothing.
+  remaining = False
+  for index in range(len(aliases)):
+    if index in finished:
+      continue
+    if index in parent_ids or (needs[index] and all(
+        finished.get(need, (True,))[0] for need in needs[index])):
+      remaining = True
+    else:
+      finished[index] = (False, None)
+  if not remaining:
+    return None
+  return WorkflowResume(finished, parent_ids, build_ids)
+
+
+async def run_workflow_body(
+    commands, db, config_path, config, git_poll_uuid, git_ref,
+    dispatcher=None, resume=None):
+  """Runs the actual workflow logic.
+
+  Each workflow starts once the workflows it needs succeeded, so independent
+  workflows run concurrently. When the database records workflows, journals a
+  PENDING entry for each workflow that needs no other before anything else, so
+  the workflows of the git ref can be resumed by resume_workflows() if the
+  service restarts before they all ran. The journal entries of a workflow
+  follow those of the first workflow it needs.
+
+  Args:
+    commands: GitPatrolCommands object used to execute external commands.
+    db: A GitPatrolDb object used for database operations.
+    config_path: Path to the Cloud Build configuration sources.
+    config: Target configuration object.
+    git_ref: The git ref dictionary item (ex: ('refs/heads/master', '<hash>'))
+      that triggered this workflow execution.
+    dispatcher: Optional WorkflowDispatcher bounding the number of concurrent
+      builds. Builds start immediately when not provided.
+    resume: Optional WorkflowResume continuing interrupted workflows instead
+      of starting new ones.
+  Returns:
+    True when all workflows complete successfully. False otherwise.
+  """
+  alias = config['alias']
+  workflows = config['workflows']
+  if not workflows:
+    return True
+  needs = workflow_needs(config)
+
+  ticket = None
+  if dispatcher:
+    ticket = dispatcher.open_ticket(commands, alias, git_ref)
+
+  async def run_workflow(index):
+    # Wait for the workflows this one needs. Those that already finished
+    # before a restart are not run again.
+    if index in finished:
+      return finished[index]
+    results = await asyncio.gather(*[tasks[need] for need in needs[index]])
+    if not all(success for (success, _) in results):
+      return False, None
+    workflow = workflows[index]
+    parent_id = parent_ids.get(index) or (results[0][1] if results else 0)
+
+    started = []
+    build_started_fn = None
+    if ticket:
+      def build_started_fn(build_id):
+        started.append(build_id)
+        dispatcher.build_started(commands, ticket, build_id)
+
+    slot = BuildSlot()
+    if dispatcher:
+      slot = dispatcher.build_slot(config, workflow)
+    success = False
+    skipped = True
+    async with slot:
+      try:
+        if not (ticket and ticket.superseded_by):
+          skipped = False
+          success, parent_id = await run_workflow_build(
+              commands, db, config_path, alias, workflow, git_poll_uuid,
+              git_ref, parent_id, build_started_fn, build_ids.get(index))
+      finally:
+        if ticket:
+          ticket.build_ids.difference_update(started)
+
+    # A newer commit of this git ref runs the workflows skipped or cancelled
+    # for it. Builds that failed on their own keep their failure as the last
+    # entry.
+    if not success and ticket and ticket.superseded_by and (
+        skipped or ticket.cancelled_build_ids.intersection(started)):
+      await db.record_cloud_build(
+          parent_id, git_poll_uuid, datetime.datetime.utcnow(), alias,
+          git_ref, {'status': 'SUPERSEDED',
+                    'supersededBy': ticket.superseded_by},
+          workflow=workflow.get('alias'))
+    return success, parent_id
+
+  tasks = {}
+  try:
+    finished, parent_ids, build_ids = resume or ({}, {}, {})
+    if not resume and db.record_workflows:
+      for (index, workflow) in enumerate(workflows):
+        if needs[index]:
+          continue
+        parent_ids[index] = await db.record_cloud_build(
+            0, git_poll_uuid, datetime.datetime.utcnow(), alias, git_ref,
+            {'status': 'PENDING'}, workflow=workflow.get('alias'))
+        if not parent_ids[index]:
+          return False
+
+    # Needs only refer to earlier workflows, so every task a workflow waits
+    # for exists by the time it runs.
+    for index in range(len(workflows)):
+      tasks[index] = asyncio.ensure_future(run_workflow(index))
+    results = await asyncio.gather(*tasks.values())
+    return all(success for (success, _) in results)
+  finally:
+    for task in tasks.values():
+      task.cancel()
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+    if ticket:
+      dispatcher.close_ticket(ticket)
+
+
+async def resume_workflows(
+    commands, db, config_path, targets, since, dispatcher=None):
+  """Resume the workflows interrupted by a restart of the service.
+
+  Waits again for the builds that were still running and runs the workflows
+  that didn't start yet, continuing the journal entries of each workflow.
+
+  Args:
+    commands: GitPatrolCommands object used to execute external commands.
+    db: A GitPatrolDb object used for database operations.
+    config_path: Path to the Cloud Build configuration sources.
+    targets: List of target configuration objects.
+    since: Only resume workflows updated after this time in UTC time zone.
+    dispatcher: Optional WorkflowDispatcher to run the resumed workflows in
+      the background. Otherwise waits for all of them.
+  Returns:
+    The number of git refs whose workflows were resumed.
+  """
+  configs = {config['alias']: config for config in targets}
+  rows = await db.fetch_unfinished_workflows(list(configs), since)
+  # Gather the latest entry of every workflow of each git ref.
+  git_refs = collections.OrderedDict()
+  for row in rows:
+    key = (row['alias'], row['git_poll_uuid'], tuple(row['ref']))
+    git_refs.setdefault(key, {})[row['workflow']] = (
+        row['journal_id'], row['cloud_build_status'])
+
+  workflow_tasks = []
+  for ((alias, git_poll_uuid, git_ref), entries) in git_refs.items():
+    config = configs[alias]
+    resume = workflow_resume_point(config, entries)
+    if not resume:
+      continue
+    logger.info(
+        '%s: resuming workflows %s of %s', alias,
+        [config['workflows'][index].get('alias')
+         for index in range(len(config['workflows']))
+         if index not in resume.finished], git_ref)
+    workflow_tasks.append(run_workflow_body(
+        commands, db, config_path, config, git_poll_uuid, git_ref,
+        dispatcher=dispatcher, resume=resume))
+
+  if dispatcher:
+    for workflow_task in workflow_tasks:
+      dispatcher.dispatch(workflow_task)
+  else:
+    await asyncio.gather(*workflow_tasks)
+  return len(workflow_tasks)
 
 
 async def target_loop(
-    commands, loop, db, config_path, target_config, offset, interval):
+    commands, loop, db, config_path, target_config, offset, interval,
+    scheduler=None, dispatcher=None, initial_state=None, trigger=None,
+    adaptive_interval=None, schedule=None, trigger_interval=0):
   """Main loop to manage periodic workflow execution.
 
   Args:
@@ -428,8 +1732,28 @@ async def target_loop(
     target_config: Git Patrol config target information.
     offset: Starting offset time in seconds.
     interval: Time in seconds to wait between poll attempts.
+    scheduler: Optional PollScheduler shared by all target loops to bound the
+      number of concurrent polls. Polls run immediately when not provided.
+    dispatcher: Optional WorkflowDispatcher shared by all target loops. When
+      provided, triggered workflows run in the background so the next poll
+      doesn't wait for them, and their builds are subject to the dispatcher's
+      concurrency limits.
+    initial_state: Optional (UUID, dict) tuple with the target's latest poll
+      UUID and git refs, as preloaded by
+      GitPatrolDb.fetch_latest_refs_by_aliases(). Fetched from the database
+      when not provided.
+    trigger: Optional asyncio.Event set when the repository is known to have
+      changed (ex: by a webhook). Setting it triggers a poll right away, and
+      the next periodic poll is then due a full interval later.
+    adaptive_interval: Optional AdaptivePollInterval replacing the fixed
+      interval after the first poll.
+    schedule: Optional TargetSchedule adding jitter and time windows to the
+      periodic polls.
+    trigger_interval: Minimum time in seconds between two triggered polls.
+      Triggers set sooner are held back until then.
   Returns:
-    Nothing. Loops forever.
+    Nothing. Loops until cancelled. When cancelled during a poll that already
+    started, the poll completes and its workflows are launched first.
   """
   alias = target_config['alias']
   url = target_config['url']
@@ -447,13 +1771,32 @@ async def target_loop(
     logger.error('%s: error in ref filter', alias)
     return
 
-  # Fetch latest git tags from the database.
-  current_uuid, current_refs = await db.fetch_latest_refs_by_alias(alias)
+  # Fetch latest git tags from the database unless they were preloaded.
+  if initial_state:
+    current_uuid, current_refs = initial_state
+  else:
+    current_uuid, current_refs = await db.fetch_latest_refs_by_alias(alias)
+  current_refs = git_patrol_refs.RefTable(current_refs)
   logger.info('%s: current refs %s', alias, current_refs)
 
+  async def poll(previous_uuid, previous_refs, planned_time, started):
+    started.set()
+    # Get the current time for this round.
+    utc_datetime = datetime.datetime.utcnow()
+    git_patrol_metrics.POLL_LAG_SECONDS.labels(alias).observe(
+        max(0, loop.time() - planned_time))
+
+    # Evaluate workflow triggers to see if the workflow needs to run again.
+    with git_patrol_metrics.timer(
+        git_patrol_metrics.POLL_SECONDS.labels(alias)):
+      return await run_workflow_triggers(
+          commands, db, alias, url, ref_filters, utc_datetime, previous_uuid,
+          previous_refs)
+
   # Stagger the wakeup time of the target loops to avoid hammering the remote
   # server with requests all at once.
   next_wakeup_time = loop.time() + offset + 1
+  next_trigger_time = loop.time()
 
   while True:
     # Calculate the polling loop's next wake-up time. To stay on schedule we
@@ -462,20 +1805,64 @@ async def target_loop(
     while next_wakeup_time < loop.time():
       next_wakeup_time += interval
     sleep_time = max(0, next_wakeup_time - loop.time())
+    if schedule:
+      sleep_time = schedule.delay(sleep_time, datetime.datetime.utcnow())
     logger.info('%s: sleeping for %f', alias, sleep_time)
-    await asyncio.sleep(sleep_time)
-
-    # Get the current time for this round.
-    utc_datetime = datetime.datetime.utcnow()
-
-    # Evaluate workflow triggers to see if the workflow needs to run again.
-    current_uuid, current_refs, new_refs = await run_workflow_triggers(
-        commands, db, alias, url, ref_filters, utc_datetime, current_uuid,
-        current_refs)
+    planned_time = loop.time() + sleep_time
+    if trigger:
+      # Don't let a flood of triggers poll the repository more often than
+      # trigger_interval.
+      hold_time = min(sleep_time, max(0, next_trigger_time - loop.time()))
+      await asyncio.sleep(hold_time)
+      try:
+        await asyncio.wait_for(trigger.wait(), sleep_time - hold_time)
+        # Fold the periodic poll into this one.
+        logger.info('%s: poll triggered', alias)
+        planned_time = loop.time()
+        next_wakeup_time = loop.time() + interval
+        next_trigger_time = loop.time() + trigger_interval
+      except asyncio.TimeoutError:
+        pass
+      trigger.clear()
+    else:
+      await asyncio.sleep(sleep_time)
+
+    started = asyncio.Event()
+    poll_fn = functools.partial(
+        poll, current_uuid, current_refs, planned_time, started)
+    if scheduler:
+      # Triggered polls are due now rather than at the next periodic poll.
+      poll_task = asyncio.ensure_future(
+          scheduler.submit(planned_time, url, poll_fn))
+    else:
+      poll_task = asyncio.ensure_future(poll_fn())
+    stopping = False
+    try:
+      current_uuid, current_refs, new_refs = await asyncio.shield(poll_task)
+    except asyncio.CancelledError:
+      if not started.is_set():
+        poll_task.cancel()
+        raise
+      # A started poll may already have journaled its new refs. Finish it and
+      # launch its workflows before stopping, or they would never run.
+      logger.info('%s: stopping after the current poll', alias)
+      stopping = True
+      current_uuid, current_refs, new_refs = await poll_task
+    if adaptive_interval:
+      interval = adaptive_interval.record(bool(new_refs))
+      logger.info('%s: next poll in %f', alias, interval)
 
     # Launch a workflow for each new/updated git ref.
     workflow_tasks = [
         run_workflow_body(
-            commands, db, config_path, target_config, current_uuid, ref)
+            commands, db, config_path, target_config, current_uuid, ref,
+            dispatcher=dispatcher)
         for ref in new_refs.items()]
-    await asyncio.gather(*workflow_tasks)
+    if dispatcher:
+      # Keep polling while the builds drain in the background.
+      for workflow_task in workflow_tasks:
+        dispatcher.dispatch(workflow_task)
+    else:
+      await asyncio.gather(*workflow_tasks)
+    if stopping:
+      raise asyncio.CancelledError()
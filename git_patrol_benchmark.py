@@ -0,0 +1,625 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for the Git Patrol service.
+
+Each benchmark is a subcommand. Run with --help for the list.
+Example:
+  $ python3 git_patrol_benchmark.py refs_memory --refs=500000
+  $ python3 git_patrol_benchmark.py pipeline --targets=1000 --refs=5000
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import gc
+import hashlib
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import time
+import tracemalloc
+import uuid
+
+import git_patrol
+import git_patrol_db
+import git_patrol_metrics
+import git_patrol_refs
+import git_patrol_test
+
+# Database benchmarks need a PostgreSQL server and the asyncpg client library.
+try:
+  import asyncpg
+except ImportError:
+  asyncpg = None
+
+
+SCRIPTS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'scripts')
+
+# Number of journal rows sent per COPY when loading synthetic data.
+LOAD_BATCH_ROWS = 100000
+
+# Journal tables counted by the pipeline benchmark.
+JOURNAL_TABLES = ('git_poll_journal', 'cloud_build_journal')
+
+
+def synthetic_refs(count, seed=0):
+  """Generate Gerrit style git refs with pseudo-random commit hashes.
+
+  Args:
+    count: Number of git refs to generate.
+    seed: Varies the generated commit hashes.
+  Returns:
+    A dictionary of git ref names and hex commit hashes.
+  """
+  refs = {}
+  for i in range(count):
+    refname = 'refs/changes/{:02d}/{}/{}'.format(i % 100, i // 4, i % 4 + 1)
+    refs[refname] = hashlib.sha1('{}:{}'.format(seed, i).encode()).hexdigest()
+  return refs
+
+
+def measure_allocation(fn):
+  """Measure the memory still allocated by the object returned from fn.
+
+  Args:
+    fn: Function creating the object to measure.
+  Returns:
+    A (object, int) tuple with the created object and its size in bytes.
+  """
+  gc.collect()
+  tracemalloc.start()
+  try:
+    result = fn()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return result, size
+
+
+def benchmark_refs_memory(args):
+  """Compare the memory used by dictionaries and RefTables of git refs."""
+  # Simulate parsing the refs out of the 'git ls-remote' output so neither
+  # representation shares strings with the generated source data.
+  raw_refs = ''.join(
+      '{}\t{}\n'.format(commit, refname)
+      for (refname, commit) in synthetic_refs(args.refs).items()).encode()
+
+  def parse_dict():
+    refs = {}
+    for line in raw_refs.splitlines():
+      commit, refname = line.decode().split('\t')
+      refs[refname] = commit
+    return refs
+
+  def parse_table():
+    return git_patrol_refs.RefTable(parse_dict())
+
+  refs_dict, dict_bytes = measure_allocation(parse_dict)
+  refs_table, table_bytes = measure_allocation(parse_table)
+  del refs_dict
+
+  print('refs: {}'.format(args.refs))
+  print('dict bytes/ref: {:.1f}'.format(dict_bytes / args.refs))
+  print('RefTable bytes/ref: {:.1f}'.format(table_bytes / args.refs))
+
+  # Diff against a table where every hundredth ref was updated.
+  updated_refs = dict(refs_table.items())
+  updated_refs.update(
+      (refname, '0' * 40)
+      for (i, refname) in enumerate(updated_refs) if not i % 100)
+  updated_table = git_patrol_refs.RefTable(updated_refs)
+  start = time.perf_counter()
+  changed, _ = updated_table.diff(refs_table)
+  print('RefTable diff: {:.3f}s ({} changed)'.format(
+      time.perf_counter() - start, len(changed)))
+
+
+async def _time_startup_lookups(db, aliases):
+  """Returns the latency in seconds of looking up each alias' latest refs."""
+  latencies = []
+  for alias in aliases:
+    start = time.perf_counter()
+    await db.fetch_latest_refs_by_alias(alias)
+    latencies.append(time.perf_counter() - start)
+  return latencies
+
+
+def _print_latencies(label, latencies):
+  latencies = sorted(latencies)
+  print('{}: median {:.2f}ms, p95 {:.2f}ms, total {:.2f}s'.format(
+      label, statistics.median(latencies) * 1000,
+      latencies[int(len(latencies) * 0.95)] * 1000, sum(latencies)))
+
+
+async def _benchmark_db_startup(args):
+  conn = await asyncpg.connect(args.dsn)
+  await conn.execute(
+      'DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0};'.format(
+          args.schema))
+  await conn.close()
+  pool = await asyncpg.create_pool(
+      args.dsn, server_settings={'search_path': args.schema})
+
+  # Start from the original schema without any journal indexes.
+  aliases = ['target{:04d}'.format(i) for i in range(args.aliases)]
+  async with pool.acquire() as conn:
+    with open(os.path.join(SCRIPTS_PATH, 'git_patrol_db.sql')) as f:
+      await conn.execute(f.read())
+    await conn.execute(
+        '''DROP INDEX git_poll_journal_alias_time_idx;
+        DROP INDEX cloud_build_journal_alias_time_idx;
+        ''')
+
+    # Every alias is polled at the same interval, interleaved over time.
+    start = datetime.datetime(2018, 1, 1)
+    refs = [[refname, commit] for (refname, commit) in
+            synthetic_refs(args.refs_per_row).items()]
+    load_start = time.perf_counter()
+    for batch_start in range(0, args.rows, LOAD_BATCH_ROWS):
+      batch = range(batch_start, min(batch_start + LOAD_BATCH_ROWS, args.rows))
+      await conn.copy_records_to_table(
+          'git_poll_journal',
+          columns=['git_poll_uuid', 'update_time', 'url', 'alias', 'refs',
+                   'ref_filters'],
+          records=[
+              (uuid.uuid4(), start + datetime.timedelta(minutes=i),
+               'https://host/{}.git'.format(aliases[i % len(aliases)]),
+               aliases[i % len(aliases)], refs, [])
+              for i in batch])
+    await conn.execute('ANALYZE git_poll_journal;')
+  print('rows: {} ({} aliases) loaded in {:.1f}s'.format(
+      args.rows, args.aliases, time.perf_counter() - load_start))
+
+  db = git_patrol_db.GitPatrolDb(pool)
+  _print_latencies(
+      'startup lookup without indexes',
+      await _time_startup_lookups(db, aliases))
+
+  migrate_start = time.perf_counter()
+  applied = await db.migrate(os.path.join(SCRIPTS_PATH, 'migrations'))
+  async with pool.acquire() as conn:
+    await conn.execute('ANALYZE git_poll_journal;')
+  print('migrations {} applied in {:.1f}s'.format(
+      applied, time.perf_counter() - migrate_start))
+  _print_latencies(
+      'startup lookup after migrations',
+      await _time_startup_lookups(db, aliases))
+
+  await pool.close()
+  if not args.keep:
+    conn = await asyncpg.connect(args.dsn)
+    await conn.execute('DROP SCHEMA {} CASCADE;'.format(args.schema))
+    await conn.close()
+
+
+def benchmark_db_startup(args):
+  """Measure the startup lookups of latest refs before and after migrations."""
+  if not asyncpg:
+    raise SystemExit('The db_startup benchmark requires asyncpg')
+  asyncio.get_event_loop().run_until_complete(_benchmark_db_startup(args))
+
+
+class _Samples:
+  """Stands in for a histogram metric, keeping every observed value."""
+
+  def __init__(self):
+    self.values = []
+
+  def labels(self, *args, **kwargs):
+    return self
+
+  def observe(self, value):
+    self.values.append(value)
+
+
+class _NullConnection:
+  """Accepts the statements of GitPatrolDb without a database server.
+
+  Counts the rows written, so the pipeline benchmark can measure the overhead
+  of GitPatrolDb itself when no PostgreSQL server is at hand.
+  """
+
+  def __init__(self):
+    self.rows = 0
+    self._journal_ids = itertools.count(1)
+
+  def acquire(self):
+    return self
+
+  def transaction(self):
+    return self
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    pass
+
+  async def execute(self, query, *args):
+    self.rows += 1
+    return 'INSERT 0 1'
+
+  async def fetchval(self, query, *args):
+    self.rows += 1
+    return next(self._journal_ids)
+
+  async def fetch(self, query, *args):
+    # Only the reservation of Cloud Build journal IDs reads rows.
+    return [{'id': next(self._journal_ids)} for _ in range(args[0])]
+
+  async def copy_records_to_table(self, table, records, columns):
+    self.rows += len(records)
+
+  async def executemany(self, query, args):
+    self.rows += len(args)
+
+  async def close(self):
+    pass
+
+
+class _SyntheticRepository:
+  """Remote repository whose git refs change at a random rate.
+
+  Each listing of the refs first updates changed_refs random refs with the
+  probability change_rate.
+  """
+
+  def __init__(self, refs, change_rate, changed_refs, rng):
+    self.refs = refs
+    self.change_rate = change_rate
+    self.changed_refs = changed_refs
+    self._refnames = list(refs)
+    self._rng = rng
+    self._ls_remote_stdout = self._format()
+
+  def _format(self):
+    return ''.join(
+        '{}\t{}\n'.format(commit, refname)
+        for (refname, commit) in self.refs.items()).encode()
+
+  def ls_remote(self):
+    if self._rng.random() < self.change_rate:
+      for refname in self._rng.sample(
+          self._refnames, min(self.changed_refs, len(self._refnames))):
+        self.refs[refname] = '{:040x}'.format(self._rng.getrandbits(160))
+      self._ls_remote_stdout = self._format()
+    return self._ls_remote_stdout
+
+
+def _fake_pipeline_commands(
+    repositories, build_seconds, counts, watch_intervals=None):
+  """Fake 'git' and 'gcloud' commands serving the synthetic repositories.
+
+  Args:
+    repositories: Dictionary of URLs and _SyntheticRepository objects.
+    build_seconds: Time each Cloud Build takes.
+    counts: collections.Counter of the commands run, by command name.
+    watch_intervals: Optional (min, max) tuple of the time in seconds between
+      build status checks of a CloudBuildWatcher shared by all builds, like
+      the service uses. Each build waits on its own 'gcloud builds log'
+      command when not provided.
+  Returns:
+    A GitPatrolCommands object.
+  """
+  loop = asyncio.get_event_loop()
+  # Time each submitted build finishes at, by build ID.
+  finish_times = {}
+
+  def git_stdout(*args, count):
+    return repositories[args[-1]].ls_remote()
+
+  def gcloud_stdout(*args, count):
+    if args[1] == 'submit':
+      build_id = str(uuid.uuid4())
+      finish_times[build_id] = loop.time() + build_seconds
+      return '{} 2018-11-01T20:49:31+00:00 - - - QUEUED\n'.format(
+          build_id).encode()
+    if args[1] == 'list':
+      now = loop.time()
+      return ''.join(
+          build_id + '\n' for (build_id, finish_time) in finish_times.items()
+          if finish_time > now).encode()
+    if args[1] == 'describe':
+      status = 'SUCCESS'
+      if finish_times.get(args[-1], 0) > loop.time():
+        status = 'WORKING'
+      else:
+        finish_times.pop(args[-1], None)
+      return json.dumps({'id': args[-1], 'status': status}).encode()
+    return b''
+
+  fake_git = git_patrol_test._MakeFakeCommand(stdout_fn=git_stdout)
+  fake_gcloud = git_patrol_test._MakeFakeCommand(stdout_fn=gcloud_stdout)
+
+  async def git(*args):
+    counts['git'] += 1
+    return await fake_git(*args)
+
+  async def gcloud(*args):
+    counts['gcloud'] += 1
+    if args[1] == 'log':
+      # 'gcloud builds log --stream' returns once the build is done.
+      await asyncio.sleep(build_seconds)
+    return await fake_gcloud(*args)
+
+  commands = git_patrol.GitPatrolCommands()
+  commands.git = git
+  commands.git_protocol_v2 = True
+  commands.gcloud = gcloud
+  if watch_intervals:
+    commands.build_watcher = git_patrol.CloudBuildWatcher(
+        commands, min_interval=watch_intervals[0],
+        max_interval=watch_intervals[1])
+  return commands
+
+
+async def _count_written_rows(pool):
+  """Returns the number of journal rows and heartbeats in the database."""
+  async with pool.acquire() as conn:
+    rows = 0
+    for table in JOURNAL_TABLES:
+      rows += await conn.fetchval('SELECT count(*) FROM {};'.format(table))
+    rows += await conn.fetchval(
+        'SELECT coalesce(sum(polls), 0) FROM git_poll_heartbeat;')
+  return rows
+
+
+async def _benchmark_pipeline(args):
+  loop = asyncio.get_event_loop()
+  rng = random.Random(args.seed)
+
+  if args.dsn:
+    conn = await asyncpg.connect(args.dsn)
+    await conn.execute(
+        'DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0};'.format(
+            args.schema))
+    await conn.close()
+    pool = await asyncpg.create_pool(
+        args.dsn, server_settings={'search_path': args.schema})
+    async with pool.acquire() as conn:
+      with open(os.path.join(SCRIPTS_PATH, 'git_patrol_db.sql')) as f:
+        await conn.execute(f.read())
+  else:
+    pool = _NullConnection()
+  db = git_patrol_db.GitPatrolDb(
+      pool, checkpoint_interval=args.db_checkpoint_interval,
+      write_behind=args.db_write_behind,
+      heartbeat_unchanged=args.db_heartbeat_unchanged_polls)
+  if args.dsn:
+    await db.migrate(os.path.join(SCRIPTS_PATH, 'migrations'))
+
+  targets = []
+  repositories = {}
+  for i in range(args.targets):
+    url = 'https://git{}.example.com/target{:04d}.git'.format(
+        i % args.hosts, i)
+    repositories[url] = _SyntheticRepository(
+        synthetic_refs(args.refs, seed=i), args.change_rate,
+        args.changed_refs, rng)
+    targets.append({
+        'alias': 'target{:04d}'.format(i),
+        'url': url,
+        'workflows': [
+            {'alias': 'workflow{}'.format(w), 'config': 'cloudbuild.yaml'}
+            for w in range(args.workflows)],
+    })
+  counts = collections.Counter()
+  commands = _fake_pipeline_commands(
+      repositories, args.build_seconds, counts,
+      watch_intervals=(
+          None if args.no_build_watcher else
+          (args.build_watch_min_interval, args.build_watch_max_interval)))
+
+  scheduler = git_patrol.PollScheduler(
+      args.max_concurrent_polls, args.max_concurrent_polls_per_host or None)
+  dispatcher = git_patrol.WorkflowDispatcher(
+      max_builds=args.max_concurrent_builds or None)
+  rows_before = pool.rows if not args.dsn else 0
+
+  # Collect the poll and build metrics recorded by the pipeline itself.
+  samples = {name: _Samples() for name in (
+      'POLL_LAG_SECONDS', 'POLL_SECONDS', 'BUILD_SECONDS')}
+  saved_metrics = {
+      name: getattr(git_patrol_metrics, name) for name in samples}
+  for (name, metric) in samples.items():
+    setattr(git_patrol_metrics, name, metric)
+  try:
+    start = time.perf_counter()
+    # Every target starts from the refs it had before the benchmark.
+    target_loops = [
+        asyncio.ensure_future(git_patrol.target_loop(
+            commands, loop, db, SCRIPTS_PATH, target_config,
+            offset=i * args.poll_interval / len(targets),
+            interval=args.poll_interval, scheduler=scheduler,
+            dispatcher=dispatcher,
+            initial_state=(None, dict(
+                repositories[target_config['url']].refs))))
+        for (i, target_config) in enumerate(targets)]
+    target_loops.append(asyncio.ensure_future(scheduler.run()))
+    await asyncio.wait(target_loops, timeout=args.duration)
+    for target_loop in target_loops:
+      target_loop.cancel()
+    await asyncio.gather(*target_loops, return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    builds_in_progress = len(dispatcher._tasks)
+    for task in list(dispatcher._tasks):
+      task.cancel()
+    await dispatcher.join()
+    await db.close()
+  finally:
+    for (name, metric) in saved_metrics.items():
+      setattr(git_patrol_metrics, name, metric)
+
+  if args.dsn:
+    rows = await _count_written_rows(pool)
+  else:
+    rows = pool.rows - rows_before
+  await pool.close()
+  if args.dsn and not args.keep:
+    conn = await asyncpg.connect(args.dsn)
+    await conn.execute('DROP SCHEMA {} CASCADE;'.format(args.schema))
+    await conn.close()
+
+  polls = len(samples['POLL_SECONDS'].values)
+  builds = len(samples['BUILD_SECONDS'].values)
+  print('targets: {}, refs/target: {}, workflows/target: {}, '
+        'change rate: {}'.format(
+            args.targets, args.refs, args.workflows, args.change_rate))
+  print('polls: {} ({:.1f}/s)'.format(polls, polls / elapsed))
+  print('builds: {} ({:.1f}/s), {} workflows still in progress'.format(
+      builds, builds / elapsed, builds_in_progress))
+  for (label, name) in [('poll lag', 'POLL_LAG_SECONDS'),
+                        ('poll duration', 'POLL_SECONDS'),
+                        ('build duration', 'BUILD_SECONDS')]:
+    if samples[name].values:
+      _print_latencies(label, samples[name].values)
+  print('subprocesses: {} git, {} gcloud ({:.1f}/s)'.format(
+      counts['git'], counts['gcloud'], sum(counts.values()) / elapsed))
+  print('db rows: {} ({:.1f}/s)'.format(rows, rows / elapsed))
+  # ru_maxrss is in kilobytes on Linux.
+  print('peak RSS: {:.1f}MB'.format(
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def benchmark_pipeline(args):
+  """Simulate polls, triggers and builds of many targets against fakes."""
+  if args.dsn and not asyncpg:
+    raise SystemExit('The pipeline benchmark requires asyncpg with --dsn')
+  # Per poll and per build logging would dominate the measurements.
+  logging.disable(logging.INFO)
+  asyncio.get_event_loop().run_until_complete(_benchmark_pipeline(args))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers(dest='benchmark')
+  subparsers.required = True
+
+  refs_memory = subparsers.add_parser(
+      'refs_memory', help='Memory used per git ref held by target loops.')
+  refs_memory.add_argument(
+      '--refs', type=int, default=100000, help='Number of git refs.')
+  refs_memory.set_defaults(fn=benchmark_refs_memory)
+
+  db_startup = subparsers.add_parser(
+      'db_startup',
+      help=('Startup lookup latency against a large journal in a local '
+            'PostgreSQL database, before and after schema migrations.'))
+  db_startup.add_argument(
+      '--dsn', default='postgresql://postgres@localhost/postgres',
+      help='Connection string of a scratch PostgreSQL database.')
+  db_startup.add_argument(
+      '--schema', default='git_patrol_benchmark',
+      help='Schema created (and dropped) to hold the benchmark tables.')
+  db_startup.add_argument(
+      '--rows', type=int, default=2000000,
+      help='Number of git poll journal rows to load.')
+  db_startup.add_argument(
+      '--aliases', type=int, default=200, help='Number of target aliases.')
+  db_startup.add_argument(
+      '--refs_per_row', type=int, default=8,
+      help='Number of git refs recorded in each journal row.')
+  db_startup.add_argument(
+      '--keep', action='store_true',
+      help='Keep the benchmark schema for inspection.')
+  db_startup.set_defaults(fn=benchmark_db_startup)
+
+  pipeline = subparsers.add_parser(
+      'pipeline',
+      help=('Throughput, scheduler lag and resource usage of the complete '
+            'poll, trigger and build pipeline with fake git and gcloud '
+            'commands.'))
+  pipeline.add_argument(
+      '--targets', type=int, default=100, help='Number of targets.')
+  pipeline.add_argument(
+      '--refs', type=int, default=1000, help='Number of git refs per target.')
+  pipeline.add_argument(
+      '--workflows', type=int, default=1,
+      help='Number of workflows run for each new or updated git ref.')
+  pipeline.add_argument(
+      '--hosts', type=int, default=4,
+      help='Number of hosts the targets are spread over.')
+  pipeline.add_argument(
+      '--change_rate', type=float, default=0.1,
+      help='Probability that a repository changed between two polls.')
+  pipeline.add_argument(
+      '--changed_refs', type=int, default=1,
+      help='Number of git refs updated by each change.')
+  pipeline.add_argument(
+      '--poll_interval', type=float, default=10,
+      help='Time in seconds between two polls of a target.')
+  pipeline.add_argument(
+      '--build_seconds', type=float, default=1,
+      help='Time in seconds each Cloud Build takes.')
+  pipeline.add_argument(
+      '--build_watch_min_interval', type=float,
+      default=git_patrol.BUILD_WATCH_MIN_INTERVAL_SECS,
+      help='Minimum time between build status checks in seconds.')
+  pipeline.add_argument(
+      '--build_watch_max_interval', type=float,
+      default=git_patrol.BUILD_WATCH_MAX_INTERVAL_SECS,
+      help='Maximum time between build status checks in seconds.')
+  pipeline.add_argument(
+      '--no_build_watcher', action='store_true',
+      help=('Wait for each build with its own \'gcloud builds log\' command '
+            'instead of a shared build watcher.'))
+  pipeline.add_argument(
+      '--duration', type=float, default=60,
+      help='Time in seconds to run the simulation for.')
+  pipeline.add_argument(
+      '--max_concurrent_polls', type=int, default=8,
+      help='Maximum number of polls running at the same time.')
+  pipeline.add_argument(
+      '--max_concurrent_polls_per_host', type=int, default=0,
+      help='Maximum number of polls of one host at a time. Zero for no limit.')
+  pipeline.add_argument(
+      '--max_concurrent_builds', type=int, default=0,
+      help='Maximum number of builds at the same time. Zero for no limit.')
+  pipeline.add_argument(
+      '--seed', type=int, default=0, help='Seed of the simulated changes.')
+  pipeline.add_argument(
+      '--dsn',
+      help=('Connection string of a scratch PostgreSQL database. Journal '
+            'entries are only counted, not written, when not provided.'))
+  pipeline.add_argument(
+      '--schema', default='git_patrol_benchmark',
+      help='Schema created (and dropped) to hold the benchmark tables.')
+  pipeline.add_argument(
+      '--keep', action='store_true',
+      help='Keep the benchmark schema for inspection.')
+  pipeline.add_argument(
+      '--db_checkpoint_interval', type=int, default=1,
+      help='Git poll journal entries per target between full snapshots.')
+  pipeline.add_argument(
+      '--db_write_behind', action='store_true',
+      help='Buffer journal entries and write them in batches.')
+  pipeline.add_argument(
+      '--db_heartbeat_unchanged_polls', action='store_true',
+      help='Record unchanged polls in the heartbeat table.')
+  pipeline.set_defaults(fn=benchmark_pipeline)
+
+  args = parser.parse_args()
+  args.fn(args)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,157 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local on-disk cache of the latest git refs of each target.
+
+Without it, every restart reads the complete git refs of every target from the
+database. The cache keeps them in a SQLite file keyed by alias along with the
+UUID of the git poll journal entry they come from. At startup only the latest
+UUID of each alias needs to come from the database to tell which cached
+entries are still current.
+"""
+
+import logging
+import os
+import sqlite3
+import uuid
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+# Version of the cache file layout. Cache files of other versions are emptied.
+CACHE_VERSION = 1
+
+
+def _encode_refs(refs):
+  return zlib.compress('\n'.join(
+      '{} {}'.format(commit, refname)
+      for (refname, commit) in refs.items()).encode())
+
+
+def _decode_refs(blob):
+  refs = {}
+  for line in zlib.decompress(blob).decode().splitlines():
+    commit, refname = line.split(' ', 1)
+    refs[refname] = commit
+  return refs
+
+
+class RefStateCache:
+  """SQLite file holding the latest git refs of each target.
+
+  The cache is only a copy of the database. Entries are loaded at startup and
+  saved at shutdown, so a lost or damaged cache file only costs a full read of
+  the git refs from the database. Its methods block, so only call them while
+  nothing else runs.
+  """
+
+  def __init__(self, path):
+    """Open or create a cache file.
+
+    A cache file that can't be opened is deleted and created again. If that
+    fails too, the cache stays empty and nothing is saved.
+
+    Args:
+      path: Path of the SQLite cache file.
+    """
+    self.path = path
+    self._conn = None
+    try:
+      self._conn = self._open()
+      return
+    except sqlite3.Error as e:
+      logger.warning('Recreating unreadable ref cache %s: %s', path, e)
+    try:
+      os.remove(path)
+      self._conn = self._open()
+    except (OSError, sqlite3.Error) as e:
+      logger.warning('Running without ref cache %s: %s', path, e)
+
+  def _open(self):
+    conn = sqlite3.connect(self.path)
+    try:
+      version = conn.execute('PRAGMA user_version;').fetchone()[0]
+      with conn:
+        if version != CACHE_VERSION:
+          conn.execute('DROP TABLE IF EXISTS ref_state;')
+          conn.execute('PRAGMA user_version = {:d};'.format(CACHE_VERSION))
+        conn.execute(
+            '''CREATE TABLE IF NOT EXISTS ref_state (
+              alias TEXT PRIMARY KEY,
+              latest_uuid TEXT,
+              checkpoint_uuid TEXT,
+              deltas INTEGER,
+              refs BLOB);
+            ''')
+    except sqlite3.Error:
+      conn.close()
+      raise
+    return conn
+
+  def load(self, aliases):
+    """Read the cached state of many aliases.
+
+    Args:
+      aliases: List of the git aliases to look up.
+    Returns:
+      A dictionary mapping each cached alias to a (UUID, int, dict, UUID) tuple
+      with the UUID of the alias' latest full snapshot, the number of delta
+      entries since that snapshot, the git refs and commit hashes, and the
+      UUID of the latest journal entry. Empty if the cache can't be read.
+    """
+    if not self._conn:
+      return {}
+    wanted = set(aliases)
+    try:
+      rows = self._conn.execute(
+          '''SELECT alias, latest_uuid, checkpoint_uuid, deltas, refs
+          FROM ref_state;
+          ''').fetchall()
+      return {
+          alias: (uuid.UUID(checkpoint_uuid), deltas, _decode_refs(refs),
+                  uuid.UUID(latest_uuid))
+          for (alias, latest_uuid, checkpoint_uuid, deltas, refs) in rows
+          if alias in wanted}
+    except (sqlite3.Error, zlib.error, ValueError) as e:
+      logger.warning('Ignoring unreadable ref cache %s: %s', self.path, e)
+      return {}
+
+  def save(self, states):
+    """Replace the cached state of many aliases.
+
+    Args:
+      states: Dictionary mapping aliases to tuples like the ones load()
+        returns.
+    """
+    if not self._conn:
+      return
+    try:
+      with self._conn:
+        self._conn.executemany(
+            '''INSERT OR REPLACE INTO ref_state (
+              alias, latest_uuid, checkpoint_uuid, deltas, refs)
+            VALUES (?, ?, ?, ?, ?);
+            ''', [
+                (alias, str(latest_uuid), str(checkpoint_uuid), deltas,
+                 _encode_refs(refs))
+                for (alias, (checkpoint_uuid, deltas, refs, latest_uuid))
+                in states.items()])
+    except sqlite3.Error as e:
+      logger.warning('Failed to save ref cache %s: %s', self.path, e)
+
+  def close(self):
+    """Close the cache file."""
+    if self._conn:
+      self._conn.close()
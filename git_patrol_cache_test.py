@@ -0,0 +1,111 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the local git ref cache."""
+
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import uuid
+
+import git_patrol_cache
+
+
+class GitPatrolCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    super(GitPatrolCacheTest, self).setUp()
+    logging.disable(logging.CRITICAL)
+    self._temp_dir = tempfile.mkdtemp()
+    self._path = os.path.join(self._temp_dir, 'refs.db')
+
+  def tearDown(self):
+    shutil.rmtree(self._temp_dir)
+    super(GitPatrolCacheTest, self).tearDown()
+
+  def testSaveAndLoad(self):
+    checkpoint_uuid = uuid.uuid4()
+    latest_uuid = uuid.uuid4()
+    refs = {'refs/heads/master': 'abcd', 'refs/tags/r 0001': 'fghi'}
+
+    ref_cache = git_patrol_cache.RefStateCache(self._path)
+    ref_cache.save({
+        'alias': (checkpoint_uuid, 2, refs, latest_uuid),
+        'empty': (latest_uuid, 0, {}, latest_uuid)})
+    ref_cache.close()
+
+    # Entries survive reopening the cache file.
+    ref_cache = git_patrol_cache.RefStateCache(self._path)
+    self.assertEqual(
+        ref_cache.load(['alias', 'empty', 'missing']),
+        {'alias': (checkpoint_uuid, 2, refs, latest_uuid),
+         'empty': (latest_uuid, 0, {}, latest_uuid)})
+    self.assertEqual(list(ref_cache.load(['empty'])), ['empty'])
+    ref_cache.close()
+
+  def testOtherVersionIsEmptied(self):
+    latest_uuid = uuid.uuid4()
+    ref_cache = git_patrol_cache.RefStateCache(self._path)
+    ref_cache.save({'alias': (latest_uuid, 0, {}, latest_uuid)})
+    ref_cache.close()
+
+    conn = sqlite3.connect(self._path)
+    conn.execute('PRAGMA user_version = 0;')
+    conn.close()
+
+    ref_cache = git_patrol_cache.RefStateCache(self._path)
+    self.assertEqual(ref_cache.load(['alias']), {})
+    ref_cache.close()
+
+  def testUnreadableEntriesAreIgnored(self):
+    ref_cache = git_patrol_cache.RefStateCache(self._path)
+    with ref_cache._conn:
+      ref_cache._conn.execute(
+          'INSERT INTO ref_state VALUES (?, ?, ?, ?, ?);',
+          ('alias', 'not-a-uuid', 'not-a-uuid', 0, b'garbage'))
+    self.assertEqual(ref_cache.load(['alias']), {})
+    ref_cache.close()
+
+  def testCorruptFileIsRecreated(self):
+    with open(self._path, 'wb') as f:
+      f.write(b'not a sqlite database' * 100)
+
+    latest_uuid = uuid.uuid4()
+    ref_cache = git_patrol_cache.RefStateCache(self._path)
+    self.assertEqual(ref_cache.load(['alias']), {})
+    ref_cache.save({'alias': (latest_uuid, 0, {}, latest_uuid)})
+    ref_cache.close()
+
+    ref_cache = git_patrol_cache.RefStateCache(self._path)
+    self.assertEqual(
+        ref_cache.load(['alias']),
+        {'alias': (latest_uuid, 0, {}, latest_uuid)})
+    ref_cache.close()
+
+  def testUnusableFileRunsWithoutCache(self):
+    # A directory can be neither opened as a database nor removed.
+    os.mkdir(self._path)
+
+    latest_uuid = uuid.uuid4()
+    ref_cache = git_patrol_cache.RefStateCache(self._path)
+    self.assertEqual(ref_cache.load(['alias']), {})
+    ref_cache.save({'alias': (latest_uuid, 0, {}, latest_uuid)})
+    ref_cache.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
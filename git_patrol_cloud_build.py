@@ -0,0 +1,279 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Google Cloud Build REST API client for the Git Patrol service.
+
+Talks to the Cloud Build v1 API directly over a shared keep-alive HTTP client
+rather than running a 'gcloud' process for every build operation. See
+https://cloud.google.com/cloud-build/docs/api/reference/rest for the API.
+"""
+
+import asyncio
+import json
+import time
+import urllib.parse
+import uuid
+
+import git_patrol_http
+import yaml
+
+
+CLOUD_BUILD_API_URL = 'https://cloudbuild.googleapis.com'
+STORAGE_API_URL = 'https://storage.googleapis.com'
+METADATA_URL = 'http://metadata.google.internal/computeMetadata/v1'
+
+# Build states after which a build will not change anymore. See
+# https://cloud.google.com/cloud-build/docs/api/reference/rest/v1/projects.builds#Status
+TERMINAL_STATUSES = frozenset([
+    'SUCCESS', 'FAILURE', 'INTERNAL_ERROR', 'TIMEOUT', 'CANCELLED', 'EXPIRED'])
+
+# Filter matching the builds that have not finished yet.
+ONGOING_BUILDS_FILTER = 'status="QUEUED" OR status="WORKING"'
+
+# Number of builds to request per page when listing builds.
+LIST_PAGE_SIZE = 500
+
+# Refresh access tokens this many seconds before they expire.
+TOKEN_EXPIRY_MARGIN_SECS = 60
+
+# Time in seconds between status checks while waiting for a build.
+BUILD_POLL_INTERVAL_SECS = 10
+
+
+class CloudBuildError(Exception):
+  """Raised when a Cloud Build API request fails."""
+
+
+async def metadata_access_token(http):
+  """Fetch an access token for the default service account.
+
+  Uses the metadata server available on Compute Engine, Kubernetes Engine and
+  Cloud Build workers.
+
+  Args:
+    http: git_patrol_http.HttpClient used to reach the metadata server.
+  Returns:
+    A (str, int) tuple with the access token and its lifetime in seconds.
+  Raises:
+    CloudBuildError: The metadata server failed or returned an invalid token.
+  """
+  response = await _metadata_request(
+      http, '/instance/service-accounts/default/token')
+  try:
+    token = json.loads(response.body.decode('utf-8'))
+    return token['access_token'], token['expires_in']
+  except (ValueError, KeyError, TypeError) as e:
+    raise CloudBuildError('invalid access token response: {!r}'.format(e))
+
+
+async def metadata_project_id(http):
+  """Look up the Google Cloud project the service runs in.
+
+  Args:
+    http: git_patrol_http.HttpClient used to reach the metadata server.
+  Returns:
+    The project ID.
+  Raises:
+    CloudBuildError: The metadata server failed.
+  """
+  response = await _metadata_request(http, '/project/project-id')
+  return response.body.decode('utf-8', 'ignore').strip()
+
+
+async def _metadata_request(http, path):
+  try:
+    response = await http.request(
+        'GET', METADATA_URL + path, {'Metadata-Flavor': 'Google'})
+  except git_patrol_http.GitHttpError as e:
+    raise CloudBuildError('metadata server request failed: {}'.format(e))
+  if response.status != 200:
+    raise CloudBuildError(
+        'metadata server returned HTTP {}'.format(response.status))
+  return response
+
+
+class AccessTokenCache:
+  """Caches an OAuth2 access token until shortly before it expires."""
+
+  def __init__(self, fetch_token_fn):
+    """Create a new token cache.
+
+    Args:
+      fetch_token_fn: Coroutine function returning a (token, lifetime in
+        seconds) tuple.
+    """
+    self._fetch_token_fn = fetch_token_fn
+    self._token = None
+    self._expiry = 0
+    self._lock = asyncio.Lock()
+
+  async def token(self):
+    """Returns a valid access token, fetching a new one if needed."""
+    async with self._lock:
+      if not self._token or time.monotonic() >= self._expiry:
+        self._token, lifetime = await self._fetch_token_fn()
+        self._expiry = time.monotonic() + lifetime - TOKEN_EXPIRY_MARGIN_SECS
+      return self._token
+
+
+class CloudBuildClient:
+  """Starts and monitors Cloud Build workflows through the REST API."""
+
+  def __init__(
+      self, project, token_cache, http_client=None,
+      api_url=CLOUD_BUILD_API_URL, storage_url=STORAGE_API_URL):
+    """Create a new Cloud Build client.
+
+    Args:
+      project: Google Cloud project to run builds in.
+      token_cache: AccessTokenCache providing OAuth2 access tokens.
+      http_client: git_patrol_http.HttpClient shared by all requests. A new
+        one is created when not provided.
+      api_url: Base URL of the Cloud Build API.
+      storage_url: Base URL of the Cloud Storage API. Source archives are
+        uploaded to the project's default "<project>_cloudbuild" bucket like
+        "gcloud builds submit" does.
+    """
+    self.project = project
+    self.token_cache = token_cache
+    self.http = http_client or git_patrol_http.HttpClient()
+    self.api_url = api_url
+    self.storage_url = storage_url
+
+  async def _request(self, method, url, body=None, content_type=None):
+    try:
+      # Failing to get a token fails the request like any other API error.
+      headers = {
+          'Authorization': 'Bearer ' + await self.token_cache.token(),
+          'Accept': 'application/json',
+      }
+      if content_type:
+        headers['Content-Type'] = content_type
+      response = await self.http.request(method, url, headers, body)
+    except git_patrol_http.GitHttpError as e:
+      raise CloudBuildError(str(e))
+    if not 200 <= response.status < 300:
+      raise CloudBuildError('{} {} returned HTTP {}: {}'.format(
+          method, url, response.status,
+          response.body.decode('utf-8', 'ignore')))
+    try:
+      return json.loads(response.body.decode('utf-8'))
+    except ValueError as e:
+      raise CloudBuildError('invalid JSON response: {}'.format(e))
+
+  def _builds_url(self, suffix=''):
+    return '{}/v1/projects/{}/builds{}'.format(
+        self.api_url, urllib.parse.quote(self.project), suffix)
+
+  async def upload_source(self, path):
+    """Upload a source archive for a build.
+
+    Args:
+      path: Path to a .tar.gz archive.
+    Returns:
+      A StorageSource dictionary referencing the uploaded archive.
+    """
+    loop = asyncio.get_event_loop()
+    with open(path, 'rb') as f:
+      data = await loop.run_in_executor(None, f.read)
+    bucket = '{}_cloudbuild'.format(self.project)
+    name = 'source/{:.6f}-{}.tgz'.format(time.time(), uuid.uuid4().hex)
+    await self._request(
+        'POST',
+        '{}/upload/storage/v1/b/{}/o?uploadType=media&name={}'.format(
+            self.storage_url, urllib.parse.quote(bucket),
+            urllib.parse.quote(name, safe='')),
+        data, 'application/gzip')
+    return {'bucket': bucket, 'object': name}
+
+  async def submit_build(self, config_file, substitutions, source_path=None):
+    """Start a new build like 'gcloud builds submit --async'.
+
+    Args:
+      config_file: Path to the YAML or JSON Cloud Build configuration.
+      substitutions: Dictionary of substitution variables for the build.
+      source_path: Optional path to a source archive for the build.
+    Returns:
+      The Build resource of the new build as a dictionary.
+    """
+    loop = asyncio.get_event_loop()
+    with open(config_file, 'r') as f:
+      try:
+        build = yaml.safe_load(await loop.run_in_executor(None, f.read))
+      except yaml.YAMLError as e:
+        raise CloudBuildError('invalid build config {}: {}'.format(
+            config_file, e))
+    if substitutions:
+      build['substitutions'] = dict(
+          build.get('substitutions', {}), **substitutions)
+    if source_path:
+      build['source'] = {
+          'storageSource': await self.upload_source(source_path)}
+
+    operation = await self._request(
+        'POST', self._builds_url(), json.dumps(build).encode(),
+        'application/json')
+    try:
+      return operation['metadata']['build']
+    except (KeyError, TypeError):
+      raise CloudBuildError('unexpected create build response')
+
+  async def get_build(self, build_id):
+    """Returns the current Build resource of a build as a dictionary."""
+    return await self._request(
+        'GET', self._builds_url('/' + urllib.parse.quote(build_id)))
+
+  async def cancel_build(self, build_id):
+    """Cancel a queued or running build.
+
+    Args:
+      build_id: ID of the build to cancel.
+    Returns:
+      The Build resource of the cancelled build as a dictionary.
+    """
+    return await self._request(
+        'POST', self._builds_url('/{}:cancel'.format(
+            urllib.parse.quote(build_id))),
+        b'{}', 'application/json')
+
+  async def list_ongoing_builds(self):
+    """Returns the IDs of all queued and running builds as a set."""
+    build_ids = set()
+    page_token = ''
+    while True:
+      query = urllib.parse.urlencode(
+          [('filter', ONGOING_BUILDS_FILTER), ('pageSize', LIST_PAGE_SIZE)] +
+          ([('pageToken', page_token)] if page_token else []))
+      response = await self._request('GET', self._builds_url('?' + query))
+      build_ids.update(build['id'] for build in response.get('builds', []))
+      page_token = response.get('nextPageToken')
+      if not page_token:
+        return build_ids
+
+  async def wait_build(self, build_id, poll_interval=None):
+    """Wait for a build to reach a terminal state.
+
+    Args:
+      build_id: ID of the build to wait for.
+      poll_interval: Time in seconds between status checks. Defaults to
+        BUILD_POLL_INTERVAL_SECS.
+    Returns:
+      The final Build resource of the build as a dictionary.
+    """
+    while True:
+      build = await self.get_build(build_id)
+      if build.get('status') in TERMINAL_STATUSES:
+        return build
+      await asyncio.sleep(
+          BUILD_POLL_INTERVAL_SECS if poll_interval is None else poll_interval)
@@ -0,0 +1,377 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the Git Patrol Cloud Build REST API client."""
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+import uuid
+
+import git_patrol
+import git_patrol_cloud_build
+import git_patrol_http
+import yaml
+
+
+class _FakeCloudBuildServer:
+  """Local stand-in for the Cloud Build and Cloud Storage APIs.
+
+  Implements just enough of the REST APIs to create builds, upload source
+  archives, cancel builds and report build status. Each build reports WORKING
+  on its first status check or listing and the configured final status
+  afterwards. Held builds keep running until they are cancelled.
+  """
+
+  def __init__(self, final_status='SUCCESS'):
+    self.final_status = final_status
+    self.hold_new_builds = False
+    self.held = set()
+    self.cancelled = set()
+    self.connections = 0
+    self.requests = []
+    self.builds = {}
+    self._status_checks = {}
+    self._server = None
+    self._handlers = set()
+
+  async def start(self):
+    self._server = await asyncio.start_server(
+        self._handle_connection, '127.0.0.1', 0)
+    return 'http://127.0.0.1:{}'.format(
+        self._server.sockets[0].getsockname()[1])
+
+  async def stop(self):
+    self._server.close()
+    for handler in self._handlers:
+      handler.cancel()
+    await asyncio.gather(*self._handlers, return_exceptions=True)
+
+  def _route(self, method, path, body):
+    if method == 'POST' and path.startswith('/upload/storage/v1/b/'):
+      return 200, {'kind': 'storage#object', 'size': str(len(body))}
+    if method == 'POST' and path.endswith('/builds'):
+      build = json.loads(body.decode())
+      build.update(id=str(uuid.uuid4()), status='QUEUED')
+      self.builds[build['id']] = build
+      if self.hold_new_builds:
+        self.held.add(build['id'])
+      return 200, {'name': 'operations/build/' + build['id'],
+                   'metadata': {'build': build}}
+    if method == 'GET' and path.endswith('/builds'):
+      # Listing counts as a status check of every build.
+      ongoing = []
+      for (build_id, build) in self.builds.items():
+        checks = self._status_checks.get(build_id, 0)
+        self._status_checks[build_id] = checks + 1
+        if not checks:
+          ongoing.append(dict(build, status='WORKING'))
+      return 200, {'builds': ongoing}
+    if method == 'POST' and path.endswith(':cancel'):
+      build_id = path.rsplit('/', 1)[1][:-len(':cancel')]
+      self.cancelled.add(build_id)
+      return 200, dict(self.builds[build_id], status='CANCELLED')
+    if method == 'GET' and '/builds/' in path:
+      build_id = path.rsplit('/', 1)[1]
+      if build_id not in self.builds:
+        return 404, {'error': {'code': 404}}
+      checks = self._status_checks.get(build_id, 0)
+      self._status_checks[build_id] = checks + 1
+      if build_id in self.cancelled:
+        status = 'CANCELLED'
+      elif not checks or build_id in self.held:
+        status = 'WORKING'
+      else:
+        status = self.final_status
+      return 200, dict(self.builds[build_id], status=status)
+    return 404, {'error': {'code': 404}}
+
+  async def _handle_connection(self, reader, writer):
+    self.connections += 1
+    self._handlers.add(asyncio.current_task())
+    try:
+      while True:
+        request_line = await reader.readline()
+        if not request_line:
+          break
+        method, target, _ = request_line.decode().split(' ', 2)
+        headers = {}
+        while True:
+          line = (await reader.readline()).decode().rstrip('\r\n')
+          if not line:
+            break
+          name, _, value = line.partition(':')
+          headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        self.requests.append((method, target, headers, body))
+
+        status, response = self._route(method, target.partition('?')[0], body)
+        response_body = json.dumps(response).encode()
+        writer.write(
+            'HTTP/1.1 {} X\r\nContent-Type: application/json\r\n'
+            'Content-Length: {}\r\n\r\n'.format(
+                status, len(response_body)).encode() + response_body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    finally:
+      writer.close()
+
+
+class _RecordingDb():
+
+  def __init__(self):
+    self.record_workflows = False
+    self.cloud_builds = []
+
+  async def record_cloud_build(
+      self, parent_id, git_poll_uuid, utc_datetime, alias, git_ref, status,
+      workflow=None):
+    self.cloud_builds.append((parent_id, status, git_ref))
+    return len(self.cloud_builds)
+
+
+class GitPatrolCloudBuildTest(unittest.TestCase):
+
+  def setUp(self):
+    super(GitPatrolCloudBuildTest, self).setUp()
+    logging.disable(logging.CRITICAL)
+
+    self._temp_dir = tempfile.mkdtemp()
+    with open(os.path.join(self._temp_dir, 'first.yaml'), 'w') as f:
+      f.write(
+          'steps:\n'
+          '- name: ubuntu\n'
+          '  args: [echo, $TAG_NAME]\n'
+          'substitutions:\n'
+          '  _VAR0: default\n')
+    with open(os.path.join(self._temp_dir, 'first.tar.gz'), 'wb') as f:
+      f.write(b'not really a tarball')
+
+    self._loop = asyncio.get_event_loop()
+    self._server = _FakeCloudBuildServer()
+    url = self._loop.run_until_complete(self._server.start())
+
+    self._token_fetches = 0
+    async def fetch_token():
+      self._token_fetches += 1
+      return 'token{}'.format(self._token_fetches), 3600
+
+    self._client = git_patrol_cloud_build.CloudBuildClient(
+        'my-project', git_patrol_cloud_build.AccessTokenCache(fetch_token),
+        http_client=git_patrol_http.HttpClient(), api_url=url, storage_url=url)
+
+  def tearDown(self):
+    self._client.http.close()
+    self._loop.run_until_complete(self._server.stop())
+    shutil.rmtree(self._temp_dir, ignore_errors=True)
+    super(GitPatrolCloudBuildTest, self).tearDown()
+
+  def testSubmitAndWaitBuild(self):
+    build = self._loop.run_until_complete(self._client.submit_build(
+        os.path.join(self._temp_dir, 'first.yaml'),
+        {'TAG_NAME': 'r0001', '_VAR1': 'val1'},
+        os.path.join(self._temp_dir, 'first.tar.gz')))
+    self.assertEqual(build['status'], 'QUEUED')
+    self.assertEqual(
+        build['substitutions'],
+        {'_VAR0': 'default', 'TAG_NAME': 'r0001', '_VAR1': 'val1'})
+    self.assertEqual(build['source']['storageSource']['bucket'],
+                     'my-project_cloudbuild')
+
+    build = self._loop.run_until_complete(
+        self._client.wait_build(build['id'], poll_interval=0))
+    self.assertEqual(build['status'], 'SUCCESS')
+
+    # Upload, create and two status checks over one connection with a single
+    # access token.
+    self.assertEqual(
+        [method for (method, _, _, _) in self._server.requests],
+        ['POST', 'POST', 'GET', 'GET'])
+    self.assertEqual(self._server.connections, 1)
+    self.assertEqual(self._token_fetches, 1)
+    self.assertTrue(all(
+        headers['authorization'] == 'Bearer token1'
+        for (_, _, headers, _) in self._server.requests))
+
+  def testGetMissingBuild(self):
+    with self.assertRaises(git_patrol_cloud_build.CloudBuildError):
+      self._loop.run_until_complete(self._client.get_build('missing'))
+
+  def testAccessTokenRefresh(self):
+    async def fetch_token():
+      self._token_fetches += 1
+      return 'token', git_patrol_cloud_build.TOKEN_EXPIRY_MARGIN_SECS
+
+    # Tokens that are about to expire are fetched again.
+    cache = git_patrol_cloud_build.AccessTokenCache(fetch_token)
+    self._loop.run_until_complete(cache.token())
+    self._loop.run_until_complete(cache.token())
+    self.assertEqual(self._token_fetches, 2)
+
+  def testAccessTokenFailure(self):
+    responses = [
+        git_patrol_http.GitHttpError('connection refused'),
+        git_patrol_http.HttpResponse(200, {}, b'{"token_type": "Bearer"}')]
+    class FakeMetadataServer:
+      async def request(self, method, url, headers, body=None):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+          raise response
+        return response
+
+    # Token failures surface as Cloud Build errors, which fail the workflow
+    # rather than crash it.
+    self._client.token_cache = git_patrol_cloud_build.AccessTokenCache(
+        lambda: git_patrol_cloud_build.metadata_access_token(
+            FakeMetadataServer()))
+    for _ in range(2):
+      with self.assertRaises(git_patrol_cloud_build.CloudBuildError):
+        self._loop.run_until_complete(self._client.get_build('build'))
+    self.assertEqual(self._server.requests, [])
+
+  def testBuildWatcher(self):
+    async def submit_and_wait():
+      builds = [
+          await self._client.submit_build(
+              os.path.join(self._temp_dir, 'first.yaml'), {})
+          for _ in range(3)]
+      return await asyncio.gather(*[
+          commands.build_watcher.wait(build['id']) for build in builds])
+
+    commands = git_patrol.GitPatrolCommands()
+    commands.gcloud = unittest.mock.MagicMock()
+    commands.cloud_build = self._client
+    commands.build_watcher = git_patrol.CloudBuildWatcher(
+        commands, min_interval=0, max_interval=0)
+    builds = self._loop.run_until_complete(submit_and_wait())
+    self.assertEqual([build['status'] for build in builds], ['SUCCESS'] * 3)
+    commands.gcloud.assert_not_called()
+
+    # Three creates, two listings and one get per finished build.
+    self.assertEqual(
+        [(method, target.partition('?')[0].rsplit('/', 1)[1] != 'builds')
+         for (method, target, _, _) in self._server.requests[3:]],
+        [('GET', False), ('GET', False),
+         ('GET', True), ('GET', True), ('GET', True)])
+
+  def testCancelSupersededBuild(self):
+    self._server.hold_new_builds = True
+    commands = git_patrol.GitPatrolCommands()
+    commands.cloud_build = self._client
+    db = _RecordingDb()
+    dispatcher = git_patrol.WorkflowDispatcher(cancel_superseded=True)
+
+    target_config = yaml.safe_load(
+        """
+        alias: upstream
+        workflows:
+        - alias: first
+          config: first.yaml
+        - alias: second
+          config: first.yaml
+        """)
+
+    async def run_workflows():
+      dispatcher.dispatch(git_patrol.run_workflow_body(
+          commands, db, self._temp_dir, target_config, uuid.uuid4(),
+          ('refs/heads/master', 'c1'), dispatcher=dispatcher))
+      while not self._server.builds:
+        await asyncio.sleep(0.01)
+      self._server.hold_new_builds = False
+      dispatcher.dispatch(git_patrol.run_workflow_body(
+          commands, db, self._temp_dir, target_config, uuid.uuid4(),
+          ('refs/heads/master', 'c2'), dispatcher=dispatcher))
+      await dispatcher.join()
+
+    with unittest.mock.patch.object(
+        git_patrol_cloud_build, 'BUILD_POLL_INTERVAL_SECS', 0.01):
+      self._loop.run_until_complete(run_workflows())
+
+    # The first commit's build is cancelled and its second workflow skipped.
+    self.assertEqual(len(self._server.cancelled), 1)
+    self.assertEqual(len(self._server.builds), 3)
+    def statuses(commit):
+      return [status['status'] for (_, status, git_ref) in db.cloud_builds
+              if git_ref[1] == commit]
+    self.assertEqual(statuses('c1'), ['QUEUED', 'CANCELLED', 'SUPERSEDED'])
+    self.assertEqual(statuses('c2'), ['QUEUED', 'SUCCESS'] * 2)
+
+  def testRunWorkflowBody(self):
+    commands = git_patrol.GitPatrolCommands()
+    commands.gcloud = unittest.mock.MagicMock()
+    commands.cloud_build = self._client
+    db = _RecordingDb()
+
+    target_config = yaml.safe_load(
+        """
+        alias: upstream
+        workflows:
+        - alias: first
+          config: first.yaml
+          sources: first.tar.gz
+        - alias: second
+          config: first.yaml
+        """)
+    with unittest.mock.patch.object(
+        git_patrol_cloud_build, 'BUILD_POLL_INTERVAL_SECS', 0):
+      workflow_success = self._loop.run_until_complete(
+          git_patrol.run_workflow_body(
+              commands, db, self._temp_dir, target_config, uuid.uuid4(),
+              ('refs/heads/master', 'deadbeef')))
+    self.assertTrue(workflow_success)
+    commands.gcloud.assert_not_called()
+
+    # A QUEUED and a SUCCESS entry for each workflow, chained by parent_id.
+    self.assertEqual(
+        [(parent_id, status['status'])
+         for (parent_id, status, _) in db.cloud_builds],
+        [(0, 'QUEUED'), (1, 'SUCCESS'), (2, 'QUEUED'), (3, 'SUCCESS')])
+    self.assertEqual(
+        db.cloud_builds[0][1]['substitutions']['BRANCH_NAME'], 'master')
+    self.assertIn('source', db.cloud_builds[0][1])
+    self.assertNotIn('source', db.cloud_builds[2][1])
+
+  def testRunWorkflowBodyFailure(self):
+    self._server.final_status = 'FAILURE'
+    commands = git_patrol.GitPatrolCommands()
+    commands.cloud_build = self._client
+    db = _RecordingDb()
+
+    target_config = yaml.safe_load(
+        """
+        alias: upstream
+        workflows:
+        - alias: first
+          config: first.yaml
+        - alias: second
+          config: first.yaml
+        """)
+    with unittest.mock.patch.object(
+        git_patrol_cloud_build, 'BUILD_POLL_INTERVAL_SECS', 0):
+      workflow_success = self._loop.run_until_complete(
+          git_patrol.run_workflow_body(
+              commands, db, self._temp_dir, target_config, uuid.uuid4(),
+              ('refs/tags/r0001', 'deadbeef')))
+    self.assertFalse(workflow_success)
+    self.assertEqual(len(db.cloud_builds), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -17,9 +17,95 @@
 Provides a high level API to the database of persistent state.
 """
 
+import asyncio
+import collections
+import datetime
 import json
+import logging
+import os
+import time
 import uuid
 
+import git_patrol_metrics
+import git_patrol_refs
+
+
+# Most recently recorded git refs for an alias along with the full checkpoint
+# that subsequent delta entries are relative to.
+#   - checkpoint_uuid: UUID of the last full snapshot written for the alias.
+#   - deltas: Number of delta entries written since that checkpoint.
+#   - refs: Dictionary of git refs and commit hashes as of the latest entry.
+#   - latest_uuid: UUID of the latest entry written for the alias.
+_AliasRefState = collections.namedtuple(
+    '_AliasRefState', ['checkpoint_uuid', 'deltas', 'refs', 'latest_uuid'])
+
+
+logger = logging.getLogger(__name__)
+
+# Columns written for each journal entry by the write-behind buffer. The
+# workflow column is only written when recording workflows.
+GIT_POLL_JOURNAL_COLUMNS = [
+    'git_poll_uuid', 'update_time', 'url', 'alias', 'previous_uuid', 'refs',
+    'ref_filters', 'checkpoint_uuid', 'deleted_refs']
+CLOUD_BUILD_JOURNAL_COLUMNS = [
+    'journal_id', 'parent_id', 'git_poll_uuid', 'update_time', 'alias', 'ref',
+    'cloud_build_status']
+
+# Records the latest poll of an alias without adding a journal entry. The last
+# parameter is the number of polls since the previous heartbeat was written.
+HEARTBEAT_UPSERT = '''INSERT INTO git_poll_heartbeat (
+    alias, git_poll_uuid, last_seen, url, polls)
+  VALUES ($1, $2, $3, $4, $5)
+  ON CONFLICT (alias) DO UPDATE SET
+    git_poll_uuid = EXCLUDED.git_poll_uuid,
+    last_seen = EXCLUDED.last_seen,
+    url = EXCLUDED.url,
+    polls = git_poll_heartbeat.polls + EXCLUDED.polls;
+  '''
+
+# Arbitrary key of the advisory lock serializing schema migrations between
+# service instances.
+MIGRATION_LOCK_ID = 0x67697470
+
+# Journals partitioned by month once the partitioning migration is applied.
+PARTITIONED_JOURNALS = ['git_poll_journal', 'cloud_build_journal']
+
+
+def _apply_ref_deltas(rows):
+  """Reconstruct git refs from a checkpoint and its subsequent deltas.
+
+  Args:
+    rows: Journal rows ordered by update time. The first row must be the full
+      checkpoint and the remaining rows deltas relative to it.
+  Returns:
+    A dictionary of git refs and commit hashes.
+  """
+  refs = {}
+  for row in rows:
+    for refname in row['deleted_refs'] or []:
+      refs.pop(refname, None)
+    refs.update({ref[0]: ref[1] for ref in row['refs']})
+  return refs
+
+
+class _TimedAcquire:
+  """Acquires a pooled connection, recording how long that took."""
+
+  def __init__(self, pool):
+    self._pool = pool
+    self._context = None
+
+  async def __aenter__(self):
+    start = time.perf_counter()
+    self._context = self._pool.acquire()
+    conn = await self._context.__aenter__()
+    git_patrol_metrics.DB_POOL_WAIT_SECONDS.observe(
+        time.perf_counter() - start)
+    return conn
+
+  async def __aexit__(self, exc_type, exc, tb):
+    return await self._context.__aexit__(exc_type, exc, tb)
+
 
 class GitPatrolDb:
   """Database abstraction class for commonly used operations.
@@ -30,8 +116,54 @@ class GitPatrolDb:
   the callers and potentially complex database acrobatics.
   """
 
-  def __init__(self, asyncpg_pool):
+  def __init__(
+      self, asyncpg_pool, checkpoint_interval=1, write_behind=False,
+      flush_rows=500, flush_interval=1.0, heartbeat_unchanged=False,
+      ref_cache=None, record_workflows=False):
+    """Create a new database abstraction object.
+
+    Args:
+      asyncpg_pool: The asyncpg.Pool used to access the database.
+      checkpoint_interval: Number of git poll journal entries per alias between
+        full snapshots of the git refs. The entries in between only record the
+        refs that were added, updated or deleted. Values below 2 record a full
+        snapshot for every entry.
+      write_behind: Buffer journal entries in memory and write them in batches
+        with COPY rather than with one INSERT per entry. Buffered entries are
+        written in the order they were recorded, before any read, and by
+        close(). Cloud Build journal IDs are reserved from the database's
+        sequence in blocks so they can be returned right away.
+      flush_rows: Number of buffered journal entries that triggers a write.
+        Also the number of journal IDs reserved at a time.
+      flush_interval: Maximum time in seconds a journal entry stays buffered.
+      heartbeat_unchanged: Rather than adding a git poll journal entry for a
+        poll that found exactly the same git refs as the latest entry, only
+        update the alias' row in the git_poll_heartbeat table.
+      ref_cache: Optional git_patrol_cache.RefStateCache keeping the latest
+        git refs of each alias on local disk. fetch_latest_refs_by_aliases()
+        then only reads the git refs of aliases whose cached entry is out of
+        date, and close() saves the latest git refs to it.
+      record_workflows: Record the workflow alias of each Cloud Build journal
+        entry so interrupted workflows can be resumed. Needs the workflow
+        column added by the migrations.
+    """
     self.db_pool = asyncpg_pool
+    self.checkpoint_interval = checkpoint_interval
+    self.write_behind = write_behind
+    self.flush_rows = flush_rows
+    self.flush_interval = flush_interval
+    self.heartbeat_unchanged = heartbeat_unchanged
+    self.ref_cache = ref_cache
+    self.record_workflows = record_workflows
+    self._ref_state = {}
+    self._pending = []
+    self._heartbeats = {}
+    self._journal_ids = collections.deque()
+    self._flush_lock = asyncio.Lock()
+    self._flush_task = None
+
+  def _acquire(self):
+    return _TimedAcquire(self.db_pool)
 
   async def fetch_latest_refs_by_alias(self, alias):
     """Retrieve the most recent git refs for a given alias.
@@ -43,17 +175,212 @@ class GitPatrolDb:
       attempt for the alias. The second item is a dictionary of git refs and
       commit hashes. Otherwise (None, {}).
     """
-    async with self.db_pool.acquire() as conn:
+    await self.flush()
+    async with self._acquire() as conn:
       row = await conn.fetchrow(
-          '''SELECT git_poll_uuid, refs
+          '''SELECT git_poll_uuid, update_time, checkpoint_uuid, refs
           FROM git_poll_journal
           WHERE alias = $1
           ORDER BY update_time DESC LIMIT 1;
           ''', alias)
-      if row:
-        return row['git_poll_uuid'], {ref[0]: ref[1] for ref in row['refs']}
+      if not row:
+        self._ref_state.pop(alias, None)
+        return None, {}
+
+      # Full snapshots can be used as is. Otherwise replay the deltas recorded
+      # since the checkpoint the latest entry is relative to.
+      if not row['checkpoint_uuid']:
+        refs = {ref[0]: ref[1] for ref in row['refs']}
+        self._ref_state[alias] = _AliasRefState(
+            row['git_poll_uuid'], 0, refs, row['git_poll_uuid'])
+        return row['git_poll_uuid'], refs
+
+      rows = await conn.fetch(
+          '''SELECT refs, deleted_refs
+          FROM git_poll_journal
+          WHERE alias = $1 AND update_time <= $3
+            AND (git_poll_uuid = $2 OR checkpoint_uuid = $2)
+          ORDER BY update_time;
+          ''', alias, row['checkpoint_uuid'], row['update_time'])
+      refs = _apply_ref_deltas(rows)
+      self._ref_state[alias] = _AliasRefState(
+          row['checkpoint_uuid'], len(rows) - 1, refs, row['git_poll_uuid'])
+      return row['git_poll_uuid'], refs
+
+  async def fetch_latest_refs_by_aliases(self, aliases):
+    """Retrieve the most recent git refs for many aliases at once.
+
+    Loads the state of every target in at most two queries, rather than one
+    or two queries per alias as fetch_latest_refs_by_alias() does. Meant for
+    loading the state of all targets at startup. With a ref cache, a first
+    query of the UUIDs of the latest journal entries tells which cached git
+    refs are current, and only the others are read from the journal.
+
+    Args:
+      aliases: List of the git aliases to look up.
+    Returns:
+      A dictionary mapping each alias with at least one journal entry to a
+      (UUID, dict) tuple like the one fetch_latest_refs_by_alias() returns.
+    """
+    await self.flush()
+    results = {}
+    if self.ref_cache:
+      results = await self._fetch_cached_refs(aliases)
+      aliases = [alias for alias in aliases if alias not in results]
+      if not aliases:
+        return results
+
+    async with self._acquire() as conn:
+      # The lateral join looks up each alias through the (alias, update_time)
+      # index rather than sorting every row of the journal.
+      latest_rows = await conn.fetch(
+          '''SELECT latest.*
+          FROM unnest($1::text[]) AS target(alias)
+          CROSS JOIN LATERAL (
+            SELECT alias, git_poll_uuid, update_time, checkpoint_uuid, refs
+            FROM git_poll_journal
+            WHERE alias = target.alias
+            ORDER BY update_time DESC LIMIT 1) AS latest;
+          ''', list(aliases))
+
+      delta_rows = [row for row in latest_rows if row['checkpoint_uuid']]
+      for row in latest_rows:
+        if not row['checkpoint_uuid']:
+          refs = {ref[0]: ref[1] for ref in row['refs']}
+          self._ref_state[row['alias']] = _AliasRefState(
+              row['git_poll_uuid'], 0, refs, row['git_poll_uuid'])
+          results[row['alias']] = (row['git_poll_uuid'], refs)
+      if not delta_rows:
+        return results
 
-    return None, {}
+      # Replay the deltas of all aliases whose latest entry isn't a full
+      # snapshot in a single query.
+      rows = await conn.fetch(
+          '''SELECT journal.alias, journal.refs, journal.deleted_refs
+          FROM unnest($1::text[], $2::uuid[], $3::timestamp[])
+            AS latest(alias, checkpoint_uuid, update_time)
+          JOIN git_poll_journal AS journal
+            ON journal.alias = latest.alias
+            AND journal.update_time <= latest.update_time
+            AND (journal.git_poll_uuid = latest.checkpoint_uuid
+                 OR journal.checkpoint_uuid = latest.checkpoint_uuid)
+          ORDER BY journal.alias, journal.update_time;
+          ''', [row['alias'] for row in delta_rows],
+          [row['checkpoint_uuid'] for row in delta_rows],
+          [row['update_time'] for row in delta_rows])
+      rows_by_alias = collections.defaultdict(list)
+      for row in rows:
+        rows_by_alias[row['alias']].append(row)
+      for row in delta_rows:
+        alias_rows = rows_by_alias[row['alias']]
+        refs = _apply_ref_deltas(alias_rows)
+        self._ref_state[row['alias']] = _AliasRefState(
+            row['checkpoint_uuid'], len(alias_rows) - 1, refs,
+            row['git_poll_uuid'])
+        results[row['alias']] = (row['git_poll_uuid'], refs)
+      return results
+
+  async def _fetch_cached_refs(self, aliases):
+    """Look up the aliases whose cached git refs are still current.
+
+    Returns:
+      A dictionary like the one fetch_latest_refs_by_aliases() returns, for
+      the aliases whose cached entry matches their latest journal entry.
+    """
+    cached = self.ref_cache.load(aliases)
+    if not cached:
+      return {}
+    async with self._acquire() as conn:
+      rows = await conn.fetch(
+          '''SELECT latest.*
+          FROM unnest($1::text[]) AS target(alias)
+          CROSS JOIN LATERAL (
+            SELECT alias, git_poll_uuid
+            FROM git_poll_journal
+            WHERE alias = target.alias
+            ORDER BY update_time DESC LIMIT 1) AS latest;
+          ''', list(cached))
+
+    results = {}
+    for row in rows:
+      state = _AliasRefState(*cached[row['alias']])
+      if state.latest_uuid == row['git_poll_uuid']:
+        self._ref_state[row['alias']] = state
+        results[row['alias']] = (state.latest_uuid, state.refs)
+    logger.info(
+        'Found current cached git refs for %d of %d aliases', len(results),
+        len(aliases))
+    return results
+
+  async def fetch_change_times_by_aliases(self, aliases, limit):
+    """Retrieve when the git refs of many aliases last changed.
+
+    Only git poll journal entries with a previous_uuid found new or updated
+    git refs.
+
+    Args:
+      aliases: List of the git aliases to look up.
+      limit: Maximum number of changes to return for each alias.
+    Returns:
+      A dictionary mapping each alias with at least one change to a list of
+      the change times, most recent first.
+    """
+    await self.flush()
+    async with self._acquire() as conn:
+      rows = await conn.fetch(
+          '''SELECT changes.*
+          FROM unnest($1::text[]) AS target(alias)
+          CROSS JOIN LATERAL (
+            SELECT alias, update_time
+            FROM git_poll_journal
+            WHERE alias = target.alias AND previous_uuid IS NOT NULL
+            ORDER BY update_time DESC LIMIT $2) AS changes;
+          ''', list(aliases), limit)
+
+    results = collections.defaultdict(list)
+    for row in rows:
+      results[row['alias']].append(row['update_time'])
+    return dict(results)
+
+  async def fetch_unfinished_workflows(self, aliases, since):
+    """Retrieve the workflows that may not have run to completion.
+
+    Returns the latest entry of each workflow of the git refs of a git poll,
+    for the git refs where any workflow is pending, has a build in progress or
+    has its latest build succeeded. The caller tells from the target
+    configuration whether workflows remain.
+
+    Args:
+      aliases: List of the git aliases to look up.
+      since: Only consider entries updated after this time in UTC time zone.
+    Returns:
+      A list of dictionaries with the journal_id, git_poll_uuid, alias, ref,
+      workflow and decoded cloud_build_status of each entry, oldest first.
+    """
+    await self.flush()
+    async with self._acquire() as conn:
+      rows = await conn.fetch(
+          '''SELECT journal_id, git_poll_uuid, alias, ref, workflow,
+            cloud_build_status
+          FROM (
+            SELECT *, bool_or(cloud_build_status->>'status' IN (
+                'PENDING', 'QUEUED', 'WORKING', 'SUCCESS'))
+              OVER (PARTITION BY git_poll_uuid, ref) AS unfinished
+            FROM (
+              SELECT DISTINCT ON (git_poll_uuid, ref, workflow)
+                journal_id, git_poll_uuid, alias, ref, workflow,
+                cloud_build_status
+              FROM cloud_build_journal
+              WHERE alias = ANY($1::text[]) AND update_time >= $2
+                AND workflow IS NOT NULL
+              ORDER BY git_poll_uuid, ref, workflow, journal_id DESC)
+              AS latest) AS git_refs
+          WHERE unfinished
+          ORDER BY journal_id;
+          ''', list(aliases), since)
+    return [
+        dict(row, cloud_build_status=json.loads(row['cloud_build_status']))
+        for row in rows]
 
   async def record_git_poll(
       self, utc_datetime, url, alias, previous_uuid, refs, ref_filters):
@@ -67,29 +394,112 @@ class GitPatrolDb:
         field will contain the UUID of the poll attempt from which the delta
         was calculated. None if there were no new refs in this attempt.
       refs: Dictionary of git reference names and commit hashes retrieved from
-        the repository.
+        the repository. Polls that found the same refs as the previous poll
+        pass the same object again, which needs no comparison.
       ref_filters: Git ref filters used to prune the returned references.
     Returns:
-      The unique identifier assigned to this entry if successful. None
-      otherwise.
+      The unique identifier assigned to this entry if successful. When only
+      the heartbeat was updated, the unique identifier of the latest entry.
+      None otherwise.
     """
     poll_journal_uuid = uuid.uuid4()
 
-    async with self.db_pool.acquire() as conn:
-      insert_status = await conn.execute(
-          '''INSERT INTO git_poll_journal (
-            git_poll_uuid, update_time, url, alias, previous_uuid, refs,
-            ref_filters)
-          VALUES ($1, $2, $3, $4, $5, $6, $7);
-          ''', poll_journal_uuid, utc_datetime, url, alias, previous_uuid,
+    state = self._ref_state.get(alias)
+    changes = None
+    if state and refs is not state.refs and (
+        self.heartbeat_unchanged or self.checkpoint_interval > 1):
+      changes = git_patrol_refs.diff_refs(state.refs, refs)
+    if self.heartbeat_unchanged and state and (
+        refs is state.refs or changes == ({}, [])):
+      # Keep the refs just polled so the next unchanged poll matches them by
+      # identity.
+      self._ref_state[alias] = state._replace(refs=refs)
+      return await self._record_heartbeat(
+          utc_datetime, url, alias, state.latest_uuid)
+
+    # Record only the changes since the previous entry unless it is time for a
+    # new full snapshot. A checkpoint is also needed whenever the previous refs
+    # for this alias are unknown.
+    if (self.checkpoint_interval > 1 and state and
+        state.deltas < self.checkpoint_interval - 1):
+      changed_refs, deleted_refs = changes or ({}, [])
+      changed_refs = [
+          [refname, commit] for (refname, commit) in changed_refs.items()]
+      if self.write_behind:
+        self._ref_state[alias] = _AliasRefState(
+            state.checkpoint_uuid, state.deltas + 1, refs, poll_journal_uuid)
+        await self._buffer('git_poll_journal', (
+            poll_journal_uuid, utc_datetime, url, alias, previous_uuid,
+            changed_refs, ref_filters, state.checkpoint_uuid, deleted_refs))
+        return poll_journal_uuid
+      async with self._acquire() as conn:
+        with git_patrol_metrics.timer(
+            git_patrol_metrics.DB_WRITE_SECONDS.labels('git_poll_journal')):
+          insert_status = await conn.execute(
+              '''INSERT INTO git_poll_journal (
+                git_poll_uuid, update_time, url, alias, previous_uuid, refs,
+                ref_filters, checkpoint_uuid, deleted_refs)
+              VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9);
+              ''', poll_journal_uuid, utc_datetime, url, alias, previous_uuid,
+              changed_refs, ref_filters, state.checkpoint_uuid, deleted_refs)
+      if insert_status == 'INSERT 0 1':
+        self._ref_state[alias] = _AliasRefState(
+            state.checkpoint_uuid, state.deltas + 1, refs, poll_journal_uuid)
+        return poll_journal_uuid
+      return None
+
+    if self.write_behind:
+      self._ref_state[alias] = _AliasRefState(
+          poll_journal_uuid, 0, refs, poll_journal_uuid)
+      await self._buffer('git_poll_journal', (
+          poll_journal_uuid, utc_datetime, url, alias, previous_uuid,
           [[refname, commit] for (refname, commit) in refs.items()],
-          ref_filters)
+          ref_filters, None, None))
+      return poll_journal_uuid
+
+    async with self._acquire() as conn:
+      with git_patrol_metrics.timer(
+          git_patrol_metrics.DB_WRITE_SECONDS.labels('git_poll_journal')):
+        insert_status = await conn.execute(
+            '''INSERT INTO git_poll_journal (
+              git_poll_uuid, update_time, url, alias, previous_uuid, refs,
+              ref_filters)
+            VALUES ($1, $2, $3, $4, $5, $6, $7);
+            ''', poll_journal_uuid, utc_datetime, url, alias, previous_uuid,
+            [[refname, commit] for (refname, commit) in refs.items()],
+            ref_filters)
       if insert_status == 'INSERT 0 1':
+        self._ref_state[alias] = _AliasRefState(
+            poll_journal_uuid, 0, refs, poll_journal_uuid)
         return poll_journal_uuid
 
+  async def _record_heartbeat(self, utc_datetime, url, alias, latest_uuid):
+    """Record an unchanged poll in the git_poll_heartbeat table.
+
+    Returns:
+      latest_uuid if successful. None otherwise.
+    """
+    if self.write_behind:
+      # Only the latest heartbeat of each alias needs to be written, along
+      # with the number of polls it stands for.
+      previous = self._heartbeats.get(alias)
+      polls = previous[4] + 1 if previous else 1
+      self._heartbeats[alias] = (alias, latest_uuid, utc_datetime, url, polls)
+      self._schedule_flush()
+      return latest_uuid
+
+    async with self._acquire() as conn:
+      with git_patrol_metrics.timer(
+          git_patrol_metrics.DB_WRITE_SECONDS.labels('git_poll_heartbeat')):
+        upsert_status = await conn.execute(
+            HEARTBEAT_UPSERT, alias, latest_uuid, utc_datetime, url, 1)
+    if upsert_status == 'INSERT 0 1':
+      return latest_uuid
+    return None
+
   async def record_cloud_build(
       self, parent_id, git_poll_uuid, utc_datetime, alias, ref,
-      cloud_build_status):
+      cloud_build_status, workflow=None):
     """Update the Cloud Build journal with the current build status.
 
     Args:
@@ -100,17 +510,303 @@ class GitPatrolDb:
       alias: Human readable alias for the repository.
       ref: Git reference name and commit hash that triggered this build.
       cloud_build_status: Cloud Build status JSON.
+      workflow: Alias of the workflow this entry is about, if known. Only
+        recorded with record_workflows.
     Returns:
       The unique identifier assigned to this entry if successful. None
       otherwise.
     """
-    async with self.db_pool.acquire() as conn:
-      journal_id = await conn.fetchval(
-          '''INSERT INTO cloud_build_journal (
-            parent_id, git_poll_uuid, update_time, alias, ref,
-            cloud_build_status)
-          VALUES ($1, $2, $3, $4, $5, $6)
-          RETURNING journal_id;
-          ''', parent_id, git_poll_uuid, utc_datetime, alias, ref,
-          json.dumps(cloud_build_status))
+    if self.write_behind:
+      journal_id = await self._reserve_journal_id()
+      record = (
+          journal_id, parent_id, git_poll_uuid, utc_datetime, alias,
+          list(ref), json.dumps(cloud_build_status))
+      if self.record_workflows:
+        record += (workflow,)
+      await self._buffer('cloud_build_journal', record)
       return journal_id
+
+    async with self._acquire() as conn:
+      with git_patrol_metrics.timer(
+          git_patrol_metrics.DB_WRITE_SECONDS.labels('cloud_build_journal')):
+        if not self.record_workflows:
+          return await conn.fetchval(
+              '''INSERT INTO cloud_build_journal (
+                parent_id, git_poll_uuid, update_time, alias, ref,
+                cloud_build_status)
+              VALUES ($1, $2, $3, $4, $5, $6)
+              RETURNING journal_id;
+              ''', parent_id, git_poll_uuid, utc_datetime, alias, ref,
+              json.dumps(cloud_build_status))
+        journal_id = await conn.fetchval(
+            '''INSERT INTO cloud_build_journal (
+              parent_id, git_poll_uuid, update_time, alias, ref,
+              cloud_build_status, workflow)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            RETURNING journal_id;
+            ''', parent_id, git_poll_uuid, utc_datetime, alias, ref,
+            json.dumps(cloud_build_status), workflow)
+      return journal_id
+
+  async def _reserve_journal_id(self):
+    """Returns an unused Cloud Build journal ID from a reserved block."""
+    if not self._journal_ids:
+      async with self._acquire() as conn:
+        rows = await conn.fetch(
+            '''SELECT nextval('cloud_build_journal_journal_id_seq') AS id
+            FROM generate_series(1, $1);
+            ''', self.flush_rows)
+      self._journal_ids.extend(row['id'] for row in rows)
+    return self._journal_ids.popleft()
+
+  async def _buffer(self, table, record):
+    """Add a journal entry to the write-behind buffer."""
+    self._pending.append((table, record))
+    if len(self._pending) >= self.flush_rows:
+      await self.flush()
+    else:
+      self._schedule_flush()
+
+  def _schedule_flush(self):
+    if not self._flush_task or self._flush_task.done():
+      self._flush_task = asyncio.ensure_future(self._flush_later())
+
+  async def _flush_later(self):
+    await asyncio.sleep(self.flush_interval)
+    try:
+      # Cancelling the timer must not interrupt a write in progress.
+      await asyncio.shield(self.flush())
+    except Exception as e:
+      # The entries stay buffered and are retried by the next flush.
+      logger.warning('Failed to write journal entries: %s', e)
+      if self._pending or self._heartbeats:
+        self._flush_task = asyncio.ensure_future(self._flush_later())
+
+  async def flush(self):
+    """Write all buffered journal entries to the database.
+
+    Git poll journal entries are written before Cloud Build journal entries
+    since the latter refer to the former. Entries of each journal are written
+    in the order they were recorded. Heartbeats are written last. Entries that
+    fail to be written stay buffered.
+    """
+    async with self._flush_lock:
+      pending, self._pending = self._pending, []
+      heartbeats, self._heartbeats = self._heartbeats, {}
+      if not pending and not heartbeats:
+        return
+      try:
+        async with self._acquire() as conn:
+          with git_patrol_metrics.timer(
+              git_patrol_metrics.DB_WRITE_SECONDS.labels('batch')):
+            async with conn.transaction():
+              cloud_build_columns = CLOUD_BUILD_JOURNAL_COLUMNS
+              if self.record_workflows:
+                cloud_build_columns = cloud_build_columns + ['workflow']
+              for (table, columns) in [
+                  ('git_poll_journal', GIT_POLL_JOURNAL_COLUMNS),
+                  ('cloud_build_journal', cloud_build_columns)]:
+                records = [record for (t, record) in pending if t == table]
+                if records:
+                  await conn.copy_records_to_table(
+                      table, records=records, columns=columns)
+              if heartbeats:
+                await conn.executemany(
+                    HEARTBEAT_UPSERT, list(heartbeats.values()))
+      except BaseException:
+        self._pending = pending + self._pending
+        # Newer heartbeats replace the unwritten ones but keep counting their
+        # polls.
+        for (alias, heartbeat) in self._heartbeats.items():
+          if alias in heartbeats:
+            heartbeat = heartbeat[:4] + (heartbeat[4] + heartbeats[alias][4],)
+          heartbeats[alias] = heartbeat
+        self._heartbeats = heartbeats
+        raise
+
+  async def close(self):
+    """Write any buffered journal entries. Call before shutting down.
+
+    Also saves the latest git refs of every alias to the ref cache, if any.
+    """
+    if self._flush_task and not self._flush_task.done():
+      self._flush_task.cancel()
+    await self.flush()
+    if self.ref_cache:
+      self.ref_cache.save(self._ref_state)
+
+  async def migrate(self, migrations_path):
+    """Apply the pending schema migrations.
+
+    Migrations are the .sql files in migrations_path. They are applied in file
+    name order and recorded in the schema_migrations table so each is applied
+    once. All pending migrations are applied in a single transaction while
+    holding an advisory lock, so concurrently starting instances don't race.
+
+    Args:
+      migrations_path: Folder holding the migration files.
+    Returns:
+      The list of applied migration versions (file names without extension).
+    """
+    versions = sorted(
+        name[:-len('.sql')] for name in os.listdir(migrations_path)
+        if name.endswith('.sql'))
+    applied_versions = []
+    async with self._acquire() as conn:
+      async with conn.transaction():
+        await conn.execute(
+            'SELECT pg_advisory_xact_lock($1);', MIGRATION_LOCK_ID)
+        await conn.execute(
+            '''CREATE TABLE IF NOT EXISTS schema_migrations (
+              version text PRIMARY KEY,
+              apply_time timestamp);
+            ''')
+        rows = await conn.fetch('SELECT version FROM schema_migrations;')
+        done = {row['version'] for row in rows}
+        for version in versions:
+          if version in done:
+            continue
+          with open(os.path.join(migrations_path, version + '.sql')) as f:
+            await conn.execute(f.read())
+          await conn.execute(
+              '''INSERT INTO schema_migrations (version, apply_time)
+              VALUES ($1, $2);
+              ''', version, datetime.datetime.utcnow())
+          applied_versions.append(version)
+    return applied_versions
+
+  async def add_checkpoint_columns(self):
+    """Add the git poll journal columns of delta entries if they are missing.
+
+    Every read of the git refs selects these columns, so unlike the other
+    migrations this one can't wait for --db_migrate. Adding nullable columns
+    only changes the table's metadata.
+
+    Returns:
+      True if the columns had to be added.
+    """
+    async with self._acquire() as conn:
+      rows = await conn.fetch(
+          '''SELECT column_name FROM information_schema.columns
+          WHERE table_schema = ANY(current_schemas(false))
+            AND table_name = 'git_poll_journal'
+            AND column_name = ANY($1::text[]);
+          ''', ['checkpoint_uuid', 'deleted_refs'])
+      if len(rows) == 2:
+        return False
+      await conn.execute(
+          '''ALTER TABLE git_poll_journal
+            ADD COLUMN IF NOT EXISTS checkpoint_uuid uuid,
+            ADD COLUMN IF NOT EXISTS deleted_refs text[];
+          ''')
+    return True
+
+  async def ensure_partitions(self, utc_datetime, months_ahead=2):
+    """Create the monthly journal partitions for the coming months.
+
+    Rows without a matching partition land in the default partition, which
+    prevents creating the partition for their month later on. Run this well
+    ahead of each month. Does nothing for unpartitioned journals. Requires the
+    migrations to be applied.
+
+    Args:
+      utc_datetime: Current time in UTC time zone.
+      months_ahead: Number of months after the current one to cover.
+    """
+    async with self._acquire() as conn:
+      for journal in PARTITIONED_JOURNALS:
+        await conn.execute(
+            '''SELECT git_patrol_create_journal_partitions(
+              $1::text::regclass, $2, $2 + make_interval(months => $3));
+            ''', journal, utc_datetime, months_ahead)
+
+  async def renew_instance(self, instance_id, lease_seconds):
+    """Record that an instance is alive and list the live instances.
+
+    Instances that haven't renewed within lease_seconds are forgotten. Their
+    target leases expire on their own.
+
+    Args:
+      instance_id: ID of the calling instance.
+      lease_seconds: Time in seconds after which silent instances are dead.
+    Returns:
+      The sorted list of IDs of the live instances, instance_id included.
+    """
+    async with self._acquire() as conn:
+      async with conn.transaction():
+        await conn.execute(
+            '''DELETE FROM patrol_instance
+            WHERE heartbeat_time <
+              now() AT TIME ZONE 'UTC' - make_interval(secs => $1);
+            ''', float(lease_seconds))
+        await conn.execute(
+            '''INSERT INTO patrol_instance (instance_id, heartbeat_time)
+            VALUES ($1, now() AT TIME ZONE 'UTC')
+            ON CONFLICT (instance_id) DO UPDATE SET
+              heartbeat_time = EXCLUDED.heartbeat_time;
+            ''', instance_id)
+        rows = await conn.fetch(
+            'SELECT instance_id FROM patrol_instance ORDER BY instance_id;')
+    return [row['instance_id'] for row in rows]
+
+  async def acquire_target_leases(self, instance_id, aliases, lease_seconds):
+    """Acquire or renew the leases on many targets.
+
+    A lease is granted when it is free, expired or already held by the
+    instance. Expiry is judged by the database clock, so instances don't need
+    synchronized clocks.
+
+    Args:
+      instance_id: ID of the calling instance.
+      aliases: List of the target aliases to lease.
+      lease_seconds: Time in seconds the leases last unless renewed.
+    Returns:
+      The set of aliases the instance now holds a lease on.
+    """
+    if not aliases:
+      return set()
+    async with self._acquire() as conn:
+      rows = await conn.fetch(
+          '''INSERT INTO target_lease (alias, instance_id, expire_time)
+          SELECT alias, $2,
+            now() AT TIME ZONE 'UTC' + make_interval(secs => $3)
+          FROM unnest($1::text[]) AS alias
+          ON CONFLICT (alias) DO UPDATE SET
+            instance_id = EXCLUDED.instance_id,
+            expire_time = EXCLUDED.expire_time
+          WHERE target_lease.instance_id = EXCLUDED.instance_id
+            OR target_lease.expire_time < now() AT TIME ZONE 'UTC'
+          RETURNING alias;
+          ''', list(aliases), instance_id, float(lease_seconds))
+    return set(row['alias'] for row in rows)
+
+  async def release_target_leases(self, instance_id, aliases):
+    """Give up the leases an instance holds on some targets.
+
+    Buffered journal entries are written first, so the next holder of a
+    lease starts from the latest git refs.
+
+    Args:
+      instance_id: ID of the calling instance.
+      aliases: List of the target aliases to release.
+    """
+    await self.flush()
+    async with self._acquire() as conn:
+      await conn.execute(
+          '''DELETE FROM target_lease
+          WHERE instance_id = $1 AND alias = ANY($2::text[]);
+          ''', instance_id, list(aliases))
+
+  async def remove_instance(self, instance_id):
+    """Forget an instance that is shutting down and release all its leases.
+
+    Args:
+      instance_id: ID of the calling instance.
+    """
+    await self.flush()
+    async with self._acquire() as conn:
+      async with conn.transaction():
+        await conn.execute(
+            'DELETE FROM target_lease WHERE instance_id = $1;', instance_id)
+        await conn.execute(
+            'DELETE FROM patrol_instance WHERE instance_id = $1;', instance_id)
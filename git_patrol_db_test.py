@@ -15,10 +15,15 @@
 """Tests for Git Patrol database library."""
 
 import asyncio
+import datetime
+import os
+import shutil
+import tempfile
 import unittest
 from unittest import mock
 import uuid
 
+import git_patrol_cache
 import git_patrol_db
 
 
@@ -48,9 +53,15 @@ class MockAsyncpgConnection:
   `asyncpg.Pool.acquire` inside an `async with` statement.
   """
 
-  def __init__(self, fetchrow=None, execute=None):
+  def __init__(
+      self, fetch=None, fetchrow=None, execute=None,
+      copy_records_to_table=None, executemany=None, fetchval=None):
+    self.fetch = fetch
     self.fetchrow = fetchrow
+    self.fetchval = fetchval
     self.execute = execute
+    self.executemany = executemany
+    self.copy_records_to_table = copy_records_to_table
 
   async def __aenter__(self):
     return self
@@ -58,6 +69,9 @@ class MockAsyncpgConnection:
   async def __aexit__(self, exc_type, exc, tb):
     pass
 
+  def transaction(self):
+    return self
+
 
 class MockAsyncpgPool:
   """Mock object to use instead of asyncpg.Pool.
@@ -78,7 +92,8 @@ class GitPatrolDbTest(unittest.TestCase):
     expected_refs = [['refs/tags/r0000', 'abcd'], ['refs/tags/r0001', 'fghi']]
 
     mock_fetchrow = AsyncioMock(return_value=(
-        {'git_poll_uuid': expected_uuid, 'refs': expected_refs}))
+        {'git_poll_uuid': expected_uuid, 'update_time': None,
+         'checkpoint_uuid': None, 'refs': expected_refs}))
 
     mock_connection = MockAsyncpgConnection(fetchrow=mock_fetchrow)
     mock_pool = MockAsyncpgPool(connection=mock_connection)
@@ -112,6 +127,387 @@ class GitPatrolDbTest(unittest.TestCase):
         unittest.mock.ANY, unittest.mock.ANY, prev_uuid,
         [[item[0], item[1]] for item in refs.items()], ref_filters)
 
+  def testFetchGitRefsFromDeltasSuccess(self):
+    checkpoint_uuid = uuid.uuid4()
+    expected_uuid = uuid.uuid4()
+
+    mock_fetchrow = AsyncioMock(return_value=(
+        {'git_poll_uuid': expected_uuid, 'update_time': None,
+         'checkpoint_uuid': checkpoint_uuid,
+         'refs': [['refs/tags/r0002', 'jklm']]}))
+    mock_fetch = AsyncioMock(return_value=[
+        {'refs': [['refs/heads/master', 'abcd'], ['refs/tags/r0000', 'abcd']],
+         'deleted_refs': None},
+        {'refs': [['refs/heads/master', 'fghi'], ['refs/tags/r0001', 'fghi']],
+         'deleted_refs': ['refs/tags/r0000']},
+        {'refs': [['refs/tags/r0002', 'jklm']], 'deleted_refs': []}])
+
+    mock_connection = MockAsyncpgConnection(
+        fetch=mock_fetch, fetchrow=mock_fetchrow)
+    mock_pool = MockAsyncpgPool(connection=mock_connection)
+
+    db = git_patrol_db.GitPatrolDb(mock_pool, checkpoint_interval=10)
+    actual_uuid, actual_refs = asyncio.get_event_loop().run_until_complete(
+        db.fetch_latest_refs_by_alias('sdm845'))
+    self.assertEqual(actual_uuid, expected_uuid)
+    self.assertEqual(
+        actual_refs,
+        {'refs/heads/master': 'fghi', 'refs/tags/r0001': 'fghi',
+         'refs/tags/r0002': 'jklm'})
+
+    mock_fetch.inner_mock.assert_called_with(
+        unittest.mock.ANY, 'sdm845', checkpoint_uuid, None)
+
+  def testFetchGitRefsByAliasesSuccess(self):
+    full_uuid = uuid.uuid4()
+    checkpoint_uuid = uuid.uuid4()
+    delta_uuid = uuid.uuid4()
+
+    mock_fetch = AsyncioMock(side_effect=[
+        [{'alias': 'full', 'git_poll_uuid': full_uuid, 'update_time': None,
+          'checkpoint_uuid': None, 'refs': [['refs/heads/master', 'abcd']]},
+         {'alias': 'delta', 'git_poll_uuid': delta_uuid, 'update_time': None,
+          'checkpoint_uuid': checkpoint_uuid,
+          'refs': [['refs/tags/r0001', 'fghi']]}],
+        [{'alias': 'delta', 'refs': [['refs/tags/r0000', 'abcd']],
+          'deleted_refs': None},
+         {'alias': 'delta', 'refs': [['refs/tags/r0001', 'fghi']],
+          'deleted_refs': ['refs/tags/r0000']}]])
+
+    mock_connection = MockAsyncpgConnection(fetch=mock_fetch)
+    mock_pool = MockAsyncpgPool(connection=mock_connection)
+
+    db = git_patrol_db.GitPatrolDb(mock_pool, checkpoint_interval=10)
+    states = asyncio.get_event_loop().run_until_complete(
+        db.fetch_latest_refs_by_aliases(['full', 'delta', 'missing']))
+    self.assertEqual(
+        states,
+        {'full': (full_uuid, {'refs/heads/master': 'abcd'}),
+         'delta': (delta_uuid, {'refs/tags/r0001': 'fghi'})})
+
+    # One query for the latest entries and one to replay all deltas.
+    fetch_args = [args for (args, _) in mock_fetch.inner_mock.call_args_list]
+    self.assertEqual(len(fetch_args), 2)
+    self.assertEqual(fetch_args[0][1], ['full', 'delta', 'missing'])
+    self.assertEqual(
+        fetch_args[1][1:], (['delta'], [checkpoint_uuid], [None]))
+
+  def testFetchGitRefsByAliasesFromCache(self):
+    cached_uuid = uuid.uuid4()
+    stale_uuid = uuid.uuid4()
+    latest_uuid = uuid.uuid4()
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    ref_cache = git_patrol_cache.RefStateCache(
+        os.path.join(temp_dir, 'refs.db'))
+    self.addCleanup(ref_cache.close)
+    ref_cache.save({
+        'cached': (cached_uuid, 0, {'refs/heads/master': 'abcd'}, cached_uuid),
+        'stale': (stale_uuid, 0, {'refs/heads/master': 'abcd'}, stale_uuid)})
+
+    mock_fetch = AsyncioMock(side_effect=[
+        [{'alias': 'cached', 'git_poll_uuid': cached_uuid},
+         {'alias': 'stale', 'git_poll_uuid': latest_uuid}],
+        [{'alias': 'stale', 'git_poll_uuid': latest_uuid, 'update_time': None,
+          'checkpoint_uuid': None, 'refs': [['refs/heads/master', 'fghi']]}]])
+    mock_connection = MockAsyncpgConnection(fetch=mock_fetch)
+    mock_pool = MockAsyncpgPool(connection=mock_connection)
+
+    db = git_patrol_db.GitPatrolDb(mock_pool, ref_cache=ref_cache)
+    states = asyncio.get_event_loop().run_until_complete(
+        db.fetch_latest_refs_by_aliases(['cached', 'stale', 'missing']))
+    self.assertEqual(
+        states,
+        {'cached': (cached_uuid, {'refs/heads/master': 'abcd'}),
+         'stale': (latest_uuid, {'refs/heads/master': 'fghi'})})
+
+    # Only the aliases without a current cache entry are read in full.
+    fetch_args = [args for (args, _) in mock_fetch.inner_mock.call_args_list]
+    self.assertEqual(len(fetch_args), 2)
+    self.assertEqual(fetch_args[0][1], ['cached', 'stale'])
+    self.assertEqual(fetch_args[1][1], ['stale', 'missing'])
+
+    # Closing saves the refs just read for the next start.
+    asyncio.get_event_loop().run_until_complete(db.close())
+    self.assertEqual(
+        ref_cache.load(['stale'])['stale'],
+        (latest_uuid, 0, {'refs/heads/master': 'fghi'}, latest_uuid))
+
+  def testFetchChangeTimesByAliases(self):
+    newer = datetime.datetime(2019, 1, 2)
+    older = datetime.datetime(2019, 1, 1)
+    mock_fetch = AsyncioMock(return_value=[
+        {'alias': 'busy', 'update_time': newer},
+        {'alias': 'busy', 'update_time': older},
+        {'alias': 'quiet', 'update_time': older}])
+    mock_connection = MockAsyncpgConnection(fetch=mock_fetch)
+    mock_pool = MockAsyncpgPool(connection=mock_connection)
+
+    db = git_patrol_db.GitPatrolDb(mock_pool)
+    change_times = asyncio.get_event_loop().run_until_complete(
+        db.fetch_change_times_by_aliases(['busy', 'quiet', 'missing'], 10))
+    self.assertEqual(
+        change_times, {'busy': [newer, older], 'quiet': [older]})
+    args, _ = mock_fetch.inner_mock.call_args
+    self.assertEqual(args[1:], (['busy', 'quiet', 'missing'], 10))
+
+  def testFetchUnfinishedWorkflows(self):
+    git_poll_uuid = uuid.uuid4()
+    mock_fetch = AsyncioMock(return_value=[
+        {'journal_id': 7, 'git_poll_uuid': git_poll_uuid, 'alias': 'alias',
+         'ref': ['refs/heads/master', 'abcde'], 'workflow': 'build',
+         'cloud_build_status': '{"id": "1234", "status": "WORKING"}'}])
+    mock_connection = MockAsyncpgConnection(fetch=mock_fetch)
+    mock_pool = MockAsyncpgPool(connection=mock_connection)
+
+    db = git_patrol_db.GitPatrolDb(mock_pool)
+    since = datetime.datetime(2019, 1, 1)
+    rows = asyncio.get_event_loop().run_until_complete(
+        db.fetch_unfinished_workflows(['alias'], since))
+    self.assertEqual(len(rows), 1)
+    self.assertEqual(rows[0]['workflow'], 'build')
+    self.assertEqual(
+        rows[0]['cloud_build_status'], {'id': '1234', 'status': 'WORKING'})
+    args, _ = mock_fetch.inner_mock.call_args
+    self.assertEqual(args[1:], (['alias'], since))
+
+  def testRecordGitPollDeltaSuccess(self):
+    mock_execute = AsyncioMock(return_value='INSERT 0 1')
+    mock_connection = MockAsyncpgConnection(execute=mock_execute)
+    mock_pool = MockAsyncpgPool(connection=mock_connection)
+
+    refs0 = {
+        'refs/heads/master': 'abcde', 'refs/tags/r0001': 'abcde',
+        'refs/tags/r0002': 'defgh'}
+    refs1 = {
+        'refs/heads/master': 'ijklm', 'refs/tags/r0001': 'abcde',
+        'refs/tags/r0003': 'ijklm'}
+    ref_filters = []
+
+    db = git_patrol_db.GitPatrolDb(mock_pool, checkpoint_interval=2)
+    loop = asyncio.get_event_loop()
+
+    # The first entry must be a full checkpoint since no previous refs are
+    # known for the alias.
+    checkpoint_uuid = loop.run_until_complete(
+        db.record_git_poll(None, None, 'sdm845', None, refs0, ref_filters))
+    mock_execute.inner_mock.assert_called_with(
+        unittest.mock.ANY, checkpoint_uuid, unittest.mock.ANY,
+        unittest.mock.ANY, unittest.mock.ANY, None,
+        [[item[0], item[1]] for item in refs0.items()], ref_filters)
+
+    # The second entry only records the changes.
+    delta_uuid = loop.run_until_complete(
+        db.record_git_poll(
+            None, None, 'sdm845', checkpoint_uuid, refs1, ref_filters))
+    mock_execute.inner_mock.assert_called_with(
+        unittest.mock.ANY, delta_uuid, unittest.mock.ANY, unittest.mock.ANY,
+        unittest.mock.ANY, checkpoint_uuid,
+        [['refs/heads/master', 'ijklm'], ['refs/tags/r0003', 'ijklm']],
+        ref_filters, checkpoint_uuid, ['refs/tags/r0002'])
+
+    # The checkpoint interval has elapsed so the third entry is a full
+    # snapshot again.
+    poll_uuid = loop.run_until_complete(
+        db.record_git_poll(None, None, 'sdm845', None, refs1, ref_filters))
+    mock_execute.inner_mock.assert_called_with(
+        unittest.mock.ANY, poll_uuid, unittest.mock.ANY, unittest.mock.ANY,
+        unittest.mock.ANY, None,
+        [[item[0], item[1]] for item in refs1.items()], ref_filters)
+
+  def testMigrateAppliesPendingMigrations(self):
+    migrations_path = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, migrations_path, ignore_errors=True)
+    for (name, sql) in [('0002_second.sql', 'SELECT 2;'),
+                        ('0001_first.sql', 'SELECT 1;'),
+                        ('README', 'Not a migration.')]:
+      with open(os.path.join(migrations_path, name), 'w') as f:
+        f.write(sql)
+
+    mock_fetch = AsyncioMock(return_value=[{'version': '0001_first'}])
+    mock_execute = AsyncioMock(return_value='OK')
+    mock_connection = MockAsyncpgConnection(
+        fetch=mock_fetch, execute=mock_execute)
+    mock_pool = MockAsyncpgPool(connection=mock_connection)
+
+    db = git_patrol_db.GitPatrolDb(mock_pool)
+    applied = asyncio.get_event_loop().run_until_complete(
+        db.migrate(migrations_path))
+    self.assertEqual(applied, ['0002_second'])
+
+    # Only the pending migration runs, and it gets recorded.
+    executed = [args for (args, _) in mock_execute.inner_mock.call_args_list]
+    self.assertIn(('SELECT 2;',), executed)
+    self.assertNotIn(('SELECT 1;',), executed)
+    self.assertEqual(executed[-1][1], '0002_second')
+
+  def testAddCheckpointColumns(self):
+    mock_fetch = AsyncioMock(side_effect=[
+        [{'column_name': 'checkpoint_uuid'}],
+        [{'column_name': 'checkpoint_uuid'}, {'column_name': 'deleted_refs'}]])
+    mock_execute = AsyncioMock(return_value='ALTER TABLE')
+    mock_connection = MockAsyncpgConnection(
+        fetch=mock_fetch, execute=mock_execute)
+    mock_pool = MockAsyncpgPool(connection=mock_connection)
+
+    db = git_patrol_db.GitPatrolDb(mock_pool)
+    added = asyncio.get_event_loop().run_until_complete(
+        db.add_checkpoint_columns())
+    self.assertTrue(added)
+    args, _ = mock_execute.inner_mock.call_args
+    self.assertIn('ADD COLUMN IF NOT EXISTS deleted_refs', args[0])
+
+    # Nothing is altered once both columns exist.
+    added = asyncio.get_event_loop().run_until_complete(
+        db.add_checkpoint_columns())
+    self.assertFalse(added)
+    self.assertEqual(mock_execute.inner_mock.call_count, 1)
+
+  def testWriteBehindBatchesJournalEntries(self):
+    mock_fetch = AsyncioMock(
+        side_effect=[[{'id': 10}, {'id': 11}, {'id': 12}]])
+    mock_execute = AsyncioMock(return_value='INSERT 0 1')
+    mock_copy = AsyncioMock(return_value='COPY 1')
+    mock_connection = MockAsyncpgConnection(
+        fetch=mock_fetch, execute=mock_execute,
+        copy_records_to_table=mock_copy)
+    mock_pool = MockAsyncpgPool(connection=mock_connection)
+
+    db = git_patrol_db.GitPatrolDb(
+        mock_pool, write_behind=True, flush_rows=3, flush_interval=3600)
+    refs = {'refs/heads/master': 'abcde'}
+    ref = ['refs/heads/master', 'abcde']
+
+    async def record_entries():
+      poll_uuid = await db.record_git_poll(None, 'url', 'alias', None, refs, [])
+      first_id = await db.record_cloud_build(
+          0, poll_uuid, None, 'alias', ref, {'status': 'QUEUED'})
+      # Nothing is written until the buffer fills up.
+      self.assertFalse(mock_copy.inner_mock.called)
+      second_id = await db.record_cloud_build(
+          first_id, poll_uuid, None, 'alias', ref, {'status': 'SUCCESS'})
+      third_id = await db.record_cloud_build(
+          0, poll_uuid, None, 'alias', ref, {'status': 'QUEUED'})
+      await db.close()
+      return poll_uuid, [first_id, second_id, third_id]
+
+    poll_uuid, journal_ids = asyncio.get_event_loop().run_until_complete(
+        record_entries())
+    self.assertEqual(journal_ids, [10, 11, 12])
+    mock_execute.inner_mock.assert_not_called()
+
+    # One batch when the buffer filled up, git poll entries first, and one
+    # more for the remaining entry on close.
+    copy_calls = [
+        (args[0], [record[0] for record in kwargs['records']])
+        for (args, kwargs) in mock_copy.inner_mock.call_args_list]
+    self.assertEqual(
+        copy_calls,
+        [('git_poll_journal', [poll_uuid]),
+         ('cloud_build_journal', [10, 11]),
+         ('cloud_build_journal', [12])])
+
+  def testRecordCloudBuildWorkflow(self):
+    mock_fetchval = AsyncioMock(return_value=1)
+    mock_connection = MockAsyncpgConnection(fetchval=mock_fetchval)
+    mock_pool = MockAsyncpgPool(connection=mock_connection)
+    ref = ['refs/heads/master', 'abcde']
+
+    async def record_entries():
+      for record_workflows in (False, True):
+        db = git_patrol_db.GitPatrolDb(
+            mock_pool, record_workflows=record_workflows)
+        await db.record_cloud_build(
+            0, uuid.uuid4(), None, 'alias', ref, {'status': 'QUEUED'},
+            workflow='build')
+
+    asyncio.get_event_loop().run_until_complete(record_entries())
+
+    # The workflow column is only written when recording workflows, so
+    # databases without it keep working.
+    calls = mock_fetchval.inner_mock.call_args_list
+    self.assertNotIn('workflow', calls[0][0][0])
+    self.assertEqual(len(calls[0][0]), 7)
+    self.assertIn('workflow', calls[1][0][0])
+    self.assertEqual(calls[1][0][-1], 'build')
+
+  def testHeartbeatUnchangedPolls(self):
+    mock_execute = AsyncioMock(return_value='INSERT 0 1')
+    mock_connection = MockAsyncpgConnection(execute=mock_execute)
+    mock_pool = MockAsyncpgPool(connection=mock_connection)
+
+    db = git_patrol_db.GitPatrolDb(mock_pool, heartbeat_unchanged=True)
+    refs = {'refs/heads/master': 'abcde'}
+
+    async def record_polls():
+      first_uuid = await db.record_git_poll(
+          None, 'url', 'alias', None, refs, [])
+      second_uuid = await db.record_git_poll(
+          None, 'url', 'alias', None, dict(refs), [])
+      third_uuid = await db.record_git_poll(
+          None, 'url', 'alias', None, {'refs/heads/master': 'fghij'}, [])
+      return first_uuid, second_uuid, third_uuid
+
+    first_uuid, second_uuid, third_uuid = (
+        asyncio.get_event_loop().run_until_complete(record_polls()))
+
+    # The unchanged poll refers back to the first journal entry.
+    self.assertEqual(second_uuid, first_uuid)
+    self.assertNotEqual(third_uuid, first_uuid)
+    queries = [args[0] for (args, _) in mock_execute.inner_mock.call_args_list]
+    self.assertEqual(len(queries), 3)
+    self.assertIn('git_poll_journal', queries[0])
+    self.assertIn('git_poll_heartbeat', queries[1])
+    self.assertEqual(
+        mock_execute.inner_mock.call_args_list[1][0][1:],
+        ('alias', first_uuid, None, 'url', 1))
+    self.assertIn('git_poll_journal', queries[2])
+
+  def testHeartbeatSameRefsSkipsDiff(self):
+    mock_execute = AsyncioMock(return_value='INSERT 0 1')
+    mock_copy = AsyncioMock(return_value='COPY 1')
+    mock_executemany = AsyncioMock(return_value=None)
+    mock_connection = MockAsyncpgConnection(
+        execute=mock_execute, copy_records_to_table=mock_copy,
+        executemany=mock_executemany)
+    mock_pool = MockAsyncpgPool(connection=mock_connection)
+
+    db = git_patrol_db.GitPatrolDb(
+        mock_pool, heartbeat_unchanged=True, write_behind=True,
+        flush_rows=100, flush_interval=3600)
+    refs = {'refs/heads/master': 'abcde'}
+
+    async def record_polls():
+      first_uuid = await db.record_git_poll(
+          None, 'url', 'alias', None, refs, [])
+      with mock.patch.object(
+          git_patrol_db.git_patrol_refs, 'diff_refs') as mock_diff:
+        for _ in range(3):
+          await db.record_git_poll(None, 'url', 'alias', None, refs, [])
+      mock_diff.assert_not_called()
+      await db.flush()
+      return first_uuid
+
+    first_uuid = asyncio.get_event_loop().run_until_complete(record_polls())
+
+    # The three heartbeats are written once and count every poll.
+    args, _ = mock_executemany.inner_mock.call_args
+    self.assertIn('git_poll_heartbeat', args[0])
+    self.assertEqual(args[1], [('alias', first_uuid, None, 'url', 3)])
+
+  def testAcquireTargetLeases(self):
+    mock_fetch = AsyncioMock(return_value=[{'alias': 'free'}])
+    mock_connection = MockAsyncpgConnection(fetch=mock_fetch)
+    mock_pool = MockAsyncpgPool(connection=mock_connection)
+
+    db = git_patrol_db.GitPatrolDb(mock_pool)
+    held = asyncio.get_event_loop().run_until_complete(
+        db.acquire_target_leases('instance', ['free', 'taken'], 60))
+    self.assertEqual(held, {'free'})
+    args, _ = mock_fetch.inner_mock.call_args
+    self.assertIn('target_lease', args[0])
+    self.assertEqual(args[1:], (['free', 'taken'], 'instance', 60.0))
+
 
 if __name__ == '__main__':
   unittest.main()
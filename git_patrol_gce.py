@@ -22,19 +22,32 @@ necessarily live in the git_patrol library itself.
 
 import argparse
 import asyncio
+import datetime
 import logging
 import os
+import signal
+import socket
 import time
+import uuid
 import yaml
 
 import asyncpg
 import git_patrol
+import git_patrol_cache
+import git_patrol_cloud_build
 import git_patrol_db
+import git_patrol_http
+import git_patrol_lease
+import git_patrol_metrics
+import git_patrol_webhook
 
 
 DB_CONNECT_ATTEMPTS = 3
 DB_CONNECT_WAIT_SECS = 10
 
+# Time between checks that the coming months' journal partitions exist.
+DB_PARTITION_INTERVAL_SECS = 24 * 60 * 60
+
 
 # Route logs to StackDriver. The Google Cloud logging library enables logs
 # for INFO level by default.
@@ -51,6 +64,13 @@ except (ImportError, google.auth.exceptions.GoogleAuthError) as ex:
   logger.addHandler(logging.StreamHandler())
 
 
+async def partition_loop(db):
+  """Periodically create the journal partitions for the coming months."""
+  while True:
+    await db.ensure_partitions(datetime.datetime.utcnow())
+    await asyncio.sleep(DB_PARTITION_INTERVAL_SECS)
+
+
 def main():
   # Parse command line flags.
   parser = argparse.ArgumentParser()
@@ -59,6 +79,21 @@ def main():
       type=int,
       default=7200,
       help='Time between repository poll attempts in seconds.')
+  parser.add_argument(
+      '--adaptive_poll_interval',
+      action='store_true',
+      help=('Tune the poll interval of each target to how often it changes, '
+            'between --min_poll_interval and --max_poll_interval.'))
+  parser.add_argument(
+      '--min_poll_interval',
+      type=int,
+      default=300,
+      help='Shortest adaptive time between poll attempts in seconds.')
+  parser.add_argument(
+      '--max_poll_interval',
+      type=int,
+      default=86400,
+      help='Longest adaptive time between poll attempts in seconds.')
   parser.add_argument(
       '--config_path',
       required=True,
@@ -85,10 +120,215 @@ def main():
   parser.add_argument(
       '--db_name',
       help='Name of the database to access on the database server.')
+  parser.add_argument(
+      '--db_write_behind',
+      action='store_true',
+      help=('Buffer journal entries and write them to the database in batches '
+            'rather than one at a time.'))
+  parser.add_argument(
+      '--db_flush_rows',
+      type=int,
+      default=500,
+      help='Number of buffered journal entries that triggers a batch write.')
+  parser.add_argument(
+      '--db_flush_interval',
+      type=float,
+      default=1.0,
+      help='Maximum time in seconds a journal entry stays buffered.')
+  parser.add_argument(
+      '--db_heartbeat_unchanged_polls',
+      action='store_true',
+      help=('Only update a per-target heartbeat row, rather than adding a git '
+            'poll journal entry, when a poll finds no changes.'))
+  parser.add_argument(
+      '--db_migrate',
+      action='store_true',
+      help=('Apply pending schema migrations at startup and keep the monthly '
+            'journal partitions created ahead of time.'))
+  parser.add_argument(
+      '--db_migrations_path',
+      default=os.path.join(
+          os.path.dirname(os.path.abspath(__file__)), 'scripts', 'migrations'),
+      help='Path to the folder of schema migration files.')
+  parser.add_argument(
+      '--checkpoint_interval',
+      type=int,
+      default=1,
+      help=('Number of git poll journal entries between full snapshots of a '
+            'repository\'s git refs. Entries in between only record changes.'))
+  parser.add_argument(
+      '--max_concurrent_polls',
+      type=int,
+      default=8,
+      help='Maximum number of repository polls to run at the same time.')
+  parser.add_argument(
+      '--max_concurrent_polls_per_host',
+      type=int,
+      default=4,
+      help=('Maximum number of repository polls to run at the same time '
+            'against a single host. Zero for no limit.'))
+  parser.add_argument(
+      '--max_subprocesses',
+      type=int,
+      default=16,
+      help=('Maximum number of git and gcloud processes to run at the same '
+            'time. Zero for no limit.'))
+  parser.add_argument(
+      '--git_http_client',
+      action='store_true',
+      help=('List the refs of HTTP(S) repositories in-process instead of '
+            'running "git ls-remote" for every poll.'))
+  parser.add_argument(
+      '--max_refs',
+      type=int,
+      default=git_patrol.MAX_REFS,
+      help='Maximum number of git refs accepted from a single poll.')
+  parser.add_argument(
+      '--max_ref_bytes',
+      type=int,
+      default=git_patrol.MAX_REF_BYTES,
+      help='Maximum size in bytes of the git refs listing from a single poll.')
+  parser.add_argument(
+      '--cloud_build_api',
+      action='store_true',
+      help=('Start and wait for workflows through the Cloud Build REST API '
+            'instead of running "gcloud" for every build operation. '
+            'Credentials come from the metadata server.'))
+  parser.add_argument(
+      '--cloud_build_project',
+      help=('Google Cloud project to run builds in with --cloud_build_api. '
+            'Defaults to the project reported by the metadata server.'))
+  parser.add_argument(
+      '--build_watch_min_interval',
+      type=int,
+      default=git_patrol.BUILD_WATCH_MIN_INTERVAL_SECS,
+      help='Minimum time between build status checks in seconds.')
+  parser.add_argument(
+      '--build_watch_max_interval',
+      type=int,
+      default=git_patrol.BUILD_WATCH_MAX_INTERVAL_SECS,
+      help=('Maximum time between build status checks in seconds. Checks back '
+            'off towards this interval while no builds finish.'))
+  parser.add_argument(
+      '--max_concurrent_builds',
+      type=int,
+      default=10,
+      help=('Maximum number of Cloud Builds to run at the same time across all '
+            'targets. Zero for no limit.'))
+  parser.add_argument(
+      '--max_concurrent_builds_per_target',
+      type=int,
+      default=0,
+      help=('Default maximum number of Cloud Builds to run at the same time '
+            'for a single target. Targets override this with their '
+            'max_concurrent_builds config value. Zero for no limit.'))
+  parser.add_argument(
+      '--coalesce_superseded_refs',
+      action='store_true',
+      help=('Skip the queued and remaining workflows of a git ref once a newer '
+            'commit of the same git ref triggers them again.'))
+  parser.add_argument(
+      '--cancel_superseded_builds',
+      action='store_true',
+      help=('Like --coalesce_superseded_refs, but also cancel the running '
+            'build of superseded workflows.'))
+  parser.add_argument(
+      '--webhook_port',
+      type=int,
+      default=0,
+      help=('Port to receive push webhooks on. Webhooks trigger an immediate '
+            'poll of the matching targets. Zero disables webhooks.'))
+  parser.add_argument(
+      '--webhook_host',
+      default='127.0.0.1',
+      help=('Address to receive push webhooks on. Pass an empty string to '
+            'accept them on all interfaces.'))
+  parser.add_argument(
+      '--webhook_secret',
+      help=('Shared secret that webhook requests must be signed with, or pass '
+            'in their "token" query parameter.'))
+  parser.add_argument(
+      '--webhook_min_interval',
+      type=float,
+      default=10,
+      help=('Minimum time in seconds between two polls of a target triggered '
+            'by webhooks.'))
+  parser.add_argument(
+      '--metrics_port',
+      type=int,
+      default=0,
+      help=('Port to serve Prometheus metrics on. Requires the '
+            'prometheus_client library. Zero disables metrics.'))
+  parser.add_argument(
+      '--lease_seconds',
+      type=int,
+      default=0,
+      help=('Share the targets with the other instances using the same '
+            'database, each instance polling the targets it holds a lease on. '
+            'Leases and instances expire after this many seconds without '
+            'renewal. Zero polls every target from this instance.'))
+  parser.add_argument(
+      '--instance_id',
+      default='{}-{}'.format(socket.gethostname(), uuid.uuid4().hex[:8]),
+      help='Unique ID of this instance among those sharing the targets.')
+  parser.add_argument(
+      '--resume_workflows',
+      action='store_true',
+      help=('At startup, wait again for the builds left running by the '
+            'previous run and run the workflows it didn\'t get to.'))
+  parser.add_argument(
+      '--resume_workflows_hours',
+      type=int,
+      default=24,
+      help='Only resume workflows updated within this many hours.')
+  parser.add_argument(
+      '--ref_cache_path',
+      help=('Path of a local SQLite file caching the latest git refs of each '
+            'target between restarts, so startup only reads the git refs '
+            'that changed since from the database.'))
+  parser.add_argument(
+      '--shutdown_timeout',
+      type=float,
+      default=20,
+      help=('Time in seconds to let running workflows finish when shutting '
+            'down before cancelling them.'))
   args = parser.parse_args()
 
+  if args.resume_workflows and args.lease_seconds:
+    # The previous holder of a lease may still be running its workflows.
+    logger.error('--resume_workflows does not support --lease_seconds')
+    return
+  if args.ref_cache_path and args.lease_seconds:
+    # Targets are loaded one at a time as their leases are acquired.
+    logger.error('--ref_cache_path does not support --lease_seconds')
+    return
+
+  if args.metrics_port and not git_patrol_metrics.start_server(
+      args.metrics_port):
+    logger.warning('Metrics are disabled: prometheus_client is not installed')
+
   # Use actual subprocess commands in production.
-  commands = git_patrol.GitPatrolCommands()
+  commands = git_patrol.GitPatrolCommands(
+      max_subprocesses=args.max_subprocesses or None)
+  commands.max_refs = args.max_refs
+  commands.max_ref_bytes = args.max_ref_bytes
+  if args.git_http_client:
+    commands.git_http = git_patrol_http.GitSmartHttpClient()
+  if args.cloud_build_api:
+    http = git_patrol_http.HttpClient()
+    project = args.cloud_build_project or (
+        asyncio.get_event_loop().run_until_complete(
+            git_patrol_cloud_build.metadata_project_id(http)))
+    commands.cloud_build = git_patrol_cloud_build.CloudBuildClient(
+        project,
+        git_patrol_cloud_build.AccessTokenCache(
+            lambda: git_patrol_cloud_build.metadata_access_token(http)),
+        http_client=http)
+
+  # Wait for all in-flight builds with one shared status check.
+  commands.build_watcher = git_patrol.CloudBuildWatcher(
+      commands, min_interval=args.build_watch_min_interval,
+      max_interval=args.build_watch_max_interval)
 
   # Read and parse the configuration file.
   # TODO(brianorr): Parse the YAML into a well defined Python object to easily
@@ -97,6 +337,18 @@ def main():
     raw_config = f.read()
   git_patrol_config = yaml.safe_load(raw_config)
   git_patrol_targets = git_patrol_config['targets']
+  try:
+    schedules = [
+        git_patrol.TargetSchedule.from_config(
+            target_config, args.poll_interval)
+        for target_config in git_patrol_targets]
+    for target_config in git_patrol_targets:
+      git_patrol.workflow_needs(target_config)
+      if args.resume_workflows:
+        git_patrol.check_resumable(target_config)
+  except ValueError as e:
+    logger.error('Invalid configuration: %s', e)
+    return
 
   # Connect to the persistent state database.
   loop = asyncio.get_event_loop()
@@ -126,30 +378,143 @@ def main():
 
   if not db_pool:
     return
-  db = git_patrol_db.GitPatrolDb(db_pool)
+  db = git_patrol_db.GitPatrolDb(
+      db_pool, checkpoint_interval=args.checkpoint_interval,
+      write_behind=args.db_write_behind, flush_rows=args.db_flush_rows,
+      flush_interval=args.db_flush_interval,
+      heartbeat_unchanged=args.db_heartbeat_unchanged_polls,
+      ref_cache=(git_patrol_cache.RefStateCache(args.ref_cache_path)
+                 if args.ref_cache_path else None),
+      record_workflows=args.resume_workflows)
+  if args.db_migrate:
+    applied = loop.run_until_complete(db.migrate(args.db_migrations_path))
+    logger.info('Applied schema migrations: %s', applied)
+  try:
+    if loop.run_until_complete(db.add_checkpoint_columns()):
+      logger.info('Added the checkpoint columns to git_poll_journal')
+  except asyncpg.exceptions.PostgresError as e:
+    logger.error('Failed to add the checkpoint columns: %s', e)
+    return
+
+  # All target loops submit their polls through a shared scheduler to bound the
+  # number of git processes and remote requests in flight.
+  scheduler = git_patrol.PollScheduler(
+      max_workers=args.max_concurrent_polls,
+      max_per_host=args.max_concurrent_polls_per_host or None)
+
+  # Triggered workflows run in the background so polling continues while a
+  # burst of builds drains within the configured build limits.
+  dispatcher = git_patrol.WorkflowDispatcher(
+      max_builds=args.max_concurrent_builds or None,
+      max_builds_per_alias=args.max_concurrent_builds_per_target or None,
+      coalesce=args.coalesce_superseded_refs,
+      cancel_superseded=args.cancel_superseded_builds)
+
+  # Load the latest state of all targets in one go rather than having every
+  # target loop query the database at once. Instances sharing the targets load
+  # each target's state when they acquire its lease instead, since another
+  # instance may have polled it in the meantime.
+  initial_states = {}
+  if not args.lease_seconds:
+    initial_states = loop.run_until_complete(
+        db.fetch_latest_refs_by_aliases(
+            [target_config['alias'] for target_config in git_patrol_targets]))
 
-  # Create a polling loop coroutine for each target repository. Provide an
+  # Start each adaptive poll interval from the target's recent changes.
+  change_times = {}
+  if args.adaptive_poll_interval:
+    change_times = loop.run_until_complete(
+        db.fetch_change_times_by_aliases(
+            [target_config['alias'] for target_config in git_patrol_targets],
+            git_patrol.ADAPTIVE_POLL_HISTORY))
+  utc_now = datetime.datetime.utcnow()
+
+  # Pick up the workflows interrupted by the previous run of the service.
+  if args.resume_workflows:
+    resumed = loop.run_until_complete(
+        git_patrol.resume_workflows(
+            commands, db, args.config_path, git_patrol_targets,
+            utc_now - datetime.timedelta(hours=args.resume_workflows_hours),
+            dispatcher=dispatcher))
+    logger.info('Resumed %d interrupted workflow chains', resumed)
+
+  # Let the hosting services tell us about changes as they happen.
+  webhook_receiver = None
+  if args.webhook_port:
+    if not args.webhook_secret:
+      logger.warning(
+          'Webhooks are accepted without authentication: set --webhook_secret')
+    webhook_receiver = git_patrol_webhook.WebhookReceiver(
+        git_patrol_targets, secret=args.webhook_secret)
+    loop.run_until_complete(
+        webhook_receiver.start(args.webhook_host, args.webhook_port))
+
+  # Create a polling loop coroutine for a target repository. Provide an
   # initial time offset for each coroutine so they don't all hammer the remote
   # server(s) at once.
-  target_loops = [
-      git_patrol.target_loop(
-          commands=commands,
-          loop=loop,
-          db=db,
-          config_path=args.config_path,
-          target_config=target_config,
-          offset=idx * args.poll_interval / len(git_patrol_targets),
-          interval=args.poll_interval)
-      for idx, target_config in enumerate(git_patrol_targets)]
+  def make_target_loop(idx, initial_state=None):
+    target_config = git_patrol_targets[idx]
+    schedule = schedules[idx]
+    return git_patrol.target_loop(
+        commands=commands,
+        loop=loop,
+        db=db,
+        config_path=args.config_path,
+        target_config=target_config,
+        offset=idx * schedule.interval / len(git_patrol_targets),
+        interval=schedule.interval,
+        scheduler=scheduler,
+        dispatcher=dispatcher,
+        initial_state=initial_state,
+        trigger=(webhook_receiver.triggers[target_config['alias']]
+                 if webhook_receiver else None),
+        adaptive_interval=(
+            git_patrol.AdaptivePollInterval.from_history(
+                args.min_poll_interval, args.max_poll_interval,
+                change_times.get(target_config['alias'], []), utc_now)
+            if (args.adaptive_poll_interval and
+                'poll_interval' not in target_config) else None),
+        schedule=schedule,
+        trigger_interval=args.webhook_min_interval)
+
+  if args.lease_seconds:
+    target_indexes = {
+        target_config['alias']: idx
+        for idx, target_config in enumerate(git_patrol_targets)}
+    leases = git_patrol_lease.TargetLeases(
+        db, args.instance_id, list(target_indexes), args.lease_seconds)
+    logger.info('Sharing targets as instance %s', args.instance_id)
+    target_loops = [
+        leases.run(lambda alias: make_target_loop(target_indexes[alias]))]
+  else:
+    target_loops = [
+        make_target_loop(
+            idx, initial_states.get(target_config['alias'], (None, {})))
+        for idx, target_config in enumerate(git_patrol_targets)]
+  target_loops.append(scheduler.run())
+  if args.db_migrate:
+    target_loops.append(partition_loop(db))
 
   # Use asyncio.gather() to submit all coroutines to the event loop as
   # recommended by @gvanrossum in the GitHub issue comments at
   # https://github.com/python/asyncio/issues/477#issuecomment-269038238
+  main_task = asyncio.gather(*target_loops)
+  # Kubernetes stops containers with SIGTERM.
+  loop.add_signal_handler(signal.SIGTERM, main_task.cancel)
   try:
-    loop.run_until_complete(asyncio.gather(*target_loops))
-  except KeyboardInterrupt:
+    loop.run_until_complete(main_task)
+  except (KeyboardInterrupt, asyncio.CancelledError):
     logger.warning('Received interrupt: shutting down')
   finally:
+    if webhook_receiver:
+      loop.run_until_complete(webhook_receiver.stop())
+    # Let the workflows of the last polls start their builds and journal them.
+    # Whatever is left can be picked up with --resume_workflows.
+    loop.run_until_complete(dispatcher.shutdown(args.shutdown_timeout))
+    # Don't lose buffered journal entries.
+    loop.run_until_complete(db.close())
+    if db.ref_cache:
+      db.ref_cache.close()
     loop.close()
 
 
@@ -0,0 +1,510 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process git ref discovery over the smart HTTP protocol.
+
+Provides a minimal asyncio HTTP/1.1 client with per-host keep-alive connection
+reuse and a git smart HTTP client built on top of it. Lets Git Patrol list the
+refs of repositories served over HTTP(S) without forking a 'git ls-remote'
+process for every poll.
+See https://git-scm.com/docs/http-protocol and
+https://git-scm.com/docs/protocol-v2 for protocol details.
+"""
+
+import asyncio
+import base64
+import collections
+import fnmatch
+import hashlib
+import re
+import ssl
+import urllib.parse
+
+
+# Identify ourselves to the server. Some git hosting services only speak the
+# smart protocol to clients that look like git.
+USER_AGENT = 'git/2.0 (git-patrol)'
+
+# Maximum number of idle connections kept open for each host.
+MAX_IDLE_CONNECTIONS_PER_HOST = 4
+
+# Time in seconds to wait for a server to respond before giving up.
+HTTP_TIMEOUT_SECS = 60
+
+# Special pkt-line packets. See the "pkt-line Format" section of
+# https://git-scm.com/docs/protocol-common
+FLUSH_PKT = b'0000'
+DELIM_PKT = b'0001'
+
+# Git ref names accepted from any transport. The exact rules for a reference
+# name are tricky as seen on StackOverflow
+# (https://stackoverflow.com/questions/12093748). Since the names come from a
+# git server, assume they are well formed and just limit their length. Both
+# 'git ls-remote' and the in-process client apply the same rule so switching
+# transports never looks like refs were added or deleted.
+GIT_REFNAME_REGEX = r'refs/[^\s\0]{1,64}'
+
+# A ref advertisement or ls-refs response line.
+# Example: 039de508998f3676871ed8cc00e3b33f0f95f7cb refs/heads/master
+GIT_PKT_REF_REGEX = re.compile(
+    rb'^([0-9a-f]{40}) (' + GIT_REFNAME_REGEX.encode() + rb')(?=[\s\0]|$)')
+
+# Media type of a smart HTTP ref advertisement.
+GIT_ADVERTISEMENT_CONTENT_TYPE = 'application/x-git-upload-pack-advertisement'
+
+HttpResponse = collections.namedtuple(
+    'HttpResponse', ['status', 'headers', 'body'])
+
+
+class GitHttpError(Exception):
+  """Raised when refs can't be listed with the in-process smart HTTP client."""
+
+
+class GitHttpLimitError(GitHttpError):
+  """Raised when a response is larger than the caller allows."""
+
+
+def pkt_line(data):
+  """Encode bytes as a pkt-line.
+
+  Args:
+    data: The payload to encode.
+  Returns:
+    The payload prefixed by its four hex digit length.
+  """
+  return '{:04x}'.format(len(data) + 4).encode() + data
+
+
+def parse_pkt_lines(data):
+  """Split a buffer of pkt-lines into their payloads.
+
+  Args:
+    data: Bytes containing zero or more complete pkt-lines.
+  Returns:
+    A list of payloads. Flush and delimiter packets are returned as None.
+  Raises:
+    GitHttpError: The buffer does not contain well formed pkt-lines.
+  """
+  lines = []
+  pos = 0
+  while pos < len(data):
+    try:
+      length = int(data[pos:pos + 4], 16)
+    except ValueError:
+      raise GitHttpError('invalid pkt-line length')
+    if length < 4:
+      lines.append(None)
+      pos += 4
+      continue
+    if pos + length > len(data):
+      raise GitHttpError('truncated pkt-line')
+    lines.append(data[pos + 4:pos + length])
+    pos += length
+  return lines
+
+
+def ref_filters_match(refname, ref_filters):
+  """Apply 'git ls-remote' pattern matching to a ref name.
+
+  Each pattern is matched against the "tail" of the ref name, starting either
+  from the start of the ref name or from a slash separator. An empty list of
+  patterns matches every ref name.
+
+  Args:
+    refname: The full ref name (ex: refs/heads/master).
+    ref_filters: A (possibly empty) list of ref filter patterns.
+  Returns:
+    True when the ref name matches at least one of the patterns.
+  """
+  if not ref_filters:
+    return True
+  return any(
+      fnmatch.fnmatchcase('/' + refname, '*/' + ref_filter)
+      for ref_filter in ref_filters)
+
+
+def ref_filter_prefix(ref_filter):
+  """Find the literal ref name prefix shared by every ref matching a filter.
+
+  Only filters that spell out a full ref name (ex: 'refs/tags/v1.*') have a
+  usable prefix. Filters that rely on tail matching (ex: 'master') could match
+  refs anywhere in the namespace.
+
+  Args:
+    ref_filter: A ref filter pattern.
+  Returns:
+    The ref name prefix for the filter, or None if there isn't one.
+  """
+  if not ref_filter.startswith('refs/'):
+    return None
+  return re.split(r'[*?\[\\]', ref_filter, maxsplit=1)[0]
+
+
+def ref_filters_prefixes(ref_filters):
+  """Translate ref filters into protocol v2 'ref-prefix' arguments.
+
+  Args:
+    ref_filters: A (possibly empty) list of ref filter patterns.
+  Returns:
+    A list of ref name prefixes covering every ref matching the filters. The
+    list is empty when the server needs to send all refs.
+  """
+  prefixes = [ref_filter_prefix(ref_filter) for ref_filter in ref_filters]
+  if not prefixes or not all(prefixes):
+    return []
+  return sorted(set(prefixes))
+
+
+async def _read_headers(reader):
+  """Read HTTP header lines up to and including the blank separator line.
+
+  Args:
+    reader: The asyncio.StreamReader to read from.
+  Returns:
+    A dictionary of header values keyed by lower case header names.
+  """
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if not line:
+      raise GitHttpError('connection closed while reading headers')
+    line = line.rstrip(b'\r\n')
+    if not line:
+      return headers
+    name, _, value = line.decode('latin-1').partition(':')
+    headers[name.strip().lower()] = value.strip()
+
+
+def _check_body_size(size, max_body_bytes):
+  if max_body_bytes and size > max_body_bytes:
+    raise GitHttpLimitError('response larger than {} bytes'.format(
+        max_body_bytes))
+
+
+async def _read_chunked_body(reader, max_body_bytes):
+  """Read an HTTP body sent with chunked transfer encoding."""
+  chunks = []
+  size_read = 0
+  while True:
+    size_line = await reader.readline()
+    try:
+      size = int(size_line.split(b';')[0], 16)
+    except ValueError:
+      raise GitHttpError('invalid chunk size')
+    if not size:
+      # Skip any trailers.
+      await _read_headers(reader)
+      return b''.join(chunks)
+    size_read += size
+    _check_body_size(size_read, max_body_bytes)
+    chunks.append(await reader.readexactly(size))
+    await reader.readline()
+
+
+class HttpClient:
+  """Minimal asyncio HTTP/1.1 client.
+
+  Keeps a small pool of idle connections for each host so that successive
+  requests against the same server skip the TCP and TLS handshakes.
+  """
+
+  def __init__(self, timeout=HTTP_TIMEOUT_SECS):
+    self.timeout = timeout
+    self._idle = collections.defaultdict(list)
+    self._ssl_context = ssl.create_default_context()
+
+  async def _connect(self, key):
+    """Reuse an idle connection to the host or open a new one.
+
+    Returns:
+      A (connection, reused) tuple. The connection is a (reader, writer) pair.
+    """
+    while self._idle[key]:
+      connection = self._idle[key].pop()
+      if not connection[0].at_eof():
+        return connection, True
+      connection[1].close()
+    scheme, host, port = key
+    connection = await asyncio.open_connection(
+        host, port, ssl=self._ssl_context if scheme == 'https' else None)
+    return connection, False
+
+  def _release(self, key, connection):
+    if len(self._idle[key]) < MAX_IDLE_CONNECTIONS_PER_HOST:
+      self._idle[key].append(connection)
+    else:
+      connection[1].close()
+
+  async def request(
+      self, method, url, headers=None, body=None, max_body_bytes=None):
+    """Send an HTTP request and read the complete response.
+
+    Args:
+      method: The HTTP method (ex: 'GET').
+      url: Absolute http:// or https:// URL. Credentials embedded in the URL
+        are sent with HTTP Basic authentication.
+      headers: Optional dictionary of extra request headers.
+      body: Optional request body bytes.
+      max_body_bytes: Maximum size of the response body. None for no limit.
+    Returns:
+      An HttpResponse. Header names are lower case.
+    Raises:
+      GitHttpError: The request could not be completed.
+      GitHttpLimitError: The response body is larger than max_body_bytes.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme not in ('http', 'https'):
+      raise GitHttpError('unsupported URL scheme: ' + parsed.scheme)
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    key = (parsed.scheme, parsed.hostname, port)
+    target = parsed.path or '/'
+    if parsed.query:
+      target += '?' + parsed.query
+
+    request_headers = {
+        'Host': parsed.netloc.rpartition('@')[2],
+        'User-Agent': USER_AGENT,
+        'Connection': 'keep-alive',
+    }
+    if parsed.username is not None:
+      credentials = '{}:{}'.format(
+          urllib.parse.unquote(parsed.username),
+          urllib.parse.unquote(parsed.password or ''))
+      request_headers['Authorization'] = (
+          'Basic ' + base64.b64encode(credentials.encode()).decode())
+    if body is not None:
+      request_headers['Content-Length'] = str(len(body))
+    request_headers.update(headers or {})
+
+    request = '{} {} HTTP/1.1\r\n'.format(method, target) + ''.join(
+        '{}: {}\r\n'.format(k, v) for (k, v) in request_headers.items())
+    request = request.encode('latin-1') + b'\r\n' + (body or b'')
+
+    # The server may close an idle connection at any time, so a request sent
+    # over a reused connection is retried once on a fresh one.
+    while True:
+      reused = False
+      try:
+        connection, reused = await asyncio.wait_for(
+            self._connect(key), self.timeout)
+        try:
+          response, keep_alive = await asyncio.wait_for(
+              self._exchange(connection, request, method, max_body_bytes),
+              self.timeout)
+        except BaseException:
+          connection[1].close()
+          raise
+      except GitHttpLimitError:
+        raise
+      except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+              GitHttpError) as e:
+        if reused:
+          continue
+        raise GitHttpError('HTTP request to {} failed: {!r}'.format(
+            parsed.hostname, e))
+      break
+
+    if keep_alive:
+      self._release(key, connection)
+    else:
+      connection[1].close()
+    return response
+
+  async def _exchange(self, connection, request, method, max_body_bytes):
+    reader, writer = connection
+    writer.write(request)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    if not status_line:
+      raise GitHttpError('connection closed by server')
+    version, _, rest = status_line.decode('latin-1').partition(' ')
+    try:
+      status = int(rest.split(' ', 1)[0])
+    except ValueError:
+      raise GitHttpError('invalid HTTP status line')
+    headers = await _read_headers(reader)
+
+    keep_alive = (
+        version == 'HTTP/1.1' and
+        headers.get('connection', '').lower() != 'close')
+    if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+      body = b''
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+      body = await _read_chunked_body(reader, max_body_bytes)
+    elif 'content-length' in headers:
+      _check_body_size(int(headers['content-length']), max_body_bytes)
+      body = await reader.readexactly(int(headers['content-length']))
+    else:
+      body = await reader.read(
+          max_body_bytes + 1 if max_body_bytes else -1)
+      _check_body_size(len(body), max_body_bytes)
+      keep_alive = False
+    return HttpResponse(status, headers, body), keep_alive
+
+  def close(self):
+    """Close all idle connections."""
+    for connections in self._idle.values():
+      for _, writer in connections:
+        writer.close()
+    self._idle.clear()
+
+
+class GitSmartHttpClient:
+  """Lists the refs of git repositories served over smart HTTP.
+
+  Speaks git protocol version 2 when the server supports it, which lets the
+  server filter the refs with 'ref-prefix' arguments. Falls back to parsing the
+  protocol version 0 ref advertisement otherwise.
+  """
+
+  def __init__(self, http_client=None, protocol_version=2):
+    """Create a new smart HTTP client.
+
+    Args:
+      http_client: HttpClient used to send requests. A new one is created when
+        not provided.
+      protocol_version: Highest git protocol version to request (0 or 2).
+    """
+    self.http = http_client or HttpClient()
+    self.protocol_version = protocol_version
+
+  @staticmethod
+  def supports(url):
+    """Returns True if the URL uses a transport handled by this client."""
+    return urllib.parse.urlsplit(url).scheme in ('http', 'https')
+
+  async def ls_refs(self, url, ref_filters, max_bytes=None):
+    """List the refs of a remote repository like 'git ls-remote --refs'.
+
+    Args:
+      url: http:// or https:// URL of the git repository.
+      ref_filters: A (possibly empty) list of ref filter patterns.
+      max_bytes: Maximum size of each response from the server. None for no
+        limit.
+    Returns:
+      A (dict, int) tuple. The first item is a dictionary of git ref names and
+      commit hashes. The second item is the number of response body bytes
+      received from the server.
+    Raises:
+      GitHttpError: The refs could not be listed. Callers should fall back to
+        the git command.
+      GitHttpLimitError: The server's response is larger than max_bytes.
+    """
+    refs, bytes_received, _ = await self.ls_refs_if_changed(
+        url, ref_filters, None, max_bytes)
+    return refs, bytes_received
+
+  async def ls_refs_if_changed(
+      self, url, ref_filters, validator, max_bytes=None):
+    """List the refs of a remote repository unless they are unchanged.
+
+    Protocol version 0 advertisements hold the refs themselves, so they are
+    requested with If-None-Match when the previous one had an ETag. Otherwise
+    the advertisement, or the protocol v2 'ls-refs' response, is hashed and
+    compared before any ref is parsed.
+
+    Args:
+      url: http:// or https:// URL of the git repository.
+      ref_filters: A (possibly empty) list of ref filter patterns.
+      validator: Validator returned with the previous refs of this repository
+        and ref filters, or None.
+      max_bytes: Maximum size of each response from the server. None for no
+        limit.
+    Returns:
+      A (dict, int, str) tuple. The first item is a dictionary of git ref
+      names and commit hashes, or None when the refs match validator. The
+      second item is the number of response body bytes received from the
+      server. The third item is the validator of the current refs.
+    Raises:
+      GitHttpError: The refs could not be listed. Callers should fall back to
+        the git command.
+      GitHttpLimitError: The server's response is larger than max_bytes.
+    """
+    base_url = url.rstrip('/')
+    headers = {'Accept': '*/*'}
+    if self.protocol_version == 2:
+      headers['Git-Protocol'] = 'version=2'
+    if validator and validator.startswith('etag:'):
+      headers['If-None-Match'] = validator[len('etag:'):]
+    response = await self.http.request(
+        'GET', base_url + '/info/refs?service=git-upload-pack', headers,
+        max_body_bytes=max_bytes)
+    if response.status == 304 and 'If-None-Match' in headers:
+      return None, 0, validator
+    if response.status != 200:
+      raise GitHttpError('info/refs returned HTTP {}'.format(response.status))
+    # Ignore media type parameters such as the charset.
+    content_type = response.headers.get('content-type', '')
+    media_type = content_type.split(';', 1)[0].strip().lower()
+    if media_type != GIT_ADVERTISEMENT_CONTENT_TYPE:
+      raise GitHttpError('server does not support the smart HTTP protocol')
+
+    bytes_received = len(response.body)
+    lines = parse_pkt_lines(response.body)
+    if lines and lines[0] and lines[0].startswith(b'# service='):
+      lines = lines[2:]
+    if lines and lines[0] == b'version 2\n':
+      # The capability advertisement doesn't change with the refs, so only
+      # the 'ls-refs' response can tell whether the refs changed.
+      response = await self._ls_refs_v2(base_url, ref_filters, max_bytes)
+      bytes_received += len(response.body)
+      current_validator = 'sha1:' + hashlib.sha1(response.body).hexdigest()
+      lines = None
+    elif 'etag' in response.headers:
+      current_validator = 'etag:' + response.headers['etag']
+    else:
+      current_validator = 'sha1:' + hashlib.sha1(response.body).hexdigest()
+    if current_validator == validator:
+      return None, bytes_received, validator
+    if lines is None:
+      lines = parse_pkt_lines(response.body)
+
+    refs = {}
+    for line in lines:
+      match = line and GIT_PKT_REF_REGEX.match(line)
+      if not match:
+        continue
+      refname = match.group(2).decode('utf-8', 'ignore')
+      if (refname.startswith('refs/') and not refname.endswith('^{}') and
+          ref_filters_match(refname, ref_filters)):
+        refs[refname] = match.group(1).decode()
+    return refs, bytes_received, current_validator
+
+  async def _ls_refs_v2(self, base_url, ref_filters, max_bytes):
+    """Issue a protocol v2 'ls-refs' command.
+
+    Args:
+      base_url: URL of the git repository without a trailing slash.
+      ref_filters: A (possibly empty) list of ref filter patterns.
+      max_bytes: Maximum size of the response. None for no limit.
+    Returns:
+      The HttpResponse holding the server's pkt-line response.
+    """
+    request = [pkt_line(b'command=ls-refs\n'), DELIM_PKT]
+    request += [
+        pkt_line('ref-prefix {}\n'.format(prefix).encode())
+        for prefix in ref_filters_prefixes(ref_filters)]
+    request.append(FLUSH_PKT)
+
+    response = await self.http.request(
+        'POST', base_url + '/git-upload-pack',
+        {'Accept': 'application/x-git-upload-pack-result',
+         'Content-Type': 'application/x-git-upload-pack-request',
+         'Git-Protocol': 'version=2'},
+        b''.join(request), max_body_bytes=max_bytes)
+    if response.status != 200:
+      raise GitHttpError(
+          'git-upload-pack returned HTTP {}'.format(response.status))
+    return response
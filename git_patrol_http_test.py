@@ -0,0 +1,280 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the Git Patrol smart HTTP client."""
+
+import asyncio
+import logging
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import urllib.parse
+
+import git_patrol
+import git_patrol_http
+
+
+class _GitHttpBackendServer:
+  """Local stand-in for the git-http-backend container.
+
+  Serves the repositories below a folder over HTTP/1.1 by running the
+  'git http-backend' CGI program for each request. Keeps connections open
+  between requests and counts them so tests can check connection reuse.
+  """
+
+  def __init__(self, project_root):
+    self.project_root = project_root
+    self.connections = 0
+    self.requests = []
+    self.content_type_params = ''
+    self._server = None
+    self._handlers = set()
+
+  async def start(self):
+    self._server = await asyncio.start_server(
+        self._handle_connection, '127.0.0.1', 0)
+    return 'http://127.0.0.1:{}'.format(
+        self._server.sockets[0].getsockname()[1])
+
+  async def stop(self):
+    self._server.close()
+    for handler in self._handlers:
+      handler.cancel()
+    await asyncio.gather(*self._handlers, return_exceptions=True)
+
+  async def _handle_connection(self, reader, writer):
+    self.connections += 1
+    self._handlers.add(asyncio.current_task())
+    try:
+      while True:
+        request_line = await reader.readline()
+        if not request_line:
+          break
+        method, target, _ = request_line.decode().split(' ', 2)
+        headers = {}
+        while True:
+          line = (await reader.readline()).decode().rstrip('\r\n')
+          if not line:
+            break
+          name, _, value = line.partition(':')
+          headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        self.requests.append((method, target, headers))
+
+        path, _, query = target.partition('?')
+        env = {
+            'PATH': os.environ['PATH'],
+            'GIT_PROJECT_ROOT': self.project_root,
+            'GIT_HTTP_EXPORT_ALL': '1',
+            'REQUEST_METHOD': method,
+            'PATH_INFO': urllib.parse.unquote(path),
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': headers.get('content-type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'GIT_PROTOCOL': headers.get('git-protocol', ''),
+            'REMOTE_ADDR': '127.0.0.1',
+        }
+        proc = await asyncio.create_subprocess_exec(
+            'git', 'http-backend', env=env, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE)
+        output, _ = await proc.communicate(body)
+
+        # Translate the CGI response into an HTTP response.
+        raw_headers, _, response_body = output.partition(b'\r\n\r\n')
+        status = '200 OK'
+        response_headers = []
+        for line in raw_headers.decode().split('\r\n'):
+          name, _, value = line.partition(':')
+          if name.lower() == 'status':
+            status = value.strip()
+          elif name.lower() == 'content-type':
+            response_headers.append(line + self.content_type_params)
+          elif name:
+            response_headers.append(line)
+        response_headers.append('Content-Length: {}'.format(len(response_body)))
+        writer.write(
+            'HTTP/1.1 {}\r\n{}\r\n\r\n'.format(
+                status, '\r\n'.join(response_headers)).encode() +
+            response_body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    finally:
+      writer.close()
+
+
+class GitPatrolHttpTest(unittest.TestCase):
+
+  async def _run_git(self, *args, cwd=None):
+    proc = await asyncio.create_subprocess_exec(
+        'git', *args, stdout=asyncio.subprocess.PIPE, cwd=cwd)
+    stdout, _ = await proc.communicate()
+    self.assertEqual(proc.returncode, 0)
+    return stdout
+
+  async def _init_git_repo(self):
+    await self._run_git('init', '--quiet', '--bare', self._bare_dir)
+    await self._run_git('init', '--quiet', self._work_dir)
+    await self._run_git('config', 'user.name', 'The Author', cwd=self._work_dir)
+    await self._run_git(
+        'config', 'user.email', 'the@author.com', cwd=self._work_dir)
+    await self._run_git(
+        'commit', '--quiet', '--allow-empty', '--message=First',
+        cwd=self._work_dir)
+    await self._run_git(
+        'tag', '-a', 'r0001', '-m', 'Tag r0001', cwd=self._work_dir)
+    await self._run_git('branch', 'feature', cwd=self._work_dir)
+    await self._run_git(
+        'push', '--quiet', '--mirror', self._bare_dir, cwd=self._work_dir)
+
+    stdout = await self._run_git('ls-remote', '--refs', self._bare_dir)
+    refs = re.findall(
+        git_patrol.GIT_HASH_REFNAME_REGEX, stdout.decode(), re.MULTILINE)
+    return {refname: commit for (commit, refname) in refs}
+
+  def setUp(self):
+    super(GitPatrolHttpTest, self).setUp()
+    logging.disable(logging.CRITICAL)
+
+    self._temp_dir = tempfile.mkdtemp()
+    self._bare_dir = os.path.join(self._temp_dir, 'test.git')
+    self._work_dir = os.path.join(self._temp_dir, 'work')
+
+    self._loop = asyncio.get_event_loop()
+    self._refs = self._loop.run_until_complete(self._init_git_repo())
+    self.assertEqual(len(self._refs), 3)
+
+    self._server = _GitHttpBackendServer(self._temp_dir)
+    self._url = self._loop.run_until_complete(self._server.start()) + (
+        '/test.git')
+
+  def tearDown(self):
+    self._loop.run_until_complete(self._server.stop())
+    shutil.rmtree(self._temp_dir, ignore_errors=True)
+    super(GitPatrolHttpTest, self).tearDown()
+
+  def testLsRefsProtocolV2(self):
+    client = git_patrol_http.GitSmartHttpClient()
+    refs, _ = self._loop.run_until_complete(client.ls_refs(self._url, []))
+    client.http.close()
+    self.assertDictEqual(refs, self._refs)
+
+    # Both requests should have been sent over the same connection.
+    self.assertEqual(self._server.connections, 1)
+    self.assertEqual(
+        [method for (method, _, _) in self._server.requests], ['GET', 'POST'])
+
+  def testLsRefsProtocolV0(self):
+    client = git_patrol_http.GitSmartHttpClient(protocol_version=0)
+    refs, _ = self._loop.run_until_complete(client.ls_refs(self._url, []))
+    client.http.close()
+    self.assertDictEqual(refs, self._refs)
+    self.assertEqual(
+        [method for (method, _, _) in self._server.requests], ['GET'])
+
+  def testLsRefsFiltered(self):
+    client = git_patrol_http.GitSmartHttpClient()
+    refs, filtered_bytes = self._loop.run_until_complete(
+        client.ls_refs(self._url, ['refs/tags/*']))
+    refs_by_tail, unfiltered_bytes = self._loop.run_until_complete(
+        client.ls_refs(self._url, ['feature']))
+    client.http.close()
+
+    # Only the tail matching filter requires the server to send every ref.
+    self.assertLess(filtered_bytes, unfiltered_bytes)
+
+    self.assertDictEqual(
+        refs,
+        {k: v for k, v in self._refs.items() if k.startswith('refs/tags/')})
+    self.assertDictEqual(
+        refs_by_tail, {'refs/heads/feature': self._refs['refs/heads/feature']})
+    self.assertEqual(self._server.connections, 1)
+
+  def testLsRefsIfChanged(self):
+    for protocol_version in (0, 2):
+      client = git_patrol_http.GitSmartHttpClient(
+          protocol_version=protocol_version)
+      refs, _, validator = self._loop.run_until_complete(
+          client.ls_refs_if_changed(self._url, [], None))
+      self.assertDictEqual(refs, self._refs)
+      self.assertTrue(validator)
+
+      unchanged_refs, _, unchanged_validator = self._loop.run_until_complete(
+          client.ls_refs_if_changed(self._url, [], validator))
+      self.assertIsNone(unchanged_refs)
+      self.assertEqual(unchanged_validator, validator)
+
+      # Refs are listed again when the validator doesn't match.
+      changed_refs, _, changed_validator = self._loop.run_until_complete(
+          client.ls_refs_if_changed(self._url, [], 'sha1:' + '0' * 40))
+      client.http.close()
+      self.assertDictEqual(changed_refs, self._refs)
+      self.assertEqual(changed_validator, validator)
+
+  def testLsRefsContentTypeParameters(self):
+    self._server.content_type_params = '; charset=utf-8'
+    client = git_patrol_http.GitSmartHttpClient(protocol_version=0)
+    refs, _ = self._loop.run_until_complete(client.ls_refs(self._url, []))
+    client.http.close()
+    self.assertDictEqual(refs, self._refs)
+
+  def testLongRefNamesMatchGitCommand(self):
+    # Both transports skip the same overly long ref names.
+    for length in (64, 65):
+      refname = 'refs/heads/' + 'x' * (length - len('heads/'))
+      self._loop.run_until_complete(self._run_git(
+          'push', '--quiet', self._bare_dir, 'HEAD:' + refname,
+          cwd=self._work_dir))
+
+    commands = git_patrol.GitPatrolCommands()
+    git_refs = self._loop.run_until_complete(
+        git_patrol.fetch_git_refs(commands, self._bare_dir, []))
+    self.assertEqual(len(git_refs), len(self._refs) + 1)
+    for protocol_version in (0, 2):
+      client = git_patrol_http.GitSmartHttpClient(
+          protocol_version=protocol_version)
+      refs, _ = self._loop.run_until_complete(client.ls_refs(self._url, []))
+      client.http.close()
+      self.assertDictEqual(refs, dict(git_refs))
+
+  def testFetchGitRefsFallback(self):
+    commands = git_patrol.GitPatrolCommands()
+    commands.git_http = git_patrol_http.GitSmartHttpClient()
+
+    # A missing repository makes the in-process client fail, so fetching refs
+    # must fall back to 'git ls-remote', which fails as well.
+    refs = self._loop.run_until_complete(
+        git_patrol.fetch_git_refs(commands, self._url + '.missing', []))
+    self.assertIsNone(refs)
+
+    # Local repositories are always handled by the git command.
+    refs = self._loop.run_until_complete(
+        git_patrol.fetch_git_refs(commands, self._bare_dir, []))
+    commands.git_http.http.close()
+    self.assertDictEqual(dict(refs), self._refs)
+
+  def testRefFiltersPrefixes(self):
+    self.assertEqual(git_patrol_http.ref_filters_prefixes([]), [])
+    self.assertEqual(
+        git_patrol_http.ref_filters_prefixes(
+            ['refs/tags/v1.*', 'refs/heads/master']),
+        ['refs/heads/master', 'refs/tags/v1.'])
+    self.assertEqual(
+        git_patrol_http.ref_filters_prefixes(['refs/tags/*', 'master']), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,151 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shares the targets of one configuration between Git Patrol instances.
+
+Instances sharing a database each poll a part of the targets. Every instance
+periodically renews its heartbeat and its target leases in the database. The
+targets are spread over the live instances with rendezvous hashing, so an
+instance joining or leaving only moves the targets it gains or loses. A target
+is only polled while its lease is held, and a lease only changes hands once the
+previous holder released it or let it expire, so no two instances poll the
+same target and trigger the same builds.
+"""
+
+import asyncio
+import hashlib
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Number of lease renewals per lease period. Leaves room for failed renewals
+# before a lease expires.
+LEASE_RENEWALS = 3
+
+
+def rendezvous_owner(alias, instances):
+  """Pick the instance responsible for a target.
+
+  Every instance computes the same answer from the same list of instances.
+  Adding or removing an instance only changes the owner of the targets that
+  move to or from that instance.
+
+  Args:
+    alias: Alias of the target.
+    instances: Non-empty list of the IDs of the live instances.
+  Returns:
+    The ID of the instance that should poll the target.
+  """
+  return max(
+      instances,
+      key=lambda instance: hashlib.sha1(
+          '{}\0{}'.format(instance, alias).encode()).digest())
+
+
+class TargetLeases:
+  """Runs the target loops of the targets leased by this instance.
+
+  Starts a target loop when its lease is acquired and stops it when the lease
+  is released to another instance or can't be renewed in time.
+  """
+
+  def __init__(self, db, instance_id, aliases, lease_seconds):
+    """Create a new lease manager.
+
+    Args:
+      db: A GitPatrolDb object used to store the leases.
+      instance_id: ID of this instance, unique among the live instances.
+      aliases: List of the aliases of all configured targets.
+      lease_seconds: Time in seconds a lease lasts unless renewed. Also the
+        time after which a silent instance is considered dead.
+    """
+    self.db = db
+    self.instance_id = instance_id
+    self.aliases = list(aliases)
+    self.lease_seconds = lease_seconds
+    self._tasks = {}
+    self._valid_until = 0
+
+  @property
+  def held(self):
+    """The set of aliases of the targets currently polled by this instance."""
+    return set(self._tasks)
+
+  async def _stop_targets(self, aliases):
+    tasks = [self._tasks.pop(alias) for alias in aliases]
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+  async def rebalance(self, start_target):
+    """Renew the leases and start or stop target loops to match them.
+
+    Args:
+      start_target: Function called with the alias of a newly leased target.
+        Returns the target loop coroutine to run.
+    """
+    loop = asyncio.get_event_loop()
+    renew_time = loop.time()
+    try:
+      instances = await self.db.renew_instance(
+          self.instance_id, self.lease_seconds)
+      wanted = [
+          alias for alias in self.aliases
+          if rendezvous_owner(alias, instances) == self.instance_id]
+      # Hand over the targets now assigned to other instances.
+      released = [alias for alias in self._tasks if alias not in wanted]
+      if released:
+        await self._stop_targets(released)
+        await self.db.release_target_leases(self.instance_id, released)
+      held = await self.db.acquire_target_leases(
+          self.instance_id, wanted, self.lease_seconds)
+    except Exception as e:
+      logger.warning('Failed to renew target leases: %s', e)
+      # Stop before the leases expire and another instance takes over.
+      if loop.time() + self.lease_seconds / LEASE_RENEWALS >= (
+          self._valid_until):
+        await self._stop_targets(list(self._tasks))
+      return
+    self._valid_until = renew_time + self.lease_seconds
+
+    await self._stop_targets(
+        [alias for alias in self._tasks if alias not in held])
+    for alias in wanted:
+      if alias in held and alias not in self._tasks:
+        self._tasks[alias] = asyncio.ensure_future(start_target(alias))
+    logger.info(
+        'Polling %d of %d targets with %d instances', len(self._tasks),
+        len(self.aliases), len(instances))
+
+  async def run(self, start_target):
+    """Keep the leased targets polled. Loops until cancelled.
+
+    Releases all leases when cancelled, so the other instances take over
+    right away.
+
+    Args:
+      start_target: Function called with the alias of a newly leased target.
+        Returns the target loop coroutine to run.
+    """
+    try:
+      while True:
+        await self.rebalance(start_target)
+        await asyncio.sleep(self.lease_seconds / LEASE_RENEWALS)
+    finally:
+      await self._stop_targets(list(self._tasks))
+      try:
+        await self.db.remove_instance(self.instance_id)
+      except Exception as e:
+        logger.warning('Failed to release target leases: %s', e)
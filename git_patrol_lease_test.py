@@ -0,0 +1,140 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for sharing targets between Git Patrol instances."""
+
+import asyncio
+import logging
+import unittest
+
+import git_patrol_lease
+
+
+ALIASES = ['target{:02d}'.format(i) for i in range(40)]
+
+
+class FakeLeaseDb:
+  """In-memory version of the lease operations of GitPatrolDb."""
+
+  def __init__(self):
+    self.instances = set()
+    self.leases = {}
+    self.fail = False
+
+  async def renew_instance(self, instance_id, lease_seconds):
+    if self.fail:
+      raise OSError('connection lost')
+    self.instances.add(instance_id)
+    return sorted(self.instances)
+
+  async def acquire_target_leases(self, instance_id, aliases, lease_seconds):
+    for alias in aliases:
+      self.leases.setdefault(alias, instance_id)
+    return set(
+        alias for alias in aliases if self.leases[alias] == instance_id)
+
+  async def release_target_leases(self, instance_id, aliases):
+    for alias in aliases:
+      if self.leases.get(alias) == instance_id:
+        del self.leases[alias]
+
+  async def remove_instance(self, instance_id):
+    self.instances.discard(instance_id)
+    for alias in [a for (a, i) in self.leases.items() if i == instance_id]:
+      del self.leases[alias]
+
+
+class GitPatrolLeaseTest(unittest.TestCase):
+
+  def setUp(self):
+    super(GitPatrolLeaseTest, self).setUp()
+    logging.disable(logging.CRITICAL)
+    self._loop = asyncio.get_event_loop()
+    self._polled = {}
+
+  def _start_target(self, instance_id):
+    async def target_loop(alias):
+      # No two instances may ever poll the same target.
+      assert alias not in self._polled
+      self._polled[alias] = instance_id
+      try:
+        await asyncio.sleep(3600)
+      finally:
+        del self._polled[alias]
+    return target_loop
+
+  def _rebalance(self, leases):
+    self._loop.run_until_complete(
+        leases.rebalance(self._start_target(leases.instance_id)))
+    # Let the started target loops run up to their first await.
+    self._loop.run_until_complete(asyncio.sleep(0))
+
+  def testRendezvousOwnerMovesFewTargets(self):
+    three = {
+        alias: git_patrol_lease.rendezvous_owner(alias, ['a', 'b', 'c'])
+        for alias in ALIASES}
+    four = {
+        alias: git_patrol_lease.rendezvous_owner(alias, ['a', 'b', 'c', 'd'])
+        for alias in ALIASES}
+    self.assertEqual(set(three.values()), {'a', 'b', 'c'})
+    self.assertIn('d', four.values())
+    for alias in ALIASES:
+      self.assertIn(four[alias], (three[alias], 'd'))
+
+  def testInstancesJoinAndLeave(self):
+    db = FakeLeaseDb()
+    first = git_patrol_lease.TargetLeases(db, 'first', ALIASES, 60)
+    second = git_patrol_lease.TargetLeases(db, 'second', ALIASES, 60)
+
+    self._rebalance(first)
+    self.assertEqual(first.held, set(ALIASES))
+
+    # The second instance waits for the first one to hand over its share.
+    self._rebalance(second)
+    self.assertEqual(second.held, set())
+    self._rebalance(first)
+    self._rebalance(second)
+    self.assertTrue(first.held and second.held)
+    self.assertEqual(first.held | second.held, set(ALIASES))
+    self.assertEqual(set(self._polled), set(ALIASES))
+
+    # The first instance leaves and the second one takes over.
+    run = asyncio.ensure_future(first.run(self._start_target('first')))
+    self._loop.run_until_complete(asyncio.sleep(0))
+    run.cancel()
+    self._loop.run_until_complete(asyncio.gather(run, return_exceptions=True))
+    self.assertEqual(first.held, set())
+    self._rebalance(second)
+    self.assertEqual(second.held, set(ALIASES))
+    self.assertEqual(set(self._polled.values()), {'second'})
+
+  def testStopsPollingBeforeLeasesExpire(self):
+    db = FakeLeaseDb()
+    leases = git_patrol_lease.TargetLeases(db, 'only', ALIASES, 0.3)
+    self._rebalance(leases)
+    self.assertEqual(leases.held, set(ALIASES))
+
+    # A failed renewal keeps the targets while the leases are still valid.
+    db.fail = True
+    self._rebalance(leases)
+    self.assertEqual(leases.held, set(ALIASES))
+
+    self._loop.run_until_complete(asyncio.sleep(0.2))
+    self._rebalance(leases)
+    self.assertEqual(leases.held, set())
+    self.assertEqual(self._polled, {})
+
+
+if __name__ == '__main__':
+  unittest.main()
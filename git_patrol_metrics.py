@@ -0,0 +1,151 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prometheus metrics for the Git Patrol service.
+
+Metrics are recorded through the prometheus_client library when it is
+installed. Otherwise every metric is a no-op, so instrumented code never needs
+to check whether metrics are enabled.
+See https://github.com/prometheus/client_python for the library.
+"""
+
+import time
+
+try:
+  import prometheus_client
+except ImportError:
+  prometheus_client = None
+
+
+# Buckets for durations from milliseconds to an hour, in seconds.
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900,
+    3600)
+
+# Buckets for sizes from a kilobyte to a gigabyte, in bytes.
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+
+# Buckets for counts of git refs.
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 50, 100, 1000, 10000, 100000)
+
+
+class _Timer:
+  """Context manager observing the time spent inside it."""
+
+  def __init__(self, metric):
+    self._metric = metric
+    self._start = None
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    self._metric.observe(time.perf_counter() - self._start)
+
+
+class _NoOpMetric:
+  """Stands in for every kind of metric when prometheus_client is missing."""
+
+  def labels(self, *args, **kwargs):
+    return self
+
+  def observe(self, value):
+    pass
+
+  def inc(self, amount=1):
+    pass
+
+  def dec(self, amount=1):
+    pass
+
+  def set(self, value):
+    pass
+
+
+def _histogram(name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+  if not prometheus_client:
+    return _NoOpMetric()
+  return prometheus_client.Histogram(
+      name, documentation, labelnames, buckets=buckets)
+
+
+def _gauge(name, documentation, labelnames=()):
+  if not prometheus_client:
+    return _NoOpMetric()
+  return prometheus_client.Gauge(name, documentation, labelnames)
+
+
+def timer(metric):
+  """Time a block of code, including any awaits inside it.
+
+  Args:
+    metric: Histogram, with its labels applied, to observe the time with.
+  Returns:
+    A context manager.
+  """
+  return _Timer(metric)
+
+
+def start_server(port):
+  """Serve the metrics over HTTP for Prometheus to scrape.
+
+  Args:
+    port: Port to serve the metrics on.
+  Returns:
+    True if the server was started. False when prometheus_client is missing.
+  """
+  if not prometheus_client:
+    return False
+  prometheus_client.start_http_server(port)
+  return True
+
+
+# Polls.
+LS_REMOTE_SECONDS = _histogram(
+    'git_patrol_ls_remote_seconds', 'Time spent listing the refs of a host.',
+    ['host', 'transport'])
+LS_REMOTE_BYTES = _histogram(
+    'git_patrol_ls_remote_bytes', 'Size of the ref listings of a host.',
+    ['host', 'transport'], buckets=SIZE_BUCKETS)
+POLL_SECONDS = _histogram(
+    'git_patrol_poll_seconds',
+    'Time spent polling a target, journal entry included.', ['alias'])
+POLL_LAG_SECONDS = _histogram(
+    'git_patrol_poll_lag_seconds',
+    'Delay between the planned and actual start of a poll.', ['alias'])
+REFS = _gauge(
+    'git_patrol_refs', 'Number of git refs of a target.', ['alias'])
+NEW_REFS = _histogram(
+    'git_patrol_new_refs', 'Number of new or updated git refs per poll.',
+    ['alias'], buckets=COUNT_BUCKETS)
+
+# Database.
+DB_POOL_WAIT_SECONDS = _histogram(
+    'git_patrol_db_pool_wait_seconds',
+    'Time spent waiting for a database connection.')
+DB_WRITE_SECONDS = _histogram(
+    'git_patrol_db_write_seconds', 'Time spent writing journal entries.',
+    ['table'])
+
+# Builds.
+BUILDS_WAITING = _gauge(
+    'git_patrol_builds_waiting',
+    'Number of workflows waiting for a build slot.')
+BUILDS_RUNNING = _gauge(
+    'git_patrol_builds_running', 'Number of builds holding a build slot.')
+BUILD_SECONDS = _histogram(
+    'git_patrol_build_seconds',
+    'Time from starting a Cloud Build until it finished.',
+    ['alias', 'status'])
@@ -0,0 +1,49 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the Git Patrol metrics."""
+
+import time
+import unittest
+import unittest.mock
+
+import git_patrol_metrics
+
+
+class GitPatrolMetricsTest(unittest.TestCase):
+
+  def testTimer(self):
+    metric = unittest.mock.MagicMock()
+    with git_patrol_metrics.timer(metric):
+      time.sleep(0.01)
+    (elapsed,), _ = metric.observe.call_args
+    self.assertGreaterEqual(elapsed, 0.01)
+
+  def testNoOpMetrics(self):
+    metric = git_patrol_metrics._NoOpMetric()
+    metric.labels('alias').observe(1)
+    metric.labels(alias='alias').set(1)
+    metric.inc()
+    metric.dec()
+    with git_patrol_metrics.timer(metric.labels('alias')):
+      pass
+
+  def testStartServerWithoutLibrary(self):
+    with unittest.mock.patch.object(
+        git_patrol_metrics, 'prometheus_client', None):
+      self.assertFalse(git_patrol_metrics.start_server(0))
+
+
+if __name__ == '__main__':
+  unittest.main()
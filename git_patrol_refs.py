@@ -0,0 +1,217 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact in-memory representation of a repository's git refs.
+
+Git Patrol keeps the latest git refs of every target in memory for as long as
+it runs. A plain dictionary of ref name and hex commit hash strings costs a few
+hundred bytes per ref, which adds up for repositories with hundreds of
+thousands of refs/changes/* or refs/pull/* entries.
+"""
+
+import array
+import binascii
+import collections.abc
+import itertools
+
+
+# Size in bytes of a binary SHA-1 commit hash.
+HASH_BYTES = 20
+
+
+class _RefTableItems(collections.abc.ItemsView):
+  """Items view that walks a RefTable in order without any lookups."""
+
+  def __iter__(self):
+    table = self._mapping
+    for i in range(len(table)):
+      yield table._name_at(i), table._hash_at(i)
+
+
+class RefTable(collections.abc.Mapping):
+  """Immutable mapping of git ref names to hex commit hashes.
+
+  Stores the git refs as sorted arrays rather than as individual objects. The
+  ref names are concatenated into a single string with an array of offsets
+  marking where each name starts. Commit hashes are packed back to back as 20
+  byte binary SHA-1s in a single bytes object. Ref name and hex commit hash
+  strings are only created on access.
+
+  Behaves like a read-only dictionary, so it can be used wherever git refs are
+  passed around as dictionaries.
+
+  Tables parsed from a ref advertisement can carry a validator, an opaque
+  string identifying that advertisement (ex: its HTTP ETag or a hash of its
+  bytes). A later poll returning the same validator advertises the same refs,
+  so the table can be reused without parsing the advertisement again.
+  """
+
+  __slots__ = ('_names', '_offsets', '_hashes', 'validator')
+
+  def __init__(self, refs=None):
+    """Create a new table.
+
+    Args:
+      refs: Optional dictionary of git ref names and hex commit hashes.
+    """
+    items = sorted((refs or {}).items())
+    self._set_names([name for (name, _) in items])
+    self._hashes = b''.join(
+        binascii.unhexlify(commit) for (_, commit) in items)
+    self.validator = None
+
+  @classmethod
+  def from_parsed(cls, names, hashes):
+    """Create a table from parsed ref names and binary commit hashes.
+
+    Args:
+      names: List of ref names in the order they were parsed.
+      hashes: Bytes-like object with the binary commit hash of each ref name,
+        back to back in the same order.
+    Returns:
+      A new RefTable. When a ref name appears more than once the last entry
+      wins.
+    """
+    table = cls()
+    if all(a < b for (a, b) in zip(names, names[1:])):
+      table._set_names(names)
+      table._hashes = bytes(hashes)
+      return table
+
+    # Servers normally advertise refs in sorted order. Fall back to sorting
+    # and de-duplicating when this one didn't.
+    latest = {}
+    for (i, name) in enumerate(names):
+      latest[name] = i
+    order = sorted(latest.items())
+    table._set_names([name for (name, _) in order])
+    table._hashes = b''.join(
+        hashes[i * HASH_BYTES:(i + 1) * HASH_BYTES] for (_, i) in order)
+    return table
+
+  def _set_names(self, names):
+    self._names = ''.join(names)
+    self._offsets = array.array(
+        'I', itertools.accumulate(itertools.chain([0], map(len, names))))
+
+  def _name_at(self, i):
+    return self._names[self._offsets[i]:self._offsets[i + 1]]
+
+  def _hash_at(self, i):
+    return self._hashes[i * HASH_BYTES:(i + 1) * HASH_BYTES].hex()
+
+  def _index(self, name):
+    low, high = 0, len(self)
+    while low < high:
+      middle = (low + high) // 2
+      if self._name_at(middle) < name:
+        low = middle + 1
+      else:
+        high = middle
+    if low < len(self) and self._name_at(low) == name:
+      return low
+    return None
+
+  def __getitem__(self, name):
+    i = self._index(name)
+    if i is None:
+      raise KeyError(name)
+    return self._hash_at(i)
+
+  def __contains__(self, name):
+    return self._index(name) is not None
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self._name_at(i)
+
+  def __len__(self):
+    return len(self._offsets) - 1
+
+  def __repr__(self):
+    return 'RefTable({!r})'.format(dict(self.items()))
+
+  def items(self):
+    return _RefTableItems(self)
+
+  def diff(self, previous):
+    """Compare against an older table of the same repository.
+
+    Walks both sorted tables in a single pass, comparing binary hashes without
+    creating any intermediate dictionaries. Unchanged tables are detected by
+    comparing the underlying buffers.
+
+    Args:
+      previous: The older RefTable.
+    Returns:
+      A (dict, list) tuple. The first item is a dictionary of the git refs
+      that are new or have a different commit hash in this table. The second
+      item lists the names of the git refs only present in previous.
+    """
+    if previous is self:
+      return {}, []
+    if self._names == previous._names and self._offsets == previous._offsets:
+      # Same ref names, so only the commit hashes could have changed.
+      if self._hashes == previous._hashes:
+        return {}, []
+      changed = {
+          self._name_at(i): self._hash_at(i)
+          for i in range(len(self))
+          if (self._hashes[i * HASH_BYTES:(i + 1) * HASH_BYTES] !=
+              previous._hashes[i * HASH_BYTES:(i + 1) * HASH_BYTES])}
+      return changed, []
+
+    changed = {}
+    deleted = []
+    count, previous_count = len(self), len(previous)
+    i = j = 0
+    while i < count or j < previous_count:
+      name = self._name_at(i) if i < count else None
+      previous_name = previous._name_at(j) if j < previous_count else None
+      if previous_name is None or (name is not None and name < previous_name):
+        changed[name] = self._hash_at(i)
+        i += 1
+      elif name is None or previous_name < name:
+        deleted.append(previous_name)
+        j += 1
+      else:
+        if (self._hashes[i * HASH_BYTES:(i + 1) * HASH_BYTES] !=
+            previous._hashes[j * HASH_BYTES:(j + 1) * HASH_BYTES]):
+          changed[name] = self._hash_at(i)
+        i += 1
+        j += 1
+    return changed, deleted
+
+
+def diff_refs(previous_refs, current_refs):
+  """Find the git refs that were added, updated or deleted.
+
+  Args:
+    previous_refs: Dictionary or RefTable of git refs to compare against.
+    current_refs: Dictionary or RefTable of git refs possibly containing new
+      entries, updates or deletions.
+  Returns:
+    A (dict, list) tuple. The first item is a dictionary of the new and updated
+    git refs found in current_refs. The second item lists the names of the git
+    refs missing from current_refs.
+  """
+  if isinstance(previous_refs, RefTable) and isinstance(current_refs, RefTable):
+    return current_refs.diff(previous_refs)
+
+  changed = {
+      refname: commit for (refname, commit) in current_refs.items()
+      if previous_refs.get(refname) != commit}
+  deleted = [
+      refname for refname in previous_refs if refname not in current_refs]
+  return changed, deleted
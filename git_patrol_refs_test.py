@@ -0,0 +1,82 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the Git Patrol ref table."""
+
+import binascii
+import unittest
+
+import git_patrol_refs
+
+
+class GitPatrolRefsTest(unittest.TestCase):
+
+  def setUp(self):
+    super(GitPatrolRefsTest, self).setUp()
+    self._refs = {
+        'refs/heads/master': '039de508998f3676871ed8cc00e3b33f0f95f7cb',
+        'refs/heads/branch0': 'c589a4d44889afa2e6f811852b4575df7287abcd',
+        'refs/tags/tag0': 'aaa2aa362047ec750359ccf42eee159db5f62726',
+        'refs/tags/tag1': 'bbb7626c1d6b48d5509db048e290b1642a6766c4'}
+
+  def testMappingInterface(self):
+    table = git_patrol_refs.RefTable(self._refs)
+    self.assertEqual(len(table), len(self._refs))
+    self.assertEqual(table, self._refs)
+    self.assertEqual(list(table), sorted(self._refs))
+    self.assertEqual(table['refs/tags/tag0'], self._refs['refs/tags/tag0'])
+    self.assertIn('refs/heads/master', table)
+    self.assertNotIn('refs/heads/missing', table)
+    self.assertIsNone(table.get('refs/heads/missing'))
+    self.assertFalse(git_patrol_refs.RefTable())
+
+  def testFromParsedUnsorted(self):
+    names = ['refs/tags/tag0', 'refs/heads/master', 'refs/tags/tag0']
+    hashes = b''.join(binascii.unhexlify(commit) for commit in [
+        self._refs['refs/tags/tag1'], self._refs['refs/heads/master'],
+        self._refs['refs/tags/tag0']])
+    table = git_patrol_refs.RefTable.from_parsed(names, bytearray(hashes))
+
+    # The last entry for a duplicated ref name wins.
+    self.assertEqual(
+        table,
+        {'refs/heads/master': self._refs['refs/heads/master'],
+         'refs/tags/tag0': self._refs['refs/tags/tag0']})
+
+  def testDiff(self):
+    current_refs = dict(self._refs)
+    del current_refs['refs/heads/branch0']
+    current_refs['refs/heads/master'] = self._refs['refs/tags/tag0']
+    current_refs['refs/tags/tag2'] = self._refs['refs/tags/tag1']
+
+    expected_changed = {
+        'refs/heads/master': self._refs['refs/tags/tag0'],
+        'refs/tags/tag2': self._refs['refs/tags/tag1']}
+    expected_deleted = ['refs/heads/branch0']
+
+    previous_table = git_patrol_refs.RefTable(self._refs)
+    current_table = git_patrol_refs.RefTable(current_refs)
+    self.assertEqual(
+        current_table.diff(previous_table),
+        (expected_changed, expected_deleted))
+    self.assertEqual(current_table.diff(current_table), ({}, []))
+
+    # Plain dictionaries produce the same result.
+    self.assertEqual(
+        git_patrol_refs.diff_refs(self._refs, current_refs),
+        (expected_changed, expected_deleted))
+
+
+if __name__ == '__main__':
+  unittest.main()
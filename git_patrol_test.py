@@ -15,7 +15,9 @@
 """Tests for git_patrol."""
 
 import asyncio
+import collections
 import datetime
+import functools
 import logging
 import json
 import os
@@ -27,9 +29,28 @@ import unittest.mock
 import uuid
 
 import git_patrol
+import git_patrol_refs
 import yaml
 
 
+class _FakeStream():
+  """Fake version of the asyncio.StreamReader class.
+
+  Provides the parts of the asyncio.StreamReader class used by Git Patrol to
+  read the output of a subprocess.
+  """
+
+  def __init__(self, data):
+    self._data = data
+    self._pos = 0
+
+  async def read(self, n=-1):
+    end = len(self._data) if n < 0 else self._pos + n
+    data = self._data[self._pos:end]
+    self._pos += len(data)
+    return data
+
+
 class _FakeProcess():
   """Fake version of asyncio.subprocess.Process class.
 
@@ -42,6 +63,8 @@ class _FakeProcess():
     self._returncode = returncode
     self._stdout = stdout
     self._stderr = stderr
+    self.stdout = _FakeStream(stdout)
+    self.stderr = _FakeStream(stderr)
 
   async def wait(self):
     return self._returncode
@@ -49,6 +72,9 @@ class _FakeProcess():
   async def communicate(self):
     return self._stdout, self._stderr
 
+  def kill(self):
+    self._returncode = -9
+
 
 def _MakeFakeCommand(returncode_fn=None, stdout_fn=None, stderr_fn=None):
   """Construct a coroutine to return a FakeProcess.
@@ -134,9 +160,13 @@ def AsyncioMock(*args, **kwargs):
 
 class MockGitPatrolDb():
 
-  def __init__(self, record_git_poll=None, record_cloud_build=None):
+  def __init__(
+      self, record_git_poll=None, record_cloud_build=None,
+      fetch_unfinished_workflows=None, record_workflows=False):
+    self.record_workflows = record_workflows
     self.record_git_poll = record_git_poll
     self.record_cloud_build = record_cloud_build
+    self.fetch_unfinished_workflows = fetch_unfinished_workflows
 
 
 class GitPatrolTest(unittest.TestCase):
@@ -211,7 +241,7 @@ class GitPatrolTest(unittest.TestCase):
     ref_filters = []
     refs = asyncio.get_event_loop().run_until_complete(
         git_patrol.fetch_git_refs(commands, upstream_url, ref_filters))
-    self.assertDictEqual(refs, self._refs)
+    self.assertDictEqual(dict(refs), self._refs)
 
   def testFetchGitRefsFilteredSuccess(self):
     commands = git_patrol.GitPatrolCommands()
@@ -221,9 +251,163 @@ class GitPatrolTest(unittest.TestCase):
     refs = asyncio.get_event_loop().run_until_complete(
         git_patrol.fetch_git_refs(commands, upstream_url, ref_filters))
     self.assertDictEqual(
-        refs,
+        dict(refs),
         {k: v for k, v in self._refs.items() if k.startswith('refs/tags/')})
 
+  def testFetchGitRefsUnchanged(self):
+    commands = git_patrol.GitPatrolCommands()
+
+    upstream_url = 'file://' + self._upstream_dir
+    loop = asyncio.get_event_loop()
+    refs = loop.run_until_complete(
+        git_patrol.fetch_git_refs(commands, upstream_url, []))
+    self.assertTrue(refs.validator)
+
+    # Unchanged refs are detected without building a new ref table.
+    with unittest.mock.patch.object(
+        git_patrol_refs.RefTable, 'from_parsed') as mock_from_parsed:
+      unchanged_refs = loop.run_until_complete(
+          git_patrol.fetch_git_refs(commands, upstream_url, [], refs))
+    self.assertIs(unchanged_refs, refs)
+    mock_from_parsed.assert_not_called()
+
+    proc = loop.run_until_complete(asyncio.create_subprocess_exec(
+        'git', 'tag', 'r0003', cwd=self._upstream_dir))
+    self.assertEqual(loop.run_until_complete(proc.wait()), 0)
+
+    with unittest.mock.patch.object(git_patrol, 'LS_REMOTE_CHUNK_BYTES', 7):
+      updated_refs = loop.run_until_complete(
+          git_patrol.fetch_git_refs(commands, upstream_url, [], refs))
+    expected_refs = dict(self._refs)
+    expected_refs['refs/tags/r0003'] = self._refs['refs/heads/master']
+    self.assertDictEqual(dict(updated_refs), expected_refs)
+    self.assertNotEqual(updated_refs.validator, refs.validator)
+
+  def testReadGitRefsStreamsChangedOutput(self):
+    refs = git_patrol_refs.RefTable(self._refs)
+    refs.validator = 'sha1:previous'
+    line = '{}\trefs/heads/master\n'.format(
+        self._refs['refs/heads/master']).encode()
+
+    # Output compared with the previous refs is only parsed once it ended,
+    # but the ref limit still trips before the output ends.
+    loop = asyncio.get_event_loop()
+    stream = asyncio.StreamReader()
+    stream.feed_data(line * 3)
+    with self.assertRaises(git_patrol.RefLimitExceeded):
+      loop.run_until_complete(asyncio.wait_for(
+          git_patrol.read_git_refs(stream, 2, None, refs), 5))
+
+  def testReadGitRefsHashesBeforeParsing(self):
+    output = ''.join(
+        '{}\t{}\n'.format(v, k) for k, v in self._refs.items()).encode()
+    loop = asyncio.get_event_loop()
+
+    def read(previous_refs=None):
+      stream = asyncio.StreamReader()
+      stream.feed_data(output)
+      stream.feed_eof()
+      return loop.run_until_complete(
+          git_patrol.read_git_refs(stream, None, None, previous_refs))
+
+    refs, bytes_read = read()
+    self.assertDictEqual(dict(refs), self._refs)
+    self.assertEqual(bytes_read, len(output))
+
+    # Unchanged output is recognized by its hash without parsing any line.
+    with unittest.mock.patch.object(
+        git_patrol, 'GIT_HASH_REFNAME_BYTES_REGEX') as mock_regex:
+      unchanged_refs, _ = read(refs)
+    self.assertIs(unchanged_refs, refs)
+    mock_regex.finditer.assert_not_called()
+
+    # Changed output is parsed from the spooled copy.
+    refs.validator = 'sha1:previous'
+    with unittest.mock.patch.object(git_patrol, 'LS_REMOTE_CHUNK_BYTES', 7):
+      changed_refs, _ = read(refs)
+    self.assertIsNot(changed_refs, refs)
+    self.assertDictEqual(dict(changed_refs), self._refs)
+
+  def testFetchGitRefsProtocolV2RefPrefixes(self):
+    ls_remote_stdout = '\n'.join(
+        '{}\t{}'.format(v, k) for k, v in self._refs.items()
+        if k.startswith('refs/tags/')).encode()
+
+    def make_commands(git_version):
+      def git_stdout(*args, count):
+        if args[0] == 'version':
+          return 'git version {}\n'.format(git_version).encode()
+        return ls_remote_stdout
+      commands = git_patrol.GitPatrolCommands()
+      commands.git = unittest.mock.MagicMock()
+      commands.git.side_effect = _MakeFakeCommand(stdout_fn=git_stdout)
+      return commands
+
+    upstream_url = 'file://' + self._upstream_dir
+    ref_filters = ['refs/tags/r*']
+    loop = asyncio.get_event_loop()
+    commands = make_commands('2.20.1')
+    for _ in range(2):
+      refs = loop.run_until_complete(
+          git_patrol.fetch_git_refs(commands, upstream_url, ref_filters))
+      self.assertDictEqual(
+          dict(refs),
+          {k: v for k, v in self._refs.items() if k.startswith('refs/tags/')})
+
+    # The git version is only checked once.
+    self.assertEqual(commands.git.call_args_list, [
+        unittest.mock.call('version')] + [unittest.mock.call(
+            '-c', 'protocol.version=2', 'ls-remote', '--refs', '--tags',
+            upstream_url, 'refs/tags/r*')] * 2)
+
+    # Git releases without protocol version 2 reject the setting.
+    commands = make_commands('2.17.1')
+    loop.run_until_complete(
+        git_patrol.fetch_git_refs(commands, upstream_url, ref_filters))
+    commands.git.assert_called_with(
+        'ls-remote', '--refs', '--tags', upstream_url, 'refs/tags/r*')
+
+  def testFetchGitRefsLimits(self):
+    ls_remote_stdout = ''.join(
+        '{}\t{}\n'.format(v, k) for k, v in self._refs.items()).encode()
+
+    commands = git_patrol.GitPatrolCommands()
+    commands.git = unittest.mock.MagicMock()
+    commands.git.side_effect = _MakeFakeCommand(
+        stdout_fn=lambda *args, count: ls_remote_stdout)
+
+    upstream_url = 'file://' + self._upstream_dir
+    loop = asyncio.get_event_loop()
+
+    # Read the output in tiny chunks to exercise lines split across chunks.
+    with unittest.mock.patch.object(git_patrol, 'LS_REMOTE_CHUNK_BYTES', 7):
+      refs = loop.run_until_complete(
+          git_patrol.fetch_git_refs(commands, upstream_url, []))
+    self.assertDictEqual(dict(refs), self._refs)
+
+    commands.max_refs = len(self._refs) - 1
+    refs = loop.run_until_complete(
+        git_patrol.fetch_git_refs(commands, upstream_url, []))
+    self.assertIsNone(refs)
+
+    commands.max_refs = None
+    commands.max_ref_bytes = len(ls_remote_stdout) - 1
+    refs = loop.run_until_complete(
+        git_patrol.fetch_git_refs(commands, upstream_url, []))
+    self.assertIsNone(refs)
+
+  def testLsRemoteNamespaceArgs(self):
+    self.assertEqual(git_patrol.ls_remote_namespace_args([]), [])
+    self.assertEqual(
+        git_patrol.ls_remote_namespace_args(
+            ['refs/tags/v*', 'refs/heads/release-*']),
+        ['--heads', '--tags'])
+    self.assertEqual(
+        git_patrol.ls_remote_namespace_args(['refs/tags/*', 'refs/changes/*']),
+        [])
+    self.assertEqual(
+        git_patrol.ls_remote_namespace_args(['refs/heads/*', 'master']), [])
+
   def testWorkflowNotTriggered(self):
     commands = git_patrol.GitPatrolCommands()
 
@@ -286,7 +470,7 @@ class GitPatrolTest(unittest.TestCase):
         ['refs/heads/master', 'refs/tags/r0001', 'refs/tags/r0002'],
         list(record_git_poll_args[4].keys()))
 
-    self.assertDictEqual(current_refs, self._refs)
+    self.assertDictEqual(dict(current_refs), self._refs)
     self.assertDictEqual(new_refs, self._refs)
 
   def testRunOneWorkflowSuccess(self):
@@ -371,13 +555,17 @@ class GitPatrolTest(unittest.TestCase):
     commands.gcloud.assert_any_call(
         'builds', 'describe', '--format=json', cloud_build_uuid)
 
-    # We know the method will be called with only positional arguments so we
-    # can unpack call_args_list to discard the unused kwargs.
-    record_cloud_build_args = [
-        args for (args, _) in mock_record_cloud_build.inner_mock.call_args_list]
+    # The workflow alias is passed as a keyword argument, so unpack
+    # call_args_list into both.
+    record_cloud_build_calls = (
+        mock_record_cloud_build.inner_mock.call_args_list)
+    record_cloud_build_args = [args for (args, _) in record_cloud_build_calls]
 
     # There should be two calls to "record_cloud_build()".
     self.assertEqual(len(record_cloud_build_args), 2)
+    self.assertEqual(
+        [kwargs['workflow'] for (_, kwargs) in record_cloud_build_calls],
+        ['first', 'first'])
 
     # The first call should have parent_id set to "0", indicating this is the
     # first entry. The second call should have parent_id set to "1", indicating
@@ -394,5 +582,695 @@ class GitPatrolTest(unittest.TestCase):
         record_cloud_build_args[1][5].items(),
         json.loads(cloud_build_json[1].decode('utf-8', 'ignore')).items())
 
+  def testRunWorkflowBodyRecordsPendingWorkflows(self):
+    build_id = '7d1bb5a7-545f-4c30-b640-f5461036e2e7'
+
+    def gcloud_builds_stdout(*args, count):
+      if args[1] == 'submit':
+        return '{} QUEUED'.format(build_id).encode()
+      if args[1] == 'log':
+        return b''
+      if args[1] == 'describe':
+        status = 'SUCCESS' if count else 'QUEUED'
+        return json.dumps({'id': build_id, 'status': status}).encode()
+      raise ValueError('Unexpected gcloud command: {}'.format(args[1]))
+
+    commands = git_patrol.GitPatrolCommands()
+    commands.gcloud = unittest.mock.MagicMock()
+    commands.gcloud.side_effect = _MakeFakeCommand(
+        stdout_fn=gcloud_builds_stdout)
+    mock_record_cloud_build = AsyncioMock(side_effect=range(1, 100))
+    mock_db = MockGitPatrolDb(
+        record_cloud_build=mock_record_cloud_build, record_workflows=True)
+
+    target_config = yaml.safe_load(
+        """
+        alias: upstream
+        workflows:
+        - alias: first
+          config: first.yaml
+        """)
+    workflow_success = asyncio.get_event_loop().run_until_complete(
+        git_patrol.run_workflow_body(
+            commands, mock_db, '/some/path', target_config, uuid.uuid4(),
+            ('refs/heads/master', 'deadbeef')))
+    self.assertTrue(workflow_success)
+
+    # The chain starts with a PENDING entry it can be resumed from.
+    calls = mock_record_cloud_build.inner_mock.call_args_list
+    self.assertEqual(
+        [(args[0], kwargs['workflow'], args[5]['status'])
+         for (args, kwargs) in calls],
+        [(0, 'first', 'PENDING'), (1, 'first', 'QUEUED'),
+         (2, 'first', 'SUCCESS')])
+
+  def testCheckResumable(self):
+    git_patrol.check_resumable(yaml.safe_load(
+        """
+        alias: upstream
+        workflows:
+        - alias: first
+          config: first.yaml
+        - alias: second
+          config: first.yaml
+        """))
+    with self.assertRaisesRegex(ValueError, 'needs an alias'):
+      git_patrol.check_resumable(yaml.safe_load(
+          """
+          alias: upstream
+          workflows:
+          - alias: first
+            config: first.yaml
+          - config: second.yaml
+          """))
+    with self.assertRaisesRegex(ValueError, 'more than once'):
+      git_patrol.check_resumable(yaml.safe_load(
+          """
+          alias: upstream
+          workflows:
+          - alias: first
+            config: first.yaml
+          - alias: first
+            config: second.yaml
+          """))
+
+  def testResumeWorkflows(self):
+    running_build_id = '16fd2706-8baf-433b-82eb-8c7fada847da'
+    new_build_id = '7d1bb5a7-545f-4c30-b640-f5461036e2e7'
+
+    def gcloud_builds_stdout(*args, count):
+      if args[1] == 'submit':
+        return '{} QUEUED'.format(new_build_id).encode()
+      if args[1] == 'log':
+        return b''
+      if args[1] == 'describe':
+        return json.dumps({'id': args[-1], 'status': 'SUCCESS'}).encode()
+      raise ValueError('Unexpected gcloud command: {}'.format(args[1]))
+
+    commands = git_patrol.GitPatrolCommands()
+    commands.gcloud = unittest.mock.MagicMock()
+    commands.gcloud.side_effect = _MakeFakeCommand(
+        stdout_fn=gcloud_builds_stdout)
+
+    target_config = yaml.safe_load(
+        """
+        alias: upstream
+        workflows:
+        - alias: first
+          config: first.yaml
+        - alias: second
+          config: second.yaml
+        """)
+    git_poll_uuid = uuid.uuid4()
+
+    def chain(journal_id, commit, workflow, status):
+      return {
+          'journal_id': journal_id, 'git_poll_uuid': git_poll_uuid,
+          'alias': 'upstream', 'ref': ['refs/heads/master', commit],
+          'workflow': workflow, 'cloud_build_status': status}
+
+    mock_fetch_unfinished_workflows = AsyncioMock(return_value=[
+        chain(10, 'pending', 'first', {'status': 'PENDING'}),
+        chain(20, 'running', 'first',
+              {'id': running_build_id, 'status': 'WORKING'}),
+        chain(30, 'halfway', 'first', {'status': 'SUCCESS'}),
+        chain(40, 'done', 'second', {'status': 'SUCCESS'}),
+        chain(50, 'removed', 'third', {'status': 'PENDING'})])
+    mock_record_cloud_build = AsyncioMock(side_effect=range(100, 200))
+    mock_db = MockGitPatrolDb(
+        record_cloud_build=mock_record_cloud_build,
+        fetch_unfinished_workflows=mock_fetch_unfinished_workflows,
+        record_workflows=True)
+
+    since = datetime.datetime(2019, 1, 1)
+    resumed = asyncio.get_event_loop().run_until_complete(
+        git_patrol.resume_workflows(
+            commands, mock_db, '/some/path', [target_config], since))
+    self.assertEqual(resumed, 3)
+    mock_fetch_unfinished_workflows.inner_mock.assert_called_once_with(
+        ['upstream'], since)
+
+    # The running build is waited for rather than started again, and each
+    # chain continues from its latest journal entry.
+    commands.gcloud.assert_any_call(
+        'builds', 'log', '--stream', '--no-user-output-enabled',
+        running_build_id)
+    gcloud_subcommands = [
+        args[1] for (args, _) in commands.gcloud.call_args_list]
+    self.assertEqual(gcloud_subcommands.count('submit'), 4)
+    entries = collections.defaultdict(list)
+    for (args, kwargs) in mock_record_cloud_build.inner_mock.call_args_list:
+      entries[args[4][1]].append((kwargs['workflow'], args[5]['status']))
+    self.assertEqual(entries['pending'], [
+        ('first', 'SUCCESS'), ('first', 'SUCCESS'), ('second', 'SUCCESS'),
+        ('second', 'SUCCESS')])
+    self.assertEqual(entries['running'], [
+        ('first', 'SUCCESS'), ('second', 'SUCCESS'), ('second', 'SUCCESS')])
+    self.assertEqual(
+        entries['halfway'], [('second', 'SUCCESS'), ('second', 'SUCCESS')])
+    self.assertNotIn('done', entries)
+    self.assertNotIn('removed', entries)
+    parent_ids = {
+        args[4][1]: args[0] for (args, _) in reversed(
+            mock_record_cloud_build.inner_mock.call_args_list)}
+    self.assertEqual(
+        parent_ids, {'pending': 10, 'running': 20, 'halfway': 30})
+
+  def testWorkflowNeeds(self):
+    def needs(workflows):
+      return git_patrol.workflow_needs(
+          {'alias': 'upstream', 'workflows': yaml.safe_load(workflows)})
+
+    # Without any needs, workflows run in the order they are listed.
+    self.assertEqual(
+        needs('[{alias: a}, {alias: b}, {alias: c}]'), [[], [0], [1]])
+    self.assertEqual(
+        needs('[{alias: a}, {alias: b}, {alias: c, needs: [a, b]}]'),
+        [[], [], [0, 1]])
+    self.assertEqual(
+        needs('[{alias: a}, {alias: b, needs: a}]'), [[], [0]])
+    for workflows in ('[{alias: a, needs: [a]}]',
+                      '[{alias: a, needs: [b]}, {alias: b}]',
+                      '[{alias: a}, {alias: b, needs: {a: 1}}]'):
+      with self.assertRaises(ValueError):
+        needs(workflows)
+
+  def testRunWorkflowGraph(self):
+    # Every workflow gets its own build ID, and the 'broken' one fails.
+    build_ids = {}
+    def gcloud_builds_stdout(*args, count):
+      if args[1] == 'submit':
+        workflow = os.path.basename(args[3]).split('.')[0]
+        build_ids.setdefault(str(uuid.uuid4()), workflow)
+        return '{} QUEUED'.format(list(build_ids)[-1]).encode()
+      if args[1] == 'log':
+        return b''
+      if args[1] == 'describe':
+        status = 'QUEUED'
+        if count:
+          status = 'FAILURE' if build_ids[args[-1]] == 'broken' else 'SUCCESS'
+        return json.dumps({'id': args[-1], 'status': status}).encode()
+      raise ValueError('Unexpected gcloud command: {}'.format(args[1]))
+
+    commands = git_patrol.GitPatrolCommands()
+    commands.gcloud = unittest.mock.MagicMock()
+    commands.gcloud.side_effect = _MakeFakeCommand(
+        stdout_fn=gcloud_builds_stdout)
+
+    # Journal IDs are the position of each entry in the journal. The 'lint'
+    # workflow only finishes once the 'test' workflow started its build.
+    journal = []
+    test_started = asyncio.Event()
+    async def record_cloud_build(
+        parent_id, git_poll_uuid, utc_datetime, alias, git_ref, status,
+        workflow=None):
+      if workflow == 'test' and status['status'] == 'QUEUED':
+        test_started.set()
+      if workflow == 'lint' and status['status'] == 'SUCCESS':
+        await asyncio.wait_for(test_started.wait(), 5)
+      journal.append((parent_id, workflow, status['status']))
+      return len(journal)
+    mock_db = MockGitPatrolDb(
+        record_cloud_build=record_cloud_build, record_workflows=True)
+
+    target_config = yaml.safe_load(
+        """
+        alias: upstream
+        workflows:
+        - alias: lint
+          config: lint.yaml
+        - alias: test
+          config: test.yaml
+        - alias: package
+          config: package.yaml
+          needs: [lint, test]
+        - alias: broken
+          config: broken.yaml
+        - alias: deploy
+          config: deploy.yaml
+          needs: [package, broken]
+        """)
+
+    workflow_success = asyncio.get_event_loop().run_until_complete(
+        git_patrol.run_workflow_body(
+            commands, mock_db, '/some/path', target_config, uuid.uuid4(),
+            ('refs/heads/master', 'deadbeef')))
+    self.assertFalse(workflow_success)
+
+    # Workflows that need nothing start together, each from its own PENDING
+    # entry, and each workflow continues from the first workflow it needs.
+    entries = collections.defaultdict(list)
+    for (journal_id, (parent_id, workflow, status)) in enumerate(journal, 1):
+      entries[workflow].append((journal_id, parent_id, status))
+    self.assertEqual(
+        [status for (_, _, status) in entries['lint']],
+        ['PENDING', 'QUEUED', 'SUCCESS'])
+    for workflow in ('lint', 'test', 'broken'):
+      self.assertEqual(entries[workflow][0][1], 0)
+    for chain in entries.values():
+      for (previous, entry) in zip(chain, chain[1:]):
+        self.assertEqual(entry[1], previous[0])
+    self.assertEqual(entries['package'][0][1], entries['lint'][-1][0])
+    self.assertEqual(entries['package'][-1][2], 'SUCCESS')
+
+    # The failed workflow only holds back the workflows that need it.
+    self.assertEqual(entries['broken'][-1][2], 'FAILURE')
+    self.assertNotIn('deploy', entries)
+
+  def testWorkflowResumePointGraph(self):
+    target_config = yaml.safe_load(
+        """
+        alias: upstream
+        workflows:
+        - alias: lint
+          config: lint.yaml
+        - alias: test
+          config: test.yaml
+        - alias: package
+          config: package.yaml
+          needs: [lint, test]
+        """)
+    self.assertEqual(
+        git_patrol.workflow_resume_point(target_config, {
+            'lint': (5, {'id': 'a', 'status': 'SUCCESS'}),
+            'test': (4, {'id': 'b', 'status': 'WORKING'})}),
+        git_patrol.WorkflowResume({0: (True, 5)}, {1: 4}, {1: 'b'}))
+    self.assertIsNone(
+        git_patrol.workflow_resume_point(target_config, {
+            'lint': (5, {'id': 'a', 'status': 'SUCCESS'}),
+            'test': (6, {'id': 'b', 'status': 'FAILURE'})}))
+    self.assertIsNone(
+        git_patrol.workflow_resume_point(target_config, {
+            'lint': (5, {'id': 'a', 'status': 'SUCCESS'}),
+            'test': (6, {'status': 'SUPERSEDED'})}))
+
+  def testUrlHost(self):
+    self.assertEqual(
+        git_patrol.url_host('https://user@example.com:8443/repo.git'),
+        'example.com')
+    self.assertEqual(
+        git_patrol.url_host('git@github.com:google/git-patrol.git'),
+        'github.com')
+    self.assertEqual(git_patrol.url_host('file:///tmp/repo.git'), '')
+    self.assertEqual(git_patrol.url_host('/tmp/repo.git'), '')
+
+  def testPollSchedulerLimits(self):
+    loop = asyncio.get_event_loop()
+    scheduler = git_patrol.PollScheduler(max_workers=2, max_per_host=1)
+
+    running = {'a.com': 0, 'b.com': 0}
+    max_running = {'a.com': 0, 'b.com': 0}
+    order = []
+
+    async def poll(host, name):
+      order.append(name)
+      running[host] += 1
+      max_running[host] = max(max_running[host], running[host])
+      await asyncio.sleep(0.01)
+      running[host] -= 1
+      return name
+
+    async def run_polls():
+      scheduler_task = asyncio.ensure_future(scheduler.run())
+      # Submit in reverse due time order. The scheduler should still run the
+      # polls for each host in due time order.
+      results = await asyncio.gather(*[
+          scheduler.submit(
+              due_time, 'https://{}/repo.git'.format(host),
+              functools.partial(poll, host, name))
+          for (due_time, host, name) in [
+              (3, 'a.com', 'a3'), (2, 'a.com', 'a2'), (1, 'a.com', 'a1'),
+              (4, 'b.com', 'b4')]])
+      scheduler_task.cancel()
+      return results
+
+    results = loop.run_until_complete(run_polls())
+    self.assertEqual(results, ['a3', 'a2', 'a1', 'b4'])
+    self.assertEqual(max_running, {'a.com': 1, 'b.com': 1})
+    self.assertEqual(
+        [name for name in order if name.startswith('a')], ['a1', 'a2', 'a3'])
+
+  def testWorkflowDispatcherLimits(self):
+    dispatcher = git_patrol.WorkflowDispatcher(
+        max_builds=3, max_builds_per_alias=2)
+    configs = yaml.safe_load(
+        """
+        - alias: first
+          workflows:
+          - alias: one
+            config: one.yaml
+            max_concurrent_builds: 1
+          - alias: two
+            config: two.yaml
+        - alias: second
+          max_concurrent_builds: 3
+          workflows:
+          - alias: three
+            config: three.yaml
+        """)
+
+    running = collections.Counter()
+    max_running = collections.Counter()
+
+    async def build(config, workflow):
+      keys = ['all', config['alias'], workflow['alias']]
+      async with dispatcher.build_slot(config, workflow):
+        running.update(keys)
+        for key in keys:
+          max_running[key] = max(max_running[key], running[key])
+        await asyncio.sleep(0.01)
+        running.subtract(keys)
+
+    for _ in range(4):
+      for config in configs:
+        for workflow in config['workflows']:
+          dispatcher.dispatch(build(config, workflow))
+    asyncio.get_event_loop().run_until_complete(dispatcher.join())
+
+    limits = {'all': 3, 'first': 2, 'one': 1, 'two': 2, 'second': 3}
+    for (key, limit) in limits.items():
+      self.assertLessEqual(max_running[key], limit)
+    self.assertEqual(max_running['all'], 3)
+    self.assertEqual(sum(running.values()), 0)
+
+  def testWorkflowDispatcherShutdown(self):
+    finished = []
+    async def workflow(seconds):
+      await asyncio.sleep(seconds)
+      finished.append(seconds)
+
+    async def dispatch_and_shutdown():
+      dispatcher = git_patrol.WorkflowDispatcher()
+      tasks = [dispatcher.dispatch(workflow(s)) for s in (0, 0.01, 3600)]
+      await dispatcher.shutdown(0.2)
+      return tasks
+
+    # Workflows finishing in time complete and the others are cancelled.
+    tasks = asyncio.get_event_loop().run_until_complete(
+        dispatch_and_shutdown())
+    self.assertEqual(finished, [0, 0.01])
+    self.assertTrue(tasks[2].cancelled())
+
+  def testWorkflowDispatcherCoalescing(self):
+    build_json = {'id': '7d1bb5a7-545f-4c30-b640-f5461036e2e7'}
+
+    def gcloud_builds_stdout(*args, count):
+      if args[1] == 'submit':
+        return '{} QUEUED'.format(build_json['id']).encode()
+      if args[1] == 'log':
+        return b''
+      if args[1] == 'describe':
+        return json.dumps(dict(build_json, status='SUCCESS')).encode()
+      raise ValueError('Unexpected gcloud command: {}'.format(args[1]))
+
+    commands = git_patrol.GitPatrolCommands()
+    commands.gcloud = unittest.mock.MagicMock()
+    commands.gcloud.side_effect = _MakeFakeCommand(
+        stdout_fn=gcloud_builds_stdout)
+    mock_record_cloud_build = AsyncioMock(side_effect=range(1, 100))
+    mock_db = MockGitPatrolDb(record_cloud_build=mock_record_cloud_build)
+    dispatcher = git_patrol.WorkflowDispatcher(max_builds=1, coalesce=True)
+
+    target_config = yaml.safe_load(
+        """
+        alias: upstream
+        workflows:
+        - alias: first
+          config: first.yaml
+        """)
+    git_poll_uuid = uuid.uuid4()
+
+    # Three commits of the same git ref queue up while the only build slot is
+    # taken. Only the newest one gets built.
+    async def run_workflows():
+      async with dispatcher.build_slot(
+          target_config, target_config['workflows'][0]):
+        for commit in ['c1', 'c2', 'c3']:
+          dispatcher.dispatch(git_patrol.run_workflow_body(
+              commands, mock_db, '/some/path', target_config, git_poll_uuid,
+              ('refs/heads/master', commit), dispatcher=dispatcher))
+        await asyncio.sleep(0)
+      await dispatcher.join()
+
+    asyncio.get_event_loop().run_until_complete(run_workflows())
+
+    gcloud_subcommands = [
+        args[1] for (args, _) in commands.gcloud.call_args_list]
+    self.assertEqual(gcloud_subcommands.count('submit'), 1)
+    self.assertEqual(
+        [(args[4][1], args[5].get('status'), args[5].get('supersededBy'))
+         for (args, _) in mock_record_cloud_build.inner_mock.call_args_list],
+        [('c1', 'SUPERSEDED', 'c2'), ('c2', 'SUPERSEDED', 'c3'),
+         ('c3', 'SUCCESS', None), ('c3', 'SUCCESS', None)])
+
+  def testWorkflowDispatcherFailedThenSuperseded(self):
+    build_id = '7d1bb5a7-545f-4c30-b640-f5461036e2e7'
+
+    def gcloud_builds_stdout(*args, count):
+      if args[1] == 'submit':
+        return '{} QUEUED'.format(build_id).encode()
+      if args[1] == 'log':
+        return b''
+      if args[1] == 'describe':
+        status = 'FAILURE' if count else 'QUEUED'
+        return json.dumps({'id': build_id, 'status': status}).encode()
+      raise ValueError('Unexpected gcloud command: {}'.format(args[1]))
+
+    # A newer commit of the git ref arrives while the build runs.
+    fake_gcloud = _MakeFakeCommand(stdout_fn=gcloud_builds_stdout)
+    async def gcloud(*args):
+      if args[1] == 'log':
+        dispatcher.open_ticket(
+            commands, 'upstream', ('refs/heads/master', 'c2'))
+      return await fake_gcloud(*args)
+
+    commands = git_patrol.GitPatrolCommands()
+    commands.gcloud = gcloud
+    mock_record_cloud_build = AsyncioMock(side_effect=range(1, 100))
+    mock_db = MockGitPatrolDb(record_cloud_build=mock_record_cloud_build)
+    dispatcher = git_patrol.WorkflowDispatcher(coalesce=True)
+
+    target_config = yaml.safe_load(
+        """
+        alias: upstream
+        workflows:
+        - alias: first
+          config: first.yaml
+        - alias: second
+          config: second.yaml
+        """)
+    workflow_success = asyncio.get_event_loop().run_until_complete(
+        git_patrol.run_workflow_body(
+            commands, mock_db, '/some/path', target_config, uuid.uuid4(),
+            ('refs/heads/master', 'c1'), dispatcher=dispatcher))
+    self.assertFalse(workflow_success)
+
+    # The build failed on its own, so the chain ends with its failure.
+    calls = mock_record_cloud_build.inner_mock.call_args_list
+    self.assertEqual(
+        [(kwargs['workflow'], args[5]['status']) for (args, kwargs) in calls],
+        [('first', 'QUEUED'), ('first', 'FAILURE')])
+
+  def testCheckRefFormatMatchesGit(self):
+    ref_filters = [
+        'master', 'refs/heads/*', 'refs/tags/v1.*', 'refs/*/release-*',
+        'refs/heads/feature.x', 'HEAD', '', '@', 'refs/heads/', '/refs',
+        'refs//heads', 'refs/heads/.hidden', 'refs/heads/x.lock',
+        'refs/heads/x.', 'refs/a..b', 'refs/heads/a@{1}', 'refs/*/*',
+        'refs/heads/a b', 'refs/heads/a~1', 'refs/heads/a^', 'refs/heads/a:b',
+        'refs/heads/a?', 'refs/heads/[ab]', 'refs/heads/a\\b',
+        'refs/heads/a\tb', 'refs/heads/@', 'refs/heads/a@b']
+    commands = git_patrol.GitPatrolCommands()
+
+    async def git_check_ref_format(ref_filter):
+      git_subproc = await commands.git(
+          'check-ref-format', '--allow-onelevel', '--refspec-pattern',
+          ref_filter)
+      await git_subproc.communicate()
+      return await git_subproc.wait() == 0
+
+    expected = asyncio.get_event_loop().run_until_complete(
+        asyncio.gather(*[git_check_ref_format(f) for f in ref_filters]))
+    self.assertEqual(
+        [git_patrol.check_ref_format(f) for f in ref_filters], expected)
+
+  def testSubprocessLimit(self):
+    semaphore = asyncio.Semaphore(1)
+    sleep = git_patrol.make_subprocess_cmd('sleep', semaphore)
+    loop = asyncio.get_event_loop()
+
+    async def run_limited():
+      # The second process can't start until the first one exits.
+      first = await sleep('0.2')
+      second = asyncio.ensure_future(sleep('0'))
+      await asyncio.sleep(0.1)
+      self.assertFalse(second.done())
+      await first.wait()
+      second_subproc = await asyncio.wait_for(second, 5)
+      return await second_subproc.wait()
+
+    self.assertEqual(loop.run_until_complete(run_limited()), 0)
+
+  def testTargetSchedule(self):
+    schedule = git_patrol.TargetSchedule.from_config(
+        {'alias': 'test', 'poll_interval': 600, 'poll_jitter': 30,
+         'poll_windows': ['22:00-02:00', '12:00-13:00']}, 7200)
+    self.assertEqual(schedule.interval, 600)
+    self.assertEqual(
+        schedule.windows, [(22 * 3600, 2 * 3600), (12 * 3600, 13 * 3600)])
+    self.assertEqual(
+        git_patrol.TargetSchedule.from_config({'alias': 'test'}, 7200).interval,
+        7200)
+
+    with unittest.mock.patch.object(
+        git_patrol.random, 'uniform', return_value=10):
+      # Inside a window wrapping around midnight, plus jitter.
+      self.assertEqual(
+          schedule.delay(60, datetime.datetime(2019, 1, 1, 1, 0)), 70)
+      # Outside of every window, wait for the next one to open.
+      self.assertEqual(
+          schedule.delay(60, datetime.datetime(2019, 1, 1, 11, 0)),
+          3600)
+
+    for bad_config in [
+        {'poll_interval': 0},
+        {'poll_interval': 'often'},
+        {'poll_interval': 60, 'poll_jitter': 60},
+        {'poll_windows': '12:00-13:00'},
+        {'poll_windows': ['12:00-12:00']},
+        {'poll_windows': ['24:00-01:00']}]:
+      with self.assertRaises(ValueError):
+        git_patrol.TargetSchedule.from_config(
+            dict(bad_config, alias='test'), 7200)
+
+  def testAdaptivePollInterval(self):
+    interval = git_patrol.AdaptivePollInterval(60, 1000, 100)
+    self.assertEqual(
+        [interval.record(changed) for changed in
+         [False, False, False, False, True, False]],
+        [200, 400, 800, 1000, 60, 120])
+
+    # Seeded with half the median time between the latest changes and now.
+    now = datetime.datetime(2019, 1, 1, 12)
+    change_times = [now - datetime.timedelta(seconds=s) for s in [600, 800]]
+    self.assertEqual(
+        git_patrol.AdaptivePollInterval.from_history(
+            60, 1000, change_times, now).interval, 300)
+    self.assertEqual(
+        git_patrol.AdaptivePollInterval.from_history(
+            60, 1000, [], now).interval, 1000)
+
+  def testCancelledTargetLoopFinishesPoll(self):
+    loop = asyncio.get_event_loop()
+    polling = asyncio.Event()
+    poll_uuid = uuid.uuid4()
+    new_refs = {'refs/heads/master': 'abcde'}
+    workflow_refs = []
+
+    async def fake_run_workflow_triggers(*args):
+      polling.set()
+      await asyncio.sleep(0.01)
+      return poll_uuid, new_refs, new_refs
+
+    async def fake_run_workflow_body(
+        commands, db, config_path, config, git_poll_uuid, git_ref,
+        dispatcher=None):
+      workflow_refs.append(git_ref)
+
+    dispatcher = git_patrol.WorkflowDispatcher()
+    target_loop = asyncio.ensure_future(git_patrol.target_loop(
+        commands=None, loop=loop, db=None, config_path=None,
+        target_config={'alias': 'patrol', 'url': 'https://host/patrol.git'},
+        offset=-1, interval=0.01, dispatcher=dispatcher,
+        initial_state=(None, {})))
+
+    async def cancel_during_poll():
+      await polling.wait()
+      target_loop.cancel()
+      await asyncio.gather(target_loop, return_exceptions=True)
+      await dispatcher.join()
+
+    with unittest.mock.patch.object(
+        git_patrol, 'run_workflow_triggers', fake_run_workflow_triggers), \
+        unittest.mock.patch.object(
+            git_patrol, 'run_workflow_body', fake_run_workflow_body):
+      loop.run_until_complete(cancel_during_poll())
+
+    # The journaled new refs still get their workflows.
+    self.assertTrue(target_loop.cancelled())
+    self.assertEqual(workflow_refs, list(new_refs.items()))
+
+  def testCloudBuildWatcher(self):
+    # Builds 'a' and 'b' are both running at first, then 'a' finishes.
+    # Describing build 'c' always fails.
+    ongoing_builds = [b'a\nb\nc\n', b'b\n']
+
+    def gcloud_builds_returncode(*args, count):
+      return 1 if args[1] == 'describe' and args[3] == 'c' else 0
+
+    def gcloud_builds_stdout(*args, count):
+      if args[1] == 'list':
+        return ongoing_builds[count] if count < len(ongoing_builds) else b''
+      if args[1] == 'describe':
+        return json.dumps({'id': args[3], 'status': 'SUCCESS'}).encode()
+      raise ValueError('Unexpected gcloud command: {}'.format(args[1]))
+
+    commands = git_patrol.GitPatrolCommands()
+    commands.gcloud = unittest.mock.MagicMock()
+    commands.gcloud.side_effect = _MakeFakeCommand(
+        returncode_fn=gcloud_builds_returncode, stdout_fn=gcloud_builds_stdout)
+    watcher = git_patrol.CloudBuildWatcher(
+        commands, min_interval=0, max_interval=0)
+
+    results = asyncio.get_event_loop().run_until_complete(asyncio.gather(
+        watcher.wait('a'), watcher.wait('b'), watcher.wait('c')))
+    self.assertEqual(
+        results,
+        [{'id': 'a', 'status': 'SUCCESS'}, {'id': 'b', 'status': 'SUCCESS'},
+         None])
+
+    # One list per check for all builds, and one describe per finished build
+    # plus the failed attempts for build 'c'.
+    gcloud_subcommands = [
+        args[1] for (args, _) in commands.gcloud.call_args_list]
+    self.assertEqual(
+        gcloud_subcommands.count('list'),
+        1 + git_patrol.BUILD_DESCRIBE_ATTEMPTS)
+    self.assertEqual(
+        gcloud_subcommands.count('describe'),
+        2 + git_patrol.BUILD_DESCRIBE_ATTEMPTS)
+
+  def testCloudBuildWatcherSurvivesErrors(self):
+    # Listing builds fails with an unexpected error before 'a' finishes.
+    class FakeCloudBuildClient:
+      def __init__(self):
+        self.listings = 0
+
+      async def list_ongoing_builds(self):
+        self.listings += 1
+        if self.listings == 1:
+          raise RuntimeError('unexpected')
+        return set()
+
+      async def get_build(self, build_id):
+        return {'id': build_id, 'status': 'SUCCESS'}
+
+    commands = git_patrol.GitPatrolCommands()
+    commands.cloud_build = FakeCloudBuildClient()
+    watcher = git_patrol.CloudBuildWatcher(
+        commands, min_interval=0, max_interval=0)
+    loop = asyncio.get_event_loop()
+    self.assertEqual(
+        loop.run_until_complete(watcher.wait('a')),
+        {'id': 'a', 'status': 'SUCCESS'})
+    self.assertEqual(commands.cloud_build.listings, 2)
+
+    # Waiters left when the watcher stops get no build rather than hang.
+    watcher.min_interval = 3600
+    waiter = asyncio.ensure_future(watcher.wait('b'))
+    loop.run_until_complete(asyncio.sleep(0))
+    watcher._task.cancel()
+    self.assertIsNone(loop.run_until_complete(waiter))
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,319 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Receives push webhooks and wakes up the matching target loops.
+
+Git hosting services can notify Git Patrol of new commits rather than waiting
+for the next periodic poll. Understands GitHub push events and the Gerrit
+stream-events payloads sent by the Gerrit webhooks plugin. A webhook only
+triggers an early poll of the matching targets through their target loop, so
+git refs are still read from the repository itself and the webhook payload is
+never trusted for anything else.
+See https://developer.github.com/webhooks/ and
+https://gerrit.googlesource.com/plugins/webhooks/ for the payloads.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import urllib.parse
+
+import git_patrol_http
+
+
+logger = logging.getLogger(__name__)
+
+# Largest webhook payload accepted, in bytes.
+MAX_WEBHOOK_BODY_BYTES = 1024 * 1024
+
+# Time in seconds a client gets to send its complete request.
+WEBHOOK_READ_TIMEOUT_SECS = 10
+
+HTTP_REASONS = {
+    200: 'OK',
+    202: 'Accepted',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+}
+
+
+class WebhookError(Exception):
+  """Raised when a webhook request must be rejected."""
+
+  def __init__(self, status, message):
+    super(WebhookError, self).__init__(message)
+    self.status = status
+
+
+def repository_key(url):
+  """Reduce a repository URL to a key shared by all URLs of the repository.
+
+  Drops the scheme, credentials, port and any '.git' suffix, so that the
+  https:// URL polled by a target matches the git:// or ssh:// URLs found in
+  webhook payloads.
+
+  Args:
+    url: URL of a git repository.
+  Returns:
+    A (host, path) tuple.
+  """
+  if '://' not in url and ':' in url:
+    # scp-like ssh syntax (ex: git@github.com:google/git-patrol.git)
+    host, _, path = url.partition(':')
+    url = 'ssh://{}/{}'.format(host, path)
+  parsed = urllib.parse.urlsplit(url)
+  path = parsed.path.strip('/')
+  if path.endswith('.git'):
+    path = path[:-len('.git')]
+  return (parsed.hostname or '').lower(), path
+
+
+def github_push_event(headers, payload):
+  """Extract the repository URLs and git ref of a GitHub push event.
+
+  Args:
+    headers: Dictionary of request headers with lower case names.
+    payload: The decoded JSON payload.
+  Returns:
+    A (list, str) tuple of repository URLs and the full git ref name, or None
+    when this isn't a GitHub push event.
+  """
+  if headers.get('x-github-event') != 'push':
+    return None
+  repository = payload.get('repository') or {}
+  urls = [
+      repository[key] for key in ('clone_url', 'git_url', 'ssh_url', 'html_url')
+      if repository.get(key)]
+  return urls, payload.get('ref')
+
+
+def gerrit_event(payload):
+  """Extract the project name and git ref of a Gerrit event.
+
+  Args:
+    payload: The decoded JSON payload.
+  Returns:
+    A (str, str) tuple of the Gerrit project name and the full git ref name,
+    or None when this isn't a Gerrit event that updates a git ref.
+  """
+  event_type = payload.get('type')
+  if event_type == 'ref-updated':
+    ref_update = payload.get('refUpdate') or {}
+    refname = ref_update.get('refName') or ''
+    if refname and not refname.startswith('refs/'):
+      # Older Gerrit versions send short branch names.
+      refname = 'refs/heads/' + refname
+    return ref_update.get('project'), refname
+  if event_type in ('patchset-created', 'change-merged'):
+    change = payload.get('change') or {}
+    patch_set = payload.get('patchSet') or {}
+    refname = patch_set.get('ref')
+    if event_type == 'change-merged' and change.get('branch'):
+      refname = 'refs/heads/' + change['branch']
+    return change.get('project'), refname
+  return None
+
+
+class WebhookReceiver:
+  """Minimal HTTP server turning push webhooks into early target polls.
+
+  Each target gets an asyncio.Event, which target_loop() waits on between its
+  periodic polls. Webhooks set the events of the matching targets. Events that
+  arrive while a poll is in progress collapse into a single follow-up poll.
+  """
+
+  def __init__(self, targets, secret=None):
+    """Create a new receiver.
+
+    Args:
+      targets: List of target configuration objects.
+      secret: Optional shared secret. When set, requests must either carry a
+        GitHub style X-Hub-Signature-256 HMAC of their body made with this
+        secret, or pass the secret in a 'token' query parameter for services
+        that can't sign their webhooks.
+    """
+    self.secret = secret
+    self.triggers = {}
+    self._targets_by_alias = {}
+    self._targets_by_repository = {}
+    for target_config in targets:
+      alias = target_config['alias']
+      self.triggers[alias] = asyncio.Event()
+      self._targets_by_alias[alias] = target_config
+      self._targets_by_repository.setdefault(
+          repository_key(target_config['url']), []).append(target_config)
+    self._server = None
+
+  async def start(self, host, port):
+    """Start accepting webhooks.
+
+    Args:
+      host: Address to listen on.
+      port: Port to listen on. Zero picks a free port.
+    Returns:
+      The port the receiver listens on.
+    """
+    self._server = await asyncio.start_server(
+        self._handle_connection, host, port)
+    return self._server.sockets[0].getsockname()[1]
+
+  async def stop(self):
+    """Stop accepting webhooks."""
+    self._server.close()
+    await self._server.wait_closed()
+
+  def _authorized(self, query, headers, body):
+    if not self.secret:
+      return True
+    signature = headers.get('x-hub-signature-256', '')
+    if signature.startswith('sha256='):
+      expected = hmac.new(
+          self.secret.encode(), body, hashlib.sha256).hexdigest()
+      return hmac.compare_digest(signature[len('sha256='):], expected)
+    token = urllib.parse.parse_qs(query).get('token', [''])[0]
+    return hmac.compare_digest(token.encode(), self.secret.encode())
+
+  def _matching_targets(self, path, headers, payload):
+    """Find the targets a webhook refers to.
+
+    Returns:
+      A (list, str) tuple of target configuration objects and the full name of
+      the updated git ref, if known.
+    """
+    # Webhooks can also name a target directly (ex: /webhook/<alias>).
+    alias = urllib.parse.unquote(path[len('/webhook/'):]) if (
+        path.startswith('/webhook/')) else None
+    if alias:
+      if alias not in self._targets_by_alias:
+        raise WebhookError(404, 'unknown target ' + alias)
+      return [self._targets_by_alias[alias]], None
+
+    github = github_push_event(headers, payload)
+    if github:
+      urls, refname = github
+      keys = set(repository_key(url) for url in urls)
+      return [
+          target_config
+          for key in keys
+          for target_config in self._targets_by_repository.get(key, [])
+      ], refname
+
+    gerrit = gerrit_event(payload)
+    if gerrit:
+      project, refname = gerrit
+      # Gerrit serves a project below a host specific prefix (ex: /a/ for
+      # authenticated access), so match on the end of the repository path.
+      return [
+          target_config
+          for ((_, repo_path), target_configs) in (
+              self._targets_by_repository.items())
+          for target_config in target_configs
+          if project and (
+              repo_path == project or repo_path.endswith('/' + project))
+      ], refname
+    return [], None
+
+  def handle(self, method, target, headers, body):
+    """Process a single webhook request.
+
+    Args:
+      method: The HTTP method.
+      target: The request target (path and query string).
+      headers: Dictionary of request headers with lower case names.
+      body: The request body.
+    Returns:
+      A (int, dict) tuple with the HTTP status and the JSON response.
+    """
+    path, _, query = target.partition('?')
+    try:
+      if path != '/webhook' and not path.startswith('/webhook/'):
+        raise WebhookError(404, 'not found')
+      if method != 'POST':
+        raise WebhookError(405, 'webhooks must be POSTed')
+      if not self._authorized(query, headers, body):
+        raise WebhookError(401, 'bad signature')
+      try:
+        payload = json.loads(body.decode('utf-8'))
+      except ValueError:
+        raise WebhookError(400, 'invalid JSON payload')
+      if not isinstance(payload, dict):
+        raise WebhookError(400, 'invalid JSON payload')
+
+      target_configs, refname = self._matching_targets(path, headers, payload)
+    except WebhookError as e:
+      logger.warning('Rejected webhook %s: %s', path, e)
+      return e.status, {'error': str(e)}
+
+    triggered = []
+    for target_config in target_configs:
+      # Skip targets that don't watch the updated git ref.
+      if (refname and refname.startswith('refs/') and
+          not git_patrol_http.ref_filters_match(
+              refname, target_config.get('ref_filters', []))):
+        continue
+      self.triggers[target_config['alias']].set()
+      triggered.append(target_config['alias'])
+    logger.info('Webhook %s triggered polls of %s', path, triggered)
+    return 202 if triggered else 200, {'triggered': triggered}
+
+  async def _read_request(self, reader):
+    request_line = await reader.readline()
+    if not request_line:
+      return None
+    try:
+      method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+      raise WebhookError(400, 'invalid request line')
+    headers = {}
+    while True:
+      line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+      if not line:
+        break
+      name, _, value = line.partition(':')
+      headers[name.strip().lower()] = value.strip()
+    try:
+      length = int(headers.get('content-length', 0))
+    except ValueError:
+      raise WebhookError(400, 'invalid content length')
+    if length > MAX_WEBHOOK_BODY_BYTES:
+      raise WebhookError(413, 'payload too large')
+    body = await reader.readexactly(length)
+    return method, target, headers, body
+
+  async def _handle_connection(self, reader, writer):
+    try:
+      try:
+        request = await asyncio.wait_for(
+            self._read_request(reader), WEBHOOK_READ_TIMEOUT_SECS)
+        if not request:
+          return
+        status, response = self.handle(*request)
+      except WebhookError as e:
+        status, response = e.status, {'error': str(e)}
+      body = json.dumps(response).encode()
+      writer.write(
+          'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+          'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(
+              status, HTTP_REASONS.get(status, ''), len(body)).encode() +
+          body)
+      await writer.drain()
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+      logger.warning('Webhook connection failed: %r', e)
+    finally:
+      writer.close()
@@ -51,6 +51,10 @@ BEGIN;
     --
     -- Note: Fixed array dimensions are not enforced by Postgres. Provided
     -- purely for documentation-as-code purposes.
+    --
+    -- When "checkpoint_uuid" is not NULL this entry is a delta and only holds
+    -- the git refs that were added or updated since the previous entry for
+    -- the same "alias".
     refs text[][2],
     -- Filter patterns (if any) used to filter the git refs returned for this
     -- journal entry. There isn't a canonical name for this term in the git
@@ -59,6 +63,15 @@ BEGIN;
     -- be empty. The "git check-ref-format --allow-onelevel --refspec-pattern"
     -- command must be used to validate all entries.
     ref_filters text[],
+    -- Identifies the most recent full snapshot of the git refs for the
+    -- repository identified by "alias". NULL if this entry is itself a full
+    -- snapshot. Otherwise the current set of git refs is reconstructed by
+    -- starting from the snapshot and applying every delta entry that refers
+    -- to it, in "update_time" order, up to and including this one.
+    checkpoint_uuid uuid,
+    -- Names of the git refs that were deleted since the previous entry for the
+    -- same "alias". Only used by delta entries. NULL or empty otherwise.
+    deleted_refs text[],
     PRIMARY KEY(git_poll_uuid));
 
   CREATE TABLE cloud_build_journal (
@@ -92,7 +105,66 @@ BEGIN;
 
     -- Dump of the JSON status returned by "gcloud builds describe" command. If
     -- the parent_id field is non-zero then this entry *must* have a different
-    -- status field than the previous entry.
+    -- status field than the previous entry. Git Patrol adds a few statuses of
+    -- its own: PENDING when the workflow hasn't started yet, and SUPERSEDED
+    -- when a newer commit of the git ref runs the remaining workflows.
     cloud_build_status jsonb,
+
+    -- Alias of the workflow this entry is about. Used to resume the remaining
+    -- workflows of a git ref after a restart.
+    workflow text,
     PRIMARY KEY(journal_id));
+
+  -- Look up the latest journal entries of an alias without scanning the whole
+  -- journal. Databases created from older versions of this file get these
+  -- from the migrations in the "migrations" folder, which also partition
+  -- both journals by month on PostgreSQL 11 or later.
+  CREATE INDEX git_poll_journal_alias_time_idx
+    ON git_poll_journal (alias, update_time DESC);
+  CREATE INDEX cloud_build_journal_alias_time_idx
+    ON cloud_build_journal (alias, update_time DESC);
+
+  -- Latest poll of each alias. Polls that find exactly the same git refs as
+  -- the latest git_poll_journal entry can update this table instead of adding
+  -- another journal entry.
+  CREATE TABLE git_poll_heartbeat (
+    -- Human consumable alias for the repository.
+    alias text,
+
+    -- Identifies the latest git_poll_journal entry of this alias at the time
+    -- of the heartbeat. Its git refs are the ones found by the heartbeat poll.
+    git_poll_uuid uuid,
+
+    -- Time of the latest poll. Always in UTC.
+    last_seen timestamp,
+
+    -- URL of the repository at the time of the latest poll.
+    url text,
+
+    -- Number of unchanged polls recorded by this heartbeat.
+    polls bigint,
+    PRIMARY KEY(alias));
+
+  -- Git Patrol instances sharing this database. Each instance only polls the
+  -- targets it holds a lease on, see the target_lease table.
+  CREATE TABLE patrol_instance (
+    -- Identifies the instance for as long as its process runs.
+    instance_id text,
+
+    -- Time the instance last renewed its leases. Always in UTC.
+    heartbeat_time timestamp,
+    PRIMARY KEY(instance_id));
+
+  -- Targets currently polled by each instance.
+  CREATE TABLE target_lease (
+    -- Human consumable alias for the repository.
+    alias text,
+
+    -- Instance holding the lease.
+    instance_id text,
+
+    -- Time after which another instance may take over the target unless the
+    -- lease is renewed. Always in UTC.
+    expire_time timestamp,
+    PRIMARY KEY(alias));
 END;
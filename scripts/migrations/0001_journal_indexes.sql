@@ -0,0 +1,28 @@
+-- Copyright 2019 Google LLC
+--
+-- Licensed under the Apache License, Version 2.0 (the "License");
+-- you may not use this file except in compliance with the License.
+-- You may obtain a copy of the License at
+--
+--     https://www.apache.org/licenses/LICENSE-2.0
+--
+-- Unless required by applicable law or agreed to in writing, software
+-- distributed under the License is distributed on an "AS IS" BASIS,
+-- WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+-- See the License for the specific language governing permissions and
+-- limitations under the License.
+--
+-- Brings databases created from older versions of git_patrol_db.sql up to
+-- date. Migrations are applied in file name order inside a single transaction
+-- by GitPatrolDb.migrate(), so they must not contain BEGIN/END themselves.
+
+-- Columns used by delta git poll journal entries.
+ALTER TABLE git_poll_journal ADD COLUMN IF NOT EXISTS checkpoint_uuid uuid;
+ALTER TABLE git_poll_journal ADD COLUMN IF NOT EXISTS deleted_refs text[];
+
+-- Look up the latest journal entries of an alias without scanning the whole
+-- journal. Used at startup and when reconstructing delta entries.
+CREATE INDEX IF NOT EXISTS git_poll_journal_alias_time_idx
+  ON git_poll_journal (alias, update_time DESC);
+CREATE INDEX IF NOT EXISTS cloud_build_journal_alias_time_idx
+  ON cloud_build_journal (alias, update_time DESC);
@@ -0,0 +1,105 @@
+-- Copyright 2019 Google LLC
+--
+-- Licensed under the Apache License, Version 2.0 (the "License");
+-- you may not use this file except in compliance with the License.
+-- You may obtain a copy of the License at
+--
+--     https://www.apache.org/licenses/LICENSE-2.0
+--
+-- Unless required by applicable law or agreed to in writing, software
+-- distributed under the License is distributed on an "AS IS" BASIS,
+-- WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+-- See the License for the specific language governing permissions and
+-- limitations under the License.
+--
+-- Partitions both journals by month of "update_time" so lookups of recent
+-- entries only touch recent partitions and old partitions can be detached
+-- and archived wholesale. Requires PostgreSQL 11 or later for default
+-- partitions and primary keys on partitioned tables. Older servers keep the
+-- unpartitioned tables and only get the indexes from the previous migration.
+--
+-- Partitioned tables can't have a primary key without the partition key, and
+-- foreign keys can't reference partitioned tables before PostgreSQL 12. The
+-- primary keys therefore include "update_time" and the foreign key from
+-- cloud_build_journal to git_poll_journal is dropped.
+
+-- Creates the monthly partitions of a journal covering the given time range.
+-- Does nothing for journals that aren't partitioned.
+CREATE OR REPLACE FUNCTION git_patrol_create_journal_partitions(
+    journal regclass, from_time timestamp, to_time timestamp)
+RETURNS void AS $$
+DECLARE
+  month timestamp := date_trunc('month', from_time);
+BEGIN
+  IF (SELECT relkind FROM pg_class WHERE oid = journal) <> 'p' THEN
+    RETURN;
+  END IF;
+  WHILE month <= to_time LOOP
+    EXECUTE format(
+      'CREATE TABLE IF NOT EXISTS %I PARTITION OF %s FOR VALUES FROM (%L) TO (%L)',
+      journal::text || to_char(month, '"_y"YYYY"m"MM'), journal, month,
+      month + interval '1 month');
+    month := month + interval '1 month';
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+  first_time timestamp;
+BEGIN
+  IF current_setting('server_version_num')::integer < 110000 THEN
+    RAISE NOTICE 'Journal partitioning requires PostgreSQL 11 or later';
+    RETURN;
+  END IF;
+  IF (SELECT relkind FROM pg_class
+      WHERE oid = 'git_poll_journal'::regclass) = 'p' THEN
+    RETURN;
+  END IF;
+
+  ALTER TABLE cloud_build_journal
+    DROP CONSTRAINT IF EXISTS cloud_build_journal_git_poll_uuid_fkey;
+
+  -- Git poll journal.
+  ALTER TABLE git_poll_journal RENAME TO git_poll_journal_old;
+  ALTER TABLE git_poll_journal_old
+    RENAME CONSTRAINT git_poll_journal_pkey TO git_poll_journal_old_pkey;
+  DROP INDEX IF EXISTS git_poll_journal_alias_time_idx;
+  CREATE TABLE git_poll_journal (
+    LIKE git_poll_journal_old INCLUDING DEFAULTS,
+    PRIMARY KEY (git_poll_uuid, update_time))
+    PARTITION BY RANGE (update_time);
+  CREATE TABLE git_poll_journal_default PARTITION OF git_poll_journal DEFAULT;
+  SELECT min(update_time) INTO first_time FROM git_poll_journal_old;
+  PERFORM git_patrol_create_journal_partitions(
+    'git_poll_journal', coalesce(first_time, now() at time zone 'utc'),
+    (now() at time zone 'utc') + interval '1 month');
+  INSERT INTO git_poll_journal SELECT * FROM git_poll_journal_old;
+  DROP TABLE git_poll_journal_old;
+  CREATE INDEX git_poll_journal_alias_time_idx
+    ON git_poll_journal (alias, update_time DESC);
+
+  -- Cloud Build journal. The journal_id sequence outlives the old table.
+  ALTER TABLE cloud_build_journal RENAME TO cloud_build_journal_old;
+  ALTER TABLE cloud_build_journal_old
+    RENAME CONSTRAINT cloud_build_journal_pkey TO cloud_build_journal_old_pkey;
+  DROP INDEX IF EXISTS cloud_build_journal_alias_time_idx;
+  ALTER SEQUENCE cloud_build_journal_journal_id_seq OWNED BY NONE;
+  CREATE TABLE cloud_build_journal (
+    LIKE cloud_build_journal_old INCLUDING DEFAULTS,
+    PRIMARY KEY (journal_id, update_time))
+    PARTITION BY RANGE (update_time);
+  CREATE TABLE cloud_build_journal_default
+    PARTITION OF cloud_build_journal DEFAULT;
+  SELECT min(update_time) INTO first_time FROM cloud_build_journal_old;
+  PERFORM git_patrol_create_journal_partitions(
+    'cloud_build_journal', coalesce(first_time, now() at time zone 'utc'),
+    (now() at time zone 'utc') + interval '1 month');
+  INSERT INTO cloud_build_journal SELECT * FROM cloud_build_journal_old;
+  DROP TABLE cloud_build_journal_old;
+  ALTER SEQUENCE cloud_build_journal_journal_id_seq
+    OWNED BY cloud_build_journal.journal_id;
+  CREATE INDEX cloud_build_journal_alias_time_idx
+    ON cloud_build_journal (alias, update_time DESC);
+END;
+$$;
@@ -0,0 +1,23 @@
+-- Copyright 2019 Google LLC
+--
+-- Licensed under the Apache License, Version 2.0 (the "License");
+-- you may not use this file except in compliance with the License.
+-- You may obtain a copy of the License at
+--
+--     https://www.apache.org/licenses/LICENSE-2.0
+--
+-- Unless required by applicable law or agreed to in writing, software
+-- distributed under the License is distributed on an "AS IS" BASIS,
+-- WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+-- See the License for the specific language governing permissions and
+-- limitations under the License.
+--
+-- Adds the git_poll_heartbeat table used by --db_heartbeat_unchanged_polls.
+
+CREATE TABLE IF NOT EXISTS git_poll_heartbeat (
+  alias text,
+  git_poll_uuid uuid,
+  last_seen timestamp,
+  url text,
+  polls bigint,
+  PRIMARY KEY(alias));
@@ -0,0 +1,26 @@
+-- Copyright 2019 Google LLC
+--
+-- Licensed under the Apache License, Version 2.0 (the "License");
+-- you may not use this file except in compliance with the License.
+-- You may obtain a copy of the License at
+--
+--     https://www.apache.org/licenses/LICENSE-2.0
+--
+-- Unless required by applicable law or agreed to in writing, software
+-- distributed under the License is distributed on an "AS IS" BASIS,
+-- WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+-- See the License for the specific language governing permissions and
+-- limitations under the License.
+--
+-- Adds the patrol_instance and target_lease tables used by --lease_seconds.
+
+CREATE TABLE IF NOT EXISTS patrol_instance (
+  instance_id text,
+  heartbeat_time timestamp,
+  PRIMARY KEY(instance_id));
+
+CREATE TABLE IF NOT EXISTS target_lease (
+  alias text,
+  instance_id text,
+  expire_time timestamp,
+  PRIMARY KEY(alias));